@@ -1,54 +1,312 @@
-from fastapi import FastAPI
+import os
+import json
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel
+from loguru import logger
 
 import workflow as wf
 
-# connect to the database
-wf.init_db()
+# FIXME: workspace should be configured per deployment
+workspace = wf.Workspace(base_path=os.environ.get('COMFYUI_WORKSPACE', "/home/ruoyu.huang/workspace/xiaoapp/comfyui_workspace"))
+
+# connect to the database of the workspace
+wf.init_db(workspace)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # stop the runs of this process, their ComfyUI servers are torn down
+    for active_run in list(active_runs.values()):
+        active_run.task.cancel()
+    await asyncio.gather(*[r.task for r in active_runs.values()], return_exceptions=True)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class RunRequest(BaseModel):
+    input_override: Dict[str, Dict] = {}
+    priority: str = 'interactive' # priority class of the run when runs are queued
+
+
+class ActiveRun:
+    """ A workflow run supervised by this process, its events are published on the event bus """
+
+    def __init__(self):
+        self.runner: Optional[wf.AsyncComfyUIRunner] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+# {workflow run id -> active run}
+active_runs: Dict[int, ActiveRun] = {}
+
+TERMINAL_STATUSES = {wf.WorkflowRunStatus.TERMINATED.value}
 
 
-app = FastAPI()
+def _run_event(workflow_run: wf.WorkflowRunRecord) -> Dict:
+    # current state of a run, first event of a stream
+    return wf.RunEvent(
+        type='status', run_id=workflow_run.id, workflow_id=workflow_run.workflow_id, status=workflow_run.status,
+        updated_at=workflow_run.updated_at, progress_json=workflow_run.progress_json, timestamp=time.time()
+    ).model_dump()
+
 
 @app.get("/api/workflows")
-def list_workflows():
-    workflows = wf.list_workflows()    
-    return {"workflows": workflows}
+def list_workflows(limit: int = Query(100, ge=1, le=1000), after_id: Optional[int] = None):
+    workflows = wf.list_workflows(limit=limit, after_id=after_id)
+    next_after_id = workflows[-1].id if len(workflows) == limit else None
+    return {"workflows": workflows, "next_after_id": next_after_id}
+
+
+def _query_runs(workflow_id: Optional[int], status: Optional[List[str]], created_after: Optional[str],
+                created_before: Optional[str], limit: int, cursor: Optional[str]):
+    try:
+        return wf.query_workflow_runs(
+            status=status, workflow_id=workflow_id, created_after=created_after,
+            created_before=created_before, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/runs")
+def list_workflow_runs(workflow_id: Optional[int] = None, status: Optional[List[str]] = Query(None),
+                       created_after: Optional[str] = None, created_before: Optional[str] = None,
+                       limit: int = Query(50, ge=1, le=500), cursor: Optional[str] = None):
+    """ Runs newest first, pass `next_cursor` of a page as `cursor` to get the next page """
+    return _query_runs(workflow_id, status, created_after, created_before, limit, cursor)
+
+
+@app.get("/api/workflows/{workflow_id}/runs")
+def list_runs_of_workflow(workflow_id: int, status: Optional[List[str]] = Query(None),
+                          created_after: Optional[str] = None, created_before: Optional[str] = None,
+                          limit: int = Query(50, ge=1, le=500), cursor: Optional[str] = None):
+    return _query_runs(workflow_id, status, created_after, created_before, limit, cursor)
+
+
+async def _in_thread(fn):
+    """ Run a blocking call in a worker thread, a cancelled caller still waits for it to finish """
+    call = asyncio.ensure_future(asyncio.to_thread(fn))
+    try:
+        return await asyncio.shield(call)
+    except asyncio.CancelledError:
+        await call
+        raise
+
+
+def _server_host(runner: Optional[wf.AsyncComfyUIRunner], http_request: Request) -> Optional[str]:
+    """ Host of the ComfyUI server of a run, None while the run is queued """
+    if runner is None:
+        return None
+    if runner.host in ('0.0.0.0', '::'):
+        # listening on all interfaces, the server is reached on the host of this API
+        return http_request.url.hostname
+    return runner.host
 
 
 @app.post("/api/workflows/{workflow_id}/run")
-def launch_workflow(workflow_id: str):
+async def launch_workflow(workflow_id: int, http_request: Request, request: Optional[RunRequest] = None):
+    request = request if request is not None else RunRequest()
+
     # Get workflow metadata from database
-    workflow_record_to_run = wf.get_workflow_by_id(workflow_id)
+    # database and file reads run in a worker thread, the event loop supervises the runs
+    workflow_record_to_run = await asyncio.to_thread(wf.workflow_cache.get_record, workflow_id)
+    if workflow_record_to_run is None:
+        raise HTTPException(status_code=404, detail=f"Workflow {workflow_id} not found")
+
+    # Get workflow manifest from the workflow directory, cached per workflow
+    workflow_to_run = await asyncio.to_thread(wf.workflow_cache.get_manifest, workflow_record_to_run)
+
+    # Start now, or queue the run until a slot is free, reject when the queue is full
+    try:
+        ticket = wf.admission_controller.request(workflow_record_to_run.id, priority=request.priority)
+    except wf.AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={'Retry-After': str(e.retry_after_sec)})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    # Get workflow manifest from the workflow directory
-    workflow_to_run = wf.get_workflow_manifest(workflow_record_to_run.workflow_dir)
+    # Start workflow process runner in the background, the request returns immediately
+    active_run = ActiveRun()
+    workflow_run = None
 
-    # Start workflow process runner
-    runner = wf.ComfyUIRunner(workflow_to_run)
-    runner.setup()
+    def create_runner():
+        # the runner leases the server port, a queued run gets one when admitted
+        active_run.runner = wf.AsyncComfyUIRunner(
+            workspace, workflow_to_run, workflow_run,
+            # the runner publishes run events, the database is updated in the background
+            callback=wf.submit_workflow_run_update)
+
+    try:
+        workflow_run = await asyncio.to_thread(wf.create_workflow_run, wf.WorkflowRunRecord(
+            workflow_id=workflow_record_to_run.id,
+            status=wf.WorkflowRunStatus.PENDING.value,
+            created_at=datetime.now().isoformat(),
+            input_files_json=json.dumps([]),
+            input_override_json=json.dumps(request.input_override)
+        ))
+        active_runs[workflow_run.id] = active_run
+        if ticket.granted:
+            await asyncio.to_thread(create_runner)
+    except Exception:
+        # the run never started, its ticket must not hold a slot
+        ticket.release()
+        if workflow_run is not None:
+            active_runs.pop(workflow_run.id, None)
+        raise
+
+    async def execute():
+        started = False
+        try:
+            await ticket.wait_async()
+            if active_run.runner is None:
+                await _in_thread(create_runner)
+            started = True
+            await active_run.runner.execute()
+        except asyncio.CancelledError:
+            if not started:
+                # stopped while queued, a runner created meanwhile gives its port back
+                if active_run.runner is not None:
+                    active_run.runner.server.release_port()
+                workflow_run.status = wf.WorkflowRunStatus.TERMINATED.value
+                workflow_run.updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                wf.event_bus.publish_run(workflow_run)
+                wf.submit_workflow_run_update(workflow_run)
+            raise
+        finally:
+            ticket.release()
+            active_runs.pop(workflow_run.id, None)
+    active_run.task = asyncio.create_task(execute())
 
-    # TODO: load the workflow_api.json
-    # runner.run()
     result = {
-        "run_id": runner.run_id,
-        "host": '100.112.4.55', # FIXME: a placeholder
-        "port": runner.port
+        "run_id": workflow_run.id,
+        "status": workflow_run.status,
+        "queued": not ticket.granted,
+        "host": _server_host(active_run.runner, http_request),
+        "port": active_run.runner.port if active_run.runner is not None else None
     }
-    print(f'Running workflow: {result}')
+    logger.info(f'Running workflow: {result}')
 
     return result
 
 
+@app.get("/api/workflows/{workflow_id}/run/{run_id}")
+def get_workflow_run(workflow_id: int, run_id: int):
+    workflow_run = wf.get_workflow_run_by_id(run_id)
+    if workflow_run is None:
+        raise HTTPException(status_code=404, detail=f"Workflow run {run_id} not found")
+    return workflow_run
+
+
+async def _run_events(run_id: int):
+    """ Events of a run, from its current state until the run is terminated """
+    # subscribe before reading the current state, no event is missed in between
+    async with wf.event_bus.subscribe_async(run_id=run_id) as subscription:
+        workflow_run = await asyncio.to_thread(wf.get_workflow_run_by_id, run_id)
+        if workflow_run is None:
+            raise HTTPException(status_code=404, detail=f"Workflow run {run_id} not found")
+        yield _run_event(workflow_run)
+        if run_id not in active_runs:
+            return
+        async for event in subscription:
+            yield event.model_dump()
+            if event.status in TERMINAL_STATUSES:
+                return
+
+
+async def _workflow_events(workflow_id: int):
+    """ Events of all runs of a workflow, until the client disconnects """
+    async with wf.event_bus.subscribe_async(workflow_id=workflow_id) as subscription:
+        async for event in subscription:
+            yield event.model_dump()
+
+
+async def _sse(events):
+    async for event in events:
+        yield f"data: {json.dumps(event)}\n\n"
+
+
+async def _first(events):
+    # raise HTTPException before the response is started
+    first = await events.__anext__()
+
+    async def stream():
+        yield first
+        async for event in events:
+            yield event
+    return stream()
+
+
+@app.get("/api/workflows/{workflow_id}/run/{run_id}/status")
+async def stream_workflow_run_status(workflow_id: int, run_id: int):
+    """ Server-sent events of the run status, until the run is terminated """
+    events = await _first(_run_events(run_id))
+    return StreamingResponse(_sse(events), media_type="text/event-stream")
+
+
+@app.get("/api/workflows/{workflow_id}/events")
+async def stream_workflow_events(workflow_id: int):
+    """ Server-sent events of all runs of the workflow """
+    return StreamingResponse(_sse(_workflow_events(workflow_id)), media_type="text/event-stream")
+
+
+async def _send_events(websocket: WebSocket, events):
+    await websocket.accept()
+    try:
+        async for event in events:
+            await websocket.send_json(event)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
+@app.websocket("/api/workflows/{workflow_id}/run/{run_id}/ws")
+async def watch_workflow_run(websocket: WebSocket, workflow_id: int, run_id: int):
+    try:
+        events = await _first(_run_events(run_id))
+    except HTTPException as e:
+        await websocket.close(code=4404, reason=e.detail)
+        return
+    await _send_events(websocket, events)
+
+
+@app.websocket("/api/workflows/{workflow_id}/ws")
+async def watch_workflow(websocket: WebSocket, workflow_id: int):
+    await _send_events(websocket, _workflow_events(workflow_id))
+
+
 @app.delete("/api/workflows/{workflow_id}/run/{run_id}")
-def launch_workflow(workflow_id: str, run_id: str):
-    workflow_record_to_run = wf.get_workflow_by_id(workflow_id)
-    workflow_to_run = wf.get_workflow_manifest(workflow_record_to_run.workflow_dir)
-    runner = wf.ComfyUIRunner(workflow_to_run)
-    runner.setup()
+async def stop_workflow_run(workflow_id: int, run_id: int):
+    active_run = active_runs.get(run_id, None)
+    if active_run is None:
+        raise HTTPException(status_code=404, detail=f"Workflow run {run_id} is not running")
 
-    # TODO: load the workflow_api.json
-    # runner.run()
+    # cancelling the task tears down the ComfyUI server
+    active_run.task.cancel()
+    try:
+        await active_run.task
+    except (asyncio.CancelledError, Exception):
+        pass
 
     return {
-        "run_id": runner.run_id,
-        "port": runner.port
-    }
\ No newline at end of file
+        "run_id": run_id,
+        "port": active_run.runner.port if active_run.runner is not None else None
+    }
+
+
+@app.get("/api/metrics/admission")
+def admission_metrics():
+    """ Running and queued runs of this process, admissions, rejections and queue wait time """
+    return wf.admission_controller.metrics()
+
+
+@app.get("/api/metrics/phases", response_class=PlainTextResponse)
+def phase_metrics():
+    """ Duration histograms and bytes of run phases, in the Prometheus text format """
+    return wf.prometheus_exporter.render()
@@ -0,0 +1,138 @@
+""" Run API: launch, status streams and cancel, endpoints called on the event loop of the test
+Run from app-ui: PYTHONPATH='../py' python -m pytest api
+"""
+import asyncio
+import importlib
+import json
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import workflow as wf
+from workflow.database import WorkflowRecord
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    monkeypatch.setenv('COMFYUI_WORKSPACE', str(tmp_path))
+    monkeypatch.delenv('WORKFLOW_DATABASE_URL', raising=False)
+    index = importlib.reload(importlib.import_module('index'))
+    # one run at a time, runs of this process only
+    monkeypatch.setattr(wf, 'admission_controller', wf.AdmissionController(wf.AdmissionConfig(max_running=1)))
+    monkeypatch.setattr(wf, 'workflow_cache', FakeWorkflowCache())
+    return index
+
+
+class FakeWorkflowCache:
+
+    def get_record(self, workflow_id):
+        return WorkflowRecord(id=int(workflow_id), name='test', created_at='now', workflow_dir='/tmp/test')
+
+    def get_manifest(self, record):
+        return None
+
+
+def _http_request() -> Request:
+    return Request({'type': 'http', 'method': 'POST', 'scheme': 'http', 'path': '/', 'query_string': b'',
+                    'headers': [(b'host', b'api.example:8000')], 'server': ('api.example', 8000)})
+
+
+def _create_run(status: str) -> wf.WorkflowRunRecord:
+    return wf.create_workflow_run(wf.WorkflowRunRecord(workflow_id=1, status=status, created_at='now'))
+
+
+async def _read_sse(response, count=None):
+    events = []
+    async for chunk in response.body_iterator:
+        events.append(json.loads(chunk[len('data: '):]))
+        if len(events) == count:
+            break
+    return events
+
+
+def test_ticket_is_released_when_the_run_can_not_be_created(api, monkeypatch):
+    def create_workflow_run(record):
+        raise RuntimeError('database is locked')
+    monkeypatch.setattr(wf, 'create_workflow_run', create_workflow_run)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(api.launch_workflow(1, _http_request()))
+    metrics = wf.admission_controller.metrics()
+    assert metrics['running'] == 0 and metrics['pending'] == 0
+    assert api.active_runs == {}
+
+
+def test_cancel_a_queued_run(api):
+    async def main():
+        # the only slot is taken, the run is queued without a server
+        running = wf.admission_controller.request('other')
+        result = await api.launch_workflow(1, _http_request())
+        assert result['queued'] is True and result['host'] is None and result['port'] is None
+        run_id = result['run_id']
+
+        events = asyncio.create_task(_read_sse(await api.stream_workflow_run_status(1, run_id)))
+        await asyncio.sleep(0.05)
+        assert await api.stop_workflow_run(1, run_id) == {'run_id': run_id, 'port': None}
+        assert run_id not in api.active_runs and wf.admission_controller.metrics()['pending'] == 0
+        with pytest.raises(HTTPException) as e:
+            await api.stop_workflow_run(1, run_id)
+        assert e.value.status_code == 404
+        running.release()
+        return await asyncio.wait_for(events, timeout=5)
+
+    events = asyncio.run(main())
+    assert [e['status'] for e in events] == ['pending', 'terminated']
+
+
+def test_status_stream_of_a_finished_run(api):
+    workflow_run = _create_run('completed')
+
+    async def main():
+        events = await _read_sse(await api.stream_workflow_run_status(1, workflow_run.id))
+        with pytest.raises(HTTPException) as e:
+            await api.stream_workflow_run_status(1, workflow_run.id + 1)
+        assert e.value.status_code == 404
+        return events
+
+    events = asyncio.run(main())
+    # the current state only, the run is not active
+    assert [(e['run_id'], e['status']) for e in events] == [(workflow_run.id, 'completed')]
+
+
+class FakeWebSocket:
+
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000, reason=None):
+        self.closed = (code, reason)
+
+
+def test_run_websocket(api):
+    workflow_run = _create_run('running')
+
+    async def main():
+        api.active_runs[workflow_run.id] = api.ActiveRun()
+        websocket = FakeWebSocket()
+        watch = asyncio.create_task(api.watch_workflow_run(websocket, 1, workflow_run.id))
+        await asyncio.sleep(0.05)
+        workflow_run.status = 'terminated'
+        wf.event_bus.publish_run(workflow_run)
+        await asyncio.wait_for(watch, timeout=5)
+        api.active_runs.pop(workflow_run.id)
+
+        unknown = FakeWebSocket()
+        await api.watch_workflow_run(unknown, 1, workflow_run.id + 1)
+        return websocket, unknown
+
+    websocket, unknown = asyncio.run(main())
+    assert [e['status'] for e in websocket.sent] == ['running', 'terminated'] and websocket.closed[0] == 1000
+    assert unknown.sent == [] and unknown.closed[0] == 4404
@@ -1,14 +1,37 @@
 
-from .dao import Workflow, RuntimeEnv, EnvVars, Dir, get_workflow_manifest
-from .database import init_db, list_workflows, get_workflow_by_id, create_workflow
-from .controller import ComfyUIRunner
+from .dao import Workflow, Workspace, RuntimeEnv, EnvVars, Dir, ResourceRequirements, get_workflow_manifest
+from .database import (
+    init_db, list_workflows, get_workflow_by_id, create_workflow,
+    WorkflowRunRecord, WorkflowRunStatus, create_workflow_run, update_workflow_run, get_workflow_run_by_id,
+    configure_database, submit_workflow_run_update, status_writer, StatusWriter,
+    query_workflow_runs, WorkflowRunSummary, WorkflowRunPage, DatabaseConfig, migrate
+)
+from .controller import ComfyUIRunner, InputSet, BatchItemResult, run_workflow_batch
+from .pool import ComfyUIServerPool, PoolConfig
+from .async_runner import AsyncComfyUIRunner
+from .template import compile_workflow, CompiledWorkflow, OverrideTemplateError
+from .cache import workflow_cache, WorkflowCache, WorkflowNotFound
+from .events import event_bus, EventBus, RunEvent
+from .gpu import GpuAllocator, GpuDevice, GpuLease, FakeDeviceProvider, discover_devices
+from .admission import admission_controller, AdmissionController, AdmissionConfig, AdmissionRejected
+from .tracing import tracer, Tracer, Trace, Span, InMemoryExporter, PrometheusExporter, OpenTelemetryExporter, prometheus_exporter
 
 __all__ = [
-    ComfyUIRunner,
-    Workflow, RuntimeEnv, EnvVars, Dir,
+    ComfyUIRunner, AsyncComfyUIRunner, ComfyUIServerPool, PoolConfig,
+    InputSet, BatchItemResult, run_workflow_batch,
+    compile_workflow, CompiledWorkflow, OverrideTemplateError,
+    workflow_cache, WorkflowCache, WorkflowNotFound,
+    event_bus, EventBus, RunEvent,
+    GpuAllocator, GpuDevice, GpuLease, FakeDeviceProvider, discover_devices,
+    admission_controller, AdmissionController, AdmissionConfig, AdmissionRejected,
+    tracer, Tracer, Trace, Span, InMemoryExporter, PrometheusExporter, OpenTelemetryExporter, prometheus_exporter,
+    Workflow, Workspace, RuntimeEnv, EnvVars, Dir, ResourceRequirements,
 
     # database operations
     init_db, list_workflows, get_workflow_by_id, create_workflow,
+    WorkflowRunRecord, WorkflowRunStatus, create_workflow_run, update_workflow_run, get_workflow_run_by_id,
+    configure_database, submit_workflow_run_update, status_writer, StatusWriter,
+    query_workflow_runs, WorkflowRunSummary, WorkflowRunPage, DatabaseConfig, migrate,
 
     # FS operations 
     get_workflow_manifest
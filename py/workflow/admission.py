@@ -0,0 +1,303 @@
+""" Admission control of workflow runs
+Every run, from the API or the job scheduler, is admitted before its ComfyUI process is started:
+    - at most `max_running` runs on the node and `max_running_per_workflow` runs per workflow
+    - the limits are shared by the processes of the node (API, scheduler): a running run holds a
+      lock file (flock) of a node slot and of a workflow slot in `lock_dir`, the lock goes away with
+      the process if it dies. All processes must be configured with the same limits.
+    - runs that can not start wait in a bounded queue of the process, ordered by priority class then
+      arrival, a run of a workflow at its limit does not hold back runs of other workflows. Slots freed
+      by another process are picked up by polling, priorities are not ordered across processes.
+    - when the queue is full the request is rejected with a retry delay (HTTP 429 + Retry-After),
+      the scheduler stops pulling jobs and leaves them on the job queue
+Without `lock_dir` (or without flock, on Windows) the limits only apply within the process.
+Queue depth, admissions, rejections and queue wait time are exposed by metrics().
+
+    ticket = admission_controller.request(workflow_id, priority='batch') # AdmissionRejected if full
+    ticket.wait()
+    try:
+        run_workflow(...)
+    finally:
+        ticket.release()
+"""
+import asyncio
+import itertools
+import math
+import errno
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, Field
+from loguru import logger
+
+from .readiness import StartupHistogram
+
+try:
+    import fcntl
+except ImportError: # windows, limits within the process only
+    fcntl = None
+
+
+# priority classes, first is served first
+PRIORITY_CLASSES = ['interactive', 'batch', 'background']
+
+
+class AdmissionConfig(BaseModel):
+    max_running: int = Field(default=2, description='runs of the node, ComfyUI processes started at once')
+    max_running_per_workflow: int = Field(default=2, description='runs of a workflow')
+    workflow_limits: Dict[str, int] = Field(default={}, description='per workflow id overrides of max_running_per_workflow')
+    max_pending: int = Field(default=32, description='runs waiting to start, more are rejected')
+    default_run_sec: float = Field(default=60, description='run duration assumed before one has finished')
+    lock_dir: Optional[str] = Field(default=None, description='lock files of the node slots shared by the processes, None for limits within the process')
+
+    @classmethod
+    def from_env(cls) -> 'AdmissionConfig':
+        return cls(
+            max_running=int(os.environ.get('ADMISSION_MAX_RUNNING', 2)),
+            max_running_per_workflow=int(os.environ.get('ADMISSION_MAX_RUNNING_PER_WORKFLOW', 2)),
+            max_pending=int(os.environ.get('ADMISSION_MAX_PENDING', 32)),
+            lock_dir=os.environ.get('ADMISSION_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'comfyui_admission')),
+        )
+
+
+class NodeSlots:
+    """ Slots shared by the processes of the node, a slot is held with a lock file """
+
+    def __init__(self, lock_dir: str):
+        self.lock_dir = lock_dir
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def acquire(self, name: str, count: int) -> Optional[int]:
+        """ Lock a free slot of `name` out of `count`, the lock fd, None if all are held """
+        for index in range(count):
+            fd = os.open(os.path.join(self.lock_dir, f'{name}.{index}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError as e:
+                os.close(fd)
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+        return None
+
+    @staticmethod
+    def release(fd: int):
+        os.close(fd) # drops the flock
+
+
+class AdmissionRejected(Exception):
+    """ The pending queue is full, or the run waited too long """
+
+    def __init__(self, message: str, retry_after_sec: int):
+        super().__init__(message)
+        self.retry_after_sec = retry_after_sec
+
+
+class Ticket:
+    """ Admission of one run, granted when the run may start, released when it is done """
+
+    def __init__(self, controller: 'AdmissionController', workflow_id: str, priority: str, seq: int):
+        self.controller = controller
+        self.workflow_id = workflow_id
+        self.priority = priority
+        self.seq = seq
+        self.requested_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+        self.done = False
+        self._node_locks: List[int] = [] # node and workflow slots held by the run
+        self._granted = threading.Event()
+        self._futures: List[asyncio.Future] = []
+
+    @property
+    def granted(self) -> bool:
+        return self._granted.is_set()
+
+    def _grant(self):
+        # called with the controller lock held
+        self.granted_at = time.monotonic()
+        self._granted.set()
+        for future in self._futures:
+            future.get_loop().call_soon_threadsafe(lambda f=future: f.done() or f.set_result(True))
+        self._futures.clear()
+
+    def wait(self, timeout: Optional[float] = None):
+        """ Block until the run may start, AdmissionRejected after `timeout` (the ticket is cancelled) """
+        if not self._granted.wait(timeout) and self.controller._cancel(self):
+            raise AdmissionRejected(f"Run of workflow {self.workflow_id} not admitted after {timeout}s",
+                                    self.controller.retry_after_sec())
+
+    async def wait_async(self):
+        """ Wait on the event loop, the ticket is cancelled if the waiting task is cancelled """
+        with self.controller._lock:
+            if self.granted:
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._futures.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self.release()
+            raise
+
+    def release(self):
+        """ Run done (or cancelled while pending), let the next runs start """
+        self.controller._release(self)
+
+
+class AdmissionController:
+
+    NODE_POLL_INTERVAL_SEC = 0.5 # retry of pending runs, slots freed by other processes are not notified
+
+    def __init__(self, config: Optional[AdmissionConfig] = None):
+        self.config = config if config is not None else AdmissionConfig()
+        self._node: Optional[NodeSlots] = None
+        if self.config.lock_dir is not None:
+            if fcntl is not None:
+                self._node = NodeSlots(self.config.lock_dir)
+            else:
+                logger.warning('No flock on this platform, admission limits only apply within the process')
+        self._poller: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._pending: List[Ticket] = []
+        self._running: Dict[str, int] = {} # {workflow id -> running runs}
+        self._running_total = 0
+        self._run_sec_avg: Optional[float] = None # moving average of run durations
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_sec = StartupHistogram([0.1, 0.5, 1, 5, 10, 30, 60, 300, 900])
+
+    def _workflow_limit(self, workflow_id: str) -> int:
+        return self.config.workflow_limits.get(workflow_id, self.config.max_running_per_workflow)
+
+    def _fits(self, ticket: Ticket) -> bool:
+        return (self._running_total < self.config.max_running
+                and self._running.get(ticket.workflow_id, 0) < self._workflow_limit(ticket.workflow_id))
+
+    def _acquire_node_slots(self, ticket: Ticket) -> bool:
+        if self._node is None:
+            return True
+        run_lock = self._node.acquire('run', self.config.max_running)
+        if run_lock is None:
+            return False
+        workflow_lock = self._node.acquire(f'workflow-{ticket.workflow_id}', self._workflow_limit(ticket.workflow_id))
+        if workflow_lock is None:
+            NodeSlots.release(run_lock)
+            return False
+        ticket._node_locks = [run_lock, workflow_lock]
+        return True
+
+    def _try_start(self, ticket: Ticket) -> bool:
+        # limits of the process first, then the node slots shared with other processes
+        if not self._fits(ticket) or not self._acquire_node_slots(ticket):
+            return False
+        self._running_total += 1
+        self._running[ticket.workflow_id] = self._running.get(ticket.workflow_id, 0) + 1
+        self.admitted += 1
+        ticket._grant()
+        self.wait_sec.observe(ticket.granted_at - ticket.requested_at)
+        return True
+
+    def _grant_pending_locked(self):
+        for ticket in list(self._pending):
+            if self._running_total >= self.config.max_running:
+                return
+            if self._try_start(ticket):
+                self._pending.remove(ticket)
+
+    def retry_after_sec(self) -> int:
+        """ Time for the queue ahead to drain, from the average run duration """
+        run_sec = self._run_sec_avg if self._run_sec_avg is not None else self.config.default_run_sec
+        return max(1, math.ceil(run_sec * (len(self._pending) + 1) / self.config.max_running))
+
+    def request(self, workflow_id, priority: str = 'interactive', queue: bool = True) -> Optional[Ticket]:
+        """ Admit a run now or queue it, AdmissionRejected when the queue is full
+        With queue=False the run is not queued: None if it can not start now.
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority {priority}, one of {PRIORITY_CLASSES}")
+        with self._lock:
+            ticket = Ticket(self, str(workflow_id), priority, next(self._seq))
+            # runs queued ahead with the same or higher priority go first
+            ahead = any(PRIORITY_CLASSES.index(t.priority) <= PRIORITY_CLASSES.index(priority) and self._fits(t)
+                        for t in self._pending)
+            if not ahead and self._try_start(ticket):
+                return ticket
+            if not queue:
+                return None
+            if len(self._pending) >= self.config.max_pending:
+                self.rejected += 1
+                raise AdmissionRejected(f"{len(self._pending)} runs pending, try again later", self.retry_after_sec())
+            self._pending.append(ticket)
+            self._pending.sort(key=lambda t: (PRIORITY_CLASSES.index(t.priority), t.seq))
+            self._start_poller()
+            return ticket
+
+    def _start_poller(self):
+        # called with the lock held
+        if self._node is None or (self._poller is not None and self._poller.is_alive()):
+            return
+        self._poller = threading.Thread(target=self._poll_node, daemon=True)
+        self._poller.start()
+
+    def _poll_node(self):
+        """ Retry pending runs while there are some, slots may be freed by other processes """
+        while True:
+            time.sleep(AdmissionController.NODE_POLL_INTERVAL_SEC)
+            with self._lock:
+                self._grant_pending_locked()
+                if not self._pending:
+                    self._poller = None
+                    return
+
+    def _cancel(self, ticket: Ticket) -> bool:
+        # drop a pending ticket, False if it was granted in the meantime
+        with self._lock:
+            if ticket.granted:
+                return False
+            ticket.done = True
+            if ticket in self._pending:
+                self._pending.remove(ticket)
+            return True
+
+    def _release(self, ticket: Ticket):
+        with self._lock:
+            if ticket.done:
+                return
+            ticket.done = True
+            if ticket in self._pending:
+                self._pending.remove(ticket)
+                return
+            if not ticket.granted:
+                return
+            for fd in ticket._node_locks:
+                NodeSlots.release(fd)
+            ticket._node_locks = []
+            self._running_total -= 1
+            self._running[ticket.workflow_id] -= 1
+            if not self._running[ticket.workflow_id]:
+                del self._running[ticket.workflow_id]
+            run_sec = time.monotonic() - ticket.granted_at
+            self._run_sec_avg = run_sec if self._run_sec_avg is None else 0.8 * self._run_sec_avg + 0.2 * run_sec
+            self._grant_pending_locked()
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'running': self._running_total,
+                'running_per_workflow': dict(self._running),
+                'pending': len(self._pending),
+                'pending_per_priority': {p: sum(1 for t in self._pending if t.priority == p) for p in PRIORITY_CLASSES},
+                'oldest_pending_sec': max((now - t.requested_at for t in self._pending), default=0),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'wait_sec': self.wait_sec.snapshot(),
+                'node_wide': self._node is not None,
+            }
+
+
+# runs of the process, limits are shared with the other processes of the node through ADMISSION_LOCK_DIR
+admission_controller = AdmissionController(AdmissionConfig.from_env())
@@ -0,0 +1,175 @@
+""" Asyncio native ComfyUI runner
+Same workflow run life cycle as ComfyUIRunner (setup -> run -> teardown), but the ComfyUI server is
+launched with asyncio subprocesses and all server calls go through aiohttp, so one event loop
+(e.g. the FastAPI app) can supervise many workflow runs concurrently without blocking.
+"""
+import asyncio
+import os
+from typing import Callable, Dict, Optional
+
+import aiohttp
+from loguru import logger
+
+from .dao import Workflow, Workspace
+from .database import WorkflowRunRecord
+from .controller import ComfyUIRunner
+from .readiness import ReadinessProbe, ServerStartupError, startup_metrics
+from .server import ComfyUIServer
+from .tracing import Trace
+from .tracker import PromptCompletionTracker
+
+
+class AsyncComfyService:
+    """ aiohttp client of a ComfyUI server """
+
+    REQUEST_TIMEOUT_SEC = 10
+
+    def __init__(self, host: str, port: str, session: aiohttp.ClientSession):
+        self.host = host
+        self.port = port
+        self.session = session
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def is_server_ready(self, timeout: Optional[float] = None) -> bool:
+        try:
+            async with self.session.get(f"{self.base_url}/queue", timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # expected while the server is starting
+            logger.debug(f"Server not reachable: {e}")
+            return False
+
+    async def post_prompt(self, prompt: Dict, client_id: str) -> Dict:
+        async with self.session.post(f"{self.base_url}/prompt", json={"prompt": prompt, "client_id": client_id},
+                                     timeout=aiohttp.ClientTimeout(total=AsyncComfyService.REQUEST_TIMEOUT_SEC)) as response:
+            return await response.json()
+
+    async def get_history(self, prompt_id: str) -> Dict:
+        async with self.session.get(f"{self.base_url}/history/{prompt_id}",
+                                    timeout=aiohttp.ClientTimeout(total=AsyncComfyService.REQUEST_TIMEOUT_SEC)) as response:
+            return await response.json()
+
+    async def connect_events(self, client_id: str) -> Optional[aiohttp.ClientWebSocketResponse]:
+        """ Open the /ws event stream, None if not available (polling is used) """
+        try:
+            return await self.session.ws_connect(f"ws://{self.host}:{self.port}/ws?clientId={client_id}")
+        except Exception as e:
+            logger.warning(f"Error connecting to ComfyUI websocket: {e}, falling back to polling")
+            return None
+
+
+class AsyncComfyUIRunner(ComfyUIRunner):
+    """ Run a ComfyUI workflow in an asyncio subprocess, setup/run/teardown are coroutines
+
+    runner = AsyncComfyUIRunner(workspace, workflow, workflow_run, callback=submit_workflow_run_update)
+    task = asyncio.create_task(runner.execute()) # setup, run and teardown
+    """
+
+    def __init__(self, workspace: Workspace, workflow: Workflow, workflow_run: WorkflowRunRecord,
+                 callback: Optional[Callable[[WorkflowRunRecord], None]] = None,
+                 env: Optional[Dict[str, str]] = None, trace: Optional[Trace] = None):
+        # dedicated server, the server pool is thread based
+        super().__init__(workspace, workflow, workflow_run, callback=callback, pool=None, env=env, trace=trace)
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.async_service: Optional[AsyncComfyService] = None
+        self.process: Optional[asyncio.subprocess.Process] = None
+
+    async def _launch(self, server: ComfyUIServer):
+        python_path = self.workflow.python_venv.virtualenv_python_path
+        os.makedirs(server.home_dir, exist_ok=True)
+        server.unhold_port()
+        with open(server.log_file, "w") as f:
+            # the child keeps its own copy of the log file descriptor
+            return await asyncio.create_subprocess_exec(
+                python_path, '-m', 'main', *server.server_args(),
+                env=server.server_env(),
+                cwd=server.home_dir,
+                stdout=f,
+                stderr=f,
+            )
+
+    async def setup(self):
+        """ Setup runtime directory and the ComfyUI server and wait for it to be ready """
+        with self.trace.span('prepare_runtime_dir'):
+            await asyncio.to_thread(self._prepare_runtime_dir)
+        self.session = aiohttp.ClientSession()
+        self.async_service = AsyncComfyService(self.host, self.port, self.session)
+        try:
+            with self.trace.span('server_start', pooled=False):
+                self.process = await self._launch(self.server)
+                startup_sec = await ReadinessProbe(self.async_service, self.process, ComfyUIServer.STARTUP_TIMEOUT_SEC,
+                                                   log_file=self.server.log_file).wait_async()
+            startup_metrics.observe(self.workflow.name, startup_sec)
+        except Exception as e:
+            if isinstance(e, ServerStartupError):
+                startup_metrics.observe_failure(self.workflow.name)
+            logger.error(f"Error starting ComfyUI server: {e}")
+            self._update_status("failed")
+            raise
+
+        self._update_status("ready")
+
+    async def run(self):
+        try:
+            workflow_config = await asyncio.to_thread(self._load_workflow_config)
+            if workflow_config is None:
+                return
+
+            # subscribe to execution events before submitting, so no event is missed
+            ws = await self.async_service.connect_events(self.run_id)
+            try:
+                with self.trace.span('submit'):
+                    prompt_response = self._check_prompt_response(
+                        await self.async_service.post_prompt(workflow_config, self.run_id))
+                if prompt_response is None:
+                    return
+
+                self._update_status("running")
+
+                prompt_id = prompt_response.prompt_id
+                logger.info(f"Prompt ID: {prompt_id}, workflow run dir: {self.work_dir}")
+                with self.trace.span('execute'):
+                    tracker = PromptCompletionTracker(self.async_service, self.run_id, on_event=self._on_prompt_event)
+                    get_history_response = await tracker.wait_all_async([prompt_id], ws=ws)
+            finally:
+                if ws is not None:
+                    await ws.close()
+
+            await asyncio.to_thread(self._complete, prompt_id, get_history_response)
+        except Exception as e:
+            logger.error(f"Error running workflow: {e}, please check logs in {self.work_dir}")
+            self._update_status("failed")
+            raise e
+
+    async def teardown(self):
+        try:
+            if self.process is not None and self.process.returncode is None:
+                with self.trace.span('teardown'):
+                    self.process.terminate()
+                    try:
+                        await asyncio.wait_for(self.process.wait(), timeout=ComfyUIServer.SHUTDOWN_TIMEOUT_SEC)
+                    except asyncio.TimeoutError:
+                        # process has not exit yet, force kill it
+                        self.process.kill()
+                        await self.process.wait()
+                logger.info(f"Process terminated with return code: {self.process.returncode}")
+        except ProcessLookupError:
+            pass
+        finally:
+            self.server.release_port()
+            if self.session is not None:
+                await self.session.close()
+            self._finish_trace()
+            self._update_status("terminated")
+
+    async def execute(self):
+        """ Setup, run and teardown the workflow run """
+        try:
+            await self.setup()
+            await self.run()
+        finally:
+            # also on cancellation, the ComfyUI server must not outlive the run
+            await asyncio.shield(self.teardown())
@@ -0,0 +1,133 @@
+""" Process wide cache of workflow records and manifests
+Resolving a workflow (DB lookup + manifest.json parsing and validation) is done on every job.
+Resolved workflows are kept in a bounded LRU, keyed by workflow id, and revalidated at most every
+`revalidate_interval_sec`: the manifest by its file mtime and the record by its DB updated_at.
+Between revalidations resolving a hot workflow is a dictionary lookup.
+Cached records and manifests are shared by all callers and must be treated as read-only.
+"""
+import collections
+import os
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+from loguru import logger
+
+from .dao import Workflow, get_workflow_manifest
+from .database import WorkflowRecord, get_workflow_by_id, get_workflow_version
+
+
+class WorkflowNotFound(KeyError):
+    """ No workflow record with this id """
+
+
+class CachedWorkflow:
+    """ A workflow record, its manifest and the versions they were loaded at """
+
+    def __init__(self, record: WorkflowRecord, manifest: Workflow, manifest_mtime: Optional[int]):
+        self.record = record
+        self.manifest = manifest
+        self.manifest_mtime = manifest_mtime
+        self.checked_at = time.monotonic()
+
+    @property
+    def version(self) -> Tuple:
+        return (self.record.workflow_dir, self.record.updated_at)
+
+
+class WorkflowCache:
+    """ Bounded LRU of resolved workflows
+
+    cached = workflow_cache.get(workflow_id)
+    cached.record, cached.manifest
+    """
+
+    MAX_SIZE = 64
+    REVALIDATE_INTERVAL_SEC = 5
+
+    def __init__(self, max_size: Optional[int] = None, revalidate_interval_sec: Optional[float] = None,
+                 load_record: Callable[[int], Optional[WorkflowRecord]] = get_workflow_by_id,
+                 load_version: Callable[[int], Optional[Tuple]] = get_workflow_version,
+                 load_manifest: Callable[[str], Workflow] = get_workflow_manifest):
+        self.max_size = max_size if max_size is not None else WorkflowCache.MAX_SIZE
+        self.revalidate_interval_sec = (revalidate_interval_sec if revalidate_interval_sec is not None
+                                        else WorkflowCache.REVALIDATE_INTERVAL_SEC)
+        self.load_record = load_record
+        self.load_version = load_version
+        self.load_manifest = load_manifest
+
+        self._lock = threading.Lock()
+        self._entries: 'collections.OrderedDict[int, CachedWorkflow]' = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _manifest_mtime(workflow_dir: str) -> Optional[int]:
+        try:
+            return os.stat(f'{workflow_dir}/manifest.json').st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _is_fresh(self, workflow_id: int, entry: CachedWorkflow) -> bool:
+        version = self.load_version(workflow_id)
+        if version is None or tuple(version) != entry.version:
+            return False
+        return self._manifest_mtime(entry.record.workflow_dir) == entry.manifest_mtime
+
+    def _load(self, workflow_id: int) -> CachedWorkflow:
+        record = self.load_record(workflow_id)
+        if record is None:
+            raise WorkflowNotFound(workflow_id)
+        mtime = self._manifest_mtime(record.workflow_dir)
+        return CachedWorkflow(record, self.load_manifest(record.workflow_dir), mtime)
+
+    def get(self, workflow_id: int) -> CachedWorkflow:
+        """ Resolved workflow, raise WorkflowNotFound if there is no such workflow """
+        workflow_id = int(workflow_id)
+        with self._lock:
+            entry = self._entries.get(workflow_id, None)
+            if entry is not None:
+                self._entries.move_to_end(workflow_id)
+                if time.monotonic() - entry.checked_at < self.revalidate_interval_sec:
+                    self.hits += 1
+                    return entry
+
+        # revalidate or load outside of the lock, DB and file system access may be slow
+        if entry is not None and self._is_fresh(workflow_id, entry):
+            entry.checked_at = time.monotonic()
+            with self._lock:
+                self.hits += 1
+            return entry
+
+        logger.info(f"Loading workflow {workflow_id} into the workflow cache")
+        entry = self._load(workflow_id)
+        with self._lock:
+            self.misses += 1
+            self._entries[workflow_id] = entry
+            self._entries.move_to_end(workflow_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def get_record(self, workflow_id: int) -> Optional[WorkflowRecord]:
+        """ Workflow record, None if there is no such workflow """
+        try:
+            return self.get(workflow_id).record
+        except WorkflowNotFound:
+            return None
+
+    def get_manifest(self, workflow: WorkflowRecord) -> Workflow:
+        """ Manifest of a workflow record """
+        return self.get(workflow.id).manifest
+
+    def invalidate(self, workflow_id: Optional[int] = None):
+        """ Drop a workflow, or all workflows, from the cache """
+        with self._lock:
+            if workflow_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(workflow_id), None)
+
+
+# process wide workflow cache, shared by the scheduler, the controller and the API
+workflow_cache = WorkflowCache()
@@ -0,0 +1,140 @@
+""" HTTP client of a ComfyUI server
+One keep-alive connection pool per server, consistent timeouts and retry policy,
+and latency counters per endpoint.
+"""
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from loguru import logger
+
+
+class EndpointStats:
+    """ Latency counters of an endpoint """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+
+    def observe(self, seconds: float, error: bool):
+        self.count += 1
+        self.errors += 1 if error else 0
+        self.total_sec += seconds
+        self.max_sec = max(self.max_sec, seconds)
+
+    def snapshot(self) -> Dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_sec': self.total_sec,
+            'avg_sec': self.total_sec / self.count if self.count else 0.0,
+            'max_sec': self.max_sec,
+        }
+
+
+class ComfyService:
+    """ Client of a ComfyUI server, all server calls of the runner go through it
+
+    Idempotent GETs are retried on read errors and 502/503/504, connection errors are not retried.
+    POSTs (e.g. /prompt) are never retried. Readiness probes go through a session without retries,
+    a probe takes at most its timeout, the probe loop does the retrying.
+    """
+
+    CONNECT_TIMEOUT_SEC = 3
+    READ_TIMEOUT_SEC = 30
+    MAX_RETRIES = 3
+    RETRY_BACKOFF_SEC = 0.2
+    POOL_MAXSIZE = 4 # runner, tracker and readiness probe may call concurrently
+
+    def __init__(self, host: str, port: str):
+        self.host = host
+        self.port = port
+        self.base_url = f"http://{host}:{port}"
+
+        retry = Retry(
+            total=ComfyService.MAX_RETRIES,
+            connect=0,
+            backoff_factor=ComfyService.RETRY_BACKOFF_SEC,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False)
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(
+            pool_connections=1, pool_maxsize=ComfyService.POOL_MAXSIZE, max_retries=retry))
+        self._probe_session = requests.Session()
+        self._probe_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, EndpointStats] = {}
+
+    def _request(self, method: str, endpoint: str, path: str, timeout: Optional[float] = None,
+                 session: Optional[requests.Session] = None, **kwargs) -> requests.Response:
+        """ Send a request, record its latency under `endpoint` """
+        session = session if session is not None else self.session
+        if timeout is None:
+            timeout = (ComfyService.CONNECT_TIMEOUT_SEC, ComfyService.READ_TIMEOUT_SEC)
+        started = time.perf_counter()
+        error = True
+        try:
+            response = session.request(method, f"{self.base_url}{path}", timeout=timeout, **kwargs)
+            error = response.status_code >= 400
+            return response
+        finally:
+            with self._stats_lock:
+                self._stats.setdefault(endpoint, EndpointStats()).observe(time.perf_counter() - started, error)
+
+    def is_server_ready(self, timeout: Optional[float] = None) -> bool:
+        try:
+            # check server status is 200
+            response = self._request('GET', 'queue', '/queue', timeout=timeout, session=self._probe_session)
+            return response.status_code == 200
+        except requests.ConnectionError as e:
+            # expected while the server is starting
+            logger.debug(f"Server not reachable: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"Error checking server status: {e}")
+            return False
+
+    def submit_prompt(self, prompt: Dict, client_id: Optional[str] = None) -> Dict:
+        """ Queue a prompt, the response has prompt_id, number and node_errors, or error """
+        payload = {"prompt": prompt}
+        if client_id is not None:
+            payload["client_id"] = client_id
+        return self._request('POST', 'prompt', '/prompt', json=payload).json()
+
+    def get_history(self, prompt_id: str) -> Dict:
+        """ Prompt history, empty dict until the prompt is done """
+        return self._request('GET', 'history', f'/history/{prompt_id}').json()
+
+    def get_queue(self) -> Dict:
+        """ Running and pending prompts """
+        return self._request('GET', 'queue', '/queue').json()
+
+    def get_object_info(self, node_class: Optional[str] = None) -> Dict:
+        """ Node definitions, of all nodes or of one node class """
+        path = '/object_info' if node_class is None else f'/object_info/{node_class}'
+        return self._request('GET', 'object_info', path).json()
+
+    def interrupt(self):
+        """ Interrupt the running prompt """
+        self._request('POST', 'interrupt', '/interrupt').raise_for_status()
+
+    def free(self, unload_models: bool = False, free_memory: bool = False):
+        """ Unload models and/or free cached memory """
+        self._request('POST', 'free', '/free', json={
+            'unload_models': unload_models, 'free_memory': free_memory}).raise_for_status()
+
+    def stats(self) -> Dict[str, Dict]:
+        """ Latency counters per endpoint """
+        with self._stats_lock:
+            return {endpoint: s.snapshot() for endpoint, s in self._stats.items()}
+
+    def close(self):
+        self.session.close()
+        self._probe_session.close()
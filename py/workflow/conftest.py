@@ -0,0 +1,16 @@
+import pytest
+
+from . import database
+from .database import DatabaseConfig, configure_database, init_db
+
+
+@pytest.fixture(params=['memory', 'file'])
+def db(request, tmp_path):
+    """ The database operations run against an empty in-memory and an empty file SQLite database """
+    if request.param == 'memory':
+        config = DatabaseConfig(url='sqlite://')
+    else:
+        config = DatabaseConfig.sqlite_file(str(tmp_path / 'workflow.db'))
+    init_db(config=config)
+    yield database.engine
+    configure_database(DatabaseConfig.from_env())
@@ -10,12 +10,10 @@ import time
 import json
 from datetime import datetime
 import subprocess
-import random
 import atexit
 import signal
 import json
 import shutil
-import collections
 
 from abc import ABC, abstractmethod
 from typing import Dict, List, Optional, Tuple, Callable
@@ -26,36 +24,50 @@ from workflow.database import WorkflowRunRecord
 from workflow.utils import logger, force_create_symlink
 
 import requests
-from queue import Queue
 
 from .dao import Workspace, get_workflow_manifest
 from loguru import logger
 from .database import *
+from .client import ComfyService
+from .server import ComfyUIServer, subprocesses, cleanup
+from .pool import ComfyUIServerPool
+from .tracker import PromptCompletionTracker, PromptEvent
+from .template import compile_workflow
+from .cache import workflow_cache
+from .staging import stage_files, StagingReport
+from .outputs import OutputFile, build_output_manifest
+from .events import event_bus
+from .tracing import tracer, Trace
+
+
+
+def _prefix_outputs(workflow_config: Dict, subfolder: str) -> Dict:
+    """ Route outputs of output nodes (SaveImage, VHS_VideoCombine, ...) into a subfolder of the output dir
+    The graph and its nodes may be shared with the compiled workflow, a prefixed copy is returned.
+    """
+    prefixed = dict(workflow_config)
+    for node_id, node in workflow_config.items():
+        inputs = node.get('inputs', {}) if isinstance(node, dict) else {}
+        if isinstance(inputs.get('filename_prefix', None), str):
+            prefixed[node_id] = {
+                **node, 'inputs': {**inputs, 'filename_prefix': f"{subfolder}/{inputs['filename_prefix']}"}}
+    return prefixed
 
-# a global registry of all subprocesses
-subprocesses = Queue()
-
-def cleanup():
-    for i in range(subprocesses.qsize()):
-        process = subprocesses.get()
-        if process.poll() is None:  # Check if the process is still running
-            process.terminate()
-            try:
-                process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                process.kill()
-
-def handle_signal(signum, frame):
-    cleanup()
-    sys.exit(0)
 
-# Register the cleanup function to be called on exit
-atexit.register(cleanup)
+class InputSet(BaseModel):
+    """ Inputs of one item of a batch run """
+    input_files: List[str] = []
+    input_override: Dict[str, Dict] = {}
 
-# Register signal handlers
-signal.signal(signal.SIGTERM, handle_signal)
-signal.signal(signal.SIGINT, handle_signal)
 
+class BatchItemResult(BaseModel):
+    """ Result of one prompt of a batch run """
+    index: int
+    prompt_id: Optional[str] = None
+    status: str
+    output_dir: str
+    error: Optional[str] = None
+    outputs: List[OutputFile] = []
 
 
 class Runner(ABC):
@@ -74,31 +86,19 @@ class Runner(ABC):
         pass
 
 
-class ComfyService:
-
-    def __init__(self, host: str, port: str):
-        self.host = host
-        self.port = port
-
-    def is_server_ready(self) -> bool:
-        try:
-            url = f"http://{self.host}:{self.port}/queue"
-            # check server status is 200
-            response = requests.get(url)
-            return response.status_code == 200
-        except Exception as e:
-            logger.error(f"Error checking server status: {e}")
-            return False
-    
-
 class ComfyUIRunner(Runner):
     """ Run a ComfyUI workflow in a subprocess
     Reference: https://github.com/Comfy-Org/comfy-cli/blob/main/comfy_cli/command/launch.py
     TODO: manage server lifecycle using a state machine 
     TODO: allocate GPU resources, shared cross multiple workflow runs
+
+    With a server pool, the run leases a warm ComfyUI server instead of launching its own.
+    Batch run (input_override_json is a list): every input override is submitted as a separate prompt
+    on the same server, so models are loaded once per batch; item outputs go to `output/item_{index}`.
     """
 
-    PROC_SHUTDOWN_TIMEOUT_SEC = 5
+    PROC_SHUTDOWN_TIMEOUT_SEC = ComfyUIServer.SHUTDOWN_TIMEOUT_SEC
+    PROGRESS_UPDATE_INTERVAL_SEC = 1 # throttle progress status updates
 
     class PromptResponse(BaseModel):
         prompt_id: str
@@ -107,10 +107,22 @@ class ComfyUIRunner(Runner):
 
 
     def __init__(self, workspace: Workspace, workflow: Workflow, workflow_run: WorkflowRunRecord,
-                 callback: Optional[Callable[[WorkflowRunRecord], None]] = None):
+                 callback: Optional[Callable[[WorkflowRunRecord], None]] = None,
+                 pool: Optional[ComfyUIServerPool] = None,
+                 env: Optional[Dict[str, str]] = None,
+                 move_inputs: bool = False,
+                 trace: Optional[Trace] = None):
         self.workspace = workspace
         self.workflow = workflow
         self.callback = callback # callback for status update
+        self.pool = pool # shared ComfyUI servers, None to launch a dedicated server
+        self.env = env # extra env vars of the ComfyUI server, e.g. CUDA_VISIBLE_DEVICES
+        self.move_inputs = move_inputs # input files are owned by the run, move instead of link/copy
+        self.staging_report: Optional[StagingReport] = None
+        # phase spans of the run, part of the trace of the job if given
+        self.trace = trace if trace is not None else tracer.start_trace(workflow=workflow.name)
+        self._owns_trace = trace is None
+        self.trace.attributes['run_id'] = workflow_run.id
         
         self.run_id = str(uuid.uuid4())
         
@@ -122,74 +134,68 @@ class ComfyUIRunner(Runner):
         self.output_dir = self.workflow_run.output_dir
         self.temp_dir = self.workflow_run.temp_dir
         self.input_override = json.loads(self.workflow_run.input_override_json) if self.workflow_run.input_override_json else None
+        self.input_overrides = None # input overrides of a batch run
+        if isinstance(self.input_override, list):
+            self.input_overrides, self.input_override = self.input_override, None
 
 
         # run ComfyUI main process
-        self.host = '0.0.0.0'
-        self.port = str(random.randint(8189, 49151)) # random port
-        self.comfyui_service = ComfyService(self.host, self.port)
+        # a dedicated server lives in the run dir, a pooled server is leased in setup()
+        self.server = None
+        self.host = None
+        self.port = None
+        self.comfyui_service = None
+        if self.pool is None:
+            self._attach_server(ComfyUIServer(
+                self.workflow, home_dir=self.work_dir, log_file=self.workflow_run.log_file, env=self.env))
 
 
+        # node level progress of the running prompt
+        self.progress = {}
+        self._progress_updated_at = 0
+
         # TODO: update workflow_run in database
         self._update_status("pending")
 
 
-    def _update_status(self, status: str):
+    def _update_status(self, status: str, event_type: str = 'status'):
         self.workflow_run.status = status
         self.workflow_run.updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.callback(self.workflow_run)
-
-
-    def _launch_comfyui(self, extra_args):
-        """ Launch ComfyUI server in a subprocess, using conda venv and python module
-        """
-
-        # venv
-        python_path = self.workflow.python_venv.virtualenv_python_path
-
-        # TODO: pass CUDA_VISIBLE_DEVICES from input
-        python_env = {
-            "PYTHONENCODING": "utf-8", # is this required?
-            'PYTHONPATH': self.workflow.main_module_dir, # points to ComfyUI, so that main module can be found
-            'CUDA_VISIBLE_DEVICES': '0'
-        }
+        # subscribers are notified first, the callback persists the run
+        event_bus.publish_run(self.workflow_run, type=event_type)
+        if self.callback is not None:
+            self.callback(self.workflow_run)
+
+    def _attach_server(self, server: ComfyUIServer):
+        self.server = server
+        self.host = server.host
+        self.port = server.port
+        self.comfyui_service = server.service
+        self.workflow_run.host = server.host
+        self.workflow_run.port = int(server.port)
+
+    def _on_prompt_event(self, event: PromptEvent):
+        """ Report node level progress through the status callback """
+        if event.type == 'execution_cached':
+            self.progress.setdefault('cached', []).extend(event.data.get('nodes', []))
+        elif event.type == 'executing' and event.node is not None:
+            self.progress.update({'prompt_id': event.prompt_id, 'node': event.node, 'value': None, 'max': None})
+        elif event.type == 'progress':
+            self.progress.update({'prompt_id': event.prompt_id, 'node': event.node, 'value': event.value, 'max': event.max})
+        elif event.type == 'executed':
+            self.progress.setdefault('executed', []).append(event.node)
+        elif event.type in ('execution_error', 'execution_interrupted'):
+            self.progress['error'] = event.data
+        else:
+            return
+
+        now = time.monotonic()
+        if event.type == 'progress' and now - self._progress_updated_at < ComfyUIRunner.PROGRESS_UPDATE_INTERVAL_SEC:
+            return
+        self._progress_updated_at = now
+        self.workflow_run.progress_json = json.dumps(self.progress)
+        self._update_status("running", event_type='progress')
 
-        extra_args = extra_args if extra_args is not None else []
-        
-        
-        command = f'{python_path} -m main ' + ' '.join(extra_args)
-        process = None
-
-        try:
-            with open(self.workflow_run.log_file, "w") as f:
-                if sys.platform == "win32":
-                    process = subprocess.Popen(
-                        command.split(),
-                        stdout=f,
-                        stderr=f,
-                        text=True,
-                        env=python_env,
-                        cwd=self.work_dir,
-                        encoding="utf-8",
-                        shell=True,  # win32 only
-                        creationflags=subprocess.CREATE_NEW_PROCESS_GROUP,  # win32 only
-                    )
-                else:
-                    print(f"Running: {command}")
-                    process = subprocess.Popen(
-                        command.split(),
-                        text=True,
-                        env=python_env,
-                        encoding="utf-8",
-                        cwd=self.work_dir,
-                        stdout=f,
-                        stderr=f,
-                    )
-                subprocesses.put(process)
-                return process
-        except KeyboardInterrupt:
-            if process is not None:
-                os._exit(1)
 
     # prepare workflow run dir
     def _prepare_runtime_dir(self):
@@ -198,16 +204,14 @@ class ComfyUIRunner(Runner):
         os.makedirs(self.output_dir, exist_ok=True)
         os.makedirs(self.temp_dir, exist_ok=True)
 
-        # copy workflow run input files to input dir
+        # stage workflow run input files to input dir, data is copied only across devices
         if self.workflow_run.input_files_json:
             input_files = json.loads(self.workflow_run.input_files_json)
-            for file_path in input_files:
-                # name = os.path.basename(file_path)
-                # target_path = os.path.join(self.input_dir, name)
-                # source = os.path.join(self.workspace.user_space_path, file_path)
-
-                # copy file to input dir
-                shutil.copy(file_path, self.input_dir)
+            with self.trace.span('stage_inputs') as span:
+                self.staging_report = stage_files(input_files, self.input_dir, move=self.move_inputs)
+                span.set('bytes', self.staging_report.bytes_staged)
+                span.set('bytes_copied', self.staging_report.bytes_copied)
+            self.workflow_run.input_bytes_copied = self.staging_report.bytes_copied
 
         # merge in input files from workflow input dir
         input_files = os.listdir(self.workflow.input_dir)
@@ -222,138 +226,172 @@ class ComfyUIRunner(Runner):
 
     def setup(self):
         """ Setup runtime directory and the ComfyUI server and wait for it to be ready """
-        self._prepare_runtime_dir()
+        with self.trace.span('prepare_runtime_dir'):
+            self._prepare_runtime_dir()
 
-        # FIXME: create a process cache, allow reused of processes. 
         # FIXME: manage server lifecycle using a state machine
+        try:
+            # launch and readiness, or lease of a warm server
+            with self.trace.span('server_start', pooled=self.pool is not None):
+                if self.pool is not None:
+                    self._attach_server(self.pool.lease(self.workflow, self.workflow_run, env=self.env))
+                else:
+                    self.server.start()
+                    self.server.wait_until_ready()
+        except Exception as e:
+            logger.error(f"Error starting ComfyUI server: {e}")
+            self._update_status("failed")
+            raise
 
-        # ComfyUI args
-        # extra model paths config
-        # 1) model path
-        # 2) extra custom model path
-        # 3) workflow/run input path
-        # 4) run output path
-        args = [
-            '--listen', self.host,
-            '--port', self.port,
-            '--input-directory', self.input_dir,
-            '--output-directory', self.output_dir,
-            '--temp-directory', self.temp_dir,
-            '--extra-model-paths-config', self.workflow.extra_model_paths,
-            '--verbose',
-        ]
-        
-        # os.chdir(self.work_dir)
-        self.process = self._launch_comfyui(args)
+        self._update_status("ready")
 
-        # check server status
-        # url = f"http://{self.host}:{self.port}/status"
-        while not self.comfyui_service.is_server_ready():
-            logger.info(f"Waiting for ComfyUI server to be ready: {self.host}:{self.port}")
-            time.sleep(5)
 
-        self._update_status("ready")
+    def _load_workflow_config(self, input_override: Optional[Dict] = None) -> Optional[Dict]:
+        """ workflow_api.json of the workflow, with the input override (default: run input override) merged in """
+        input_override = input_override if input_override is not None else self.input_override
+        # parsed once per workflow, the override is applied on a copy-on-write copy of the graph
+        workflow_config = compile_workflow(self.workflow.workflow_dir).apply(input_override)
+
+        if workflow_config is None:
+            logger.error(f"Error loading workflow config from {self.workflow.workflow_dir}/workflow_api.json")
+        return workflow_config
+
+    def _check_prompt_response(self, reponse_json: Dict) -> Optional['ComfyUIRunner.PromptResponse']:
+        """ Parse the /prompt response, None if ComfyUI rejected nodes of the prompt """
+        logger.info(reponse_json)
+        if reponse_json.get('error', None):
+            logger.error(f"Error running workflow: {reponse_json.get('error')}")
+            raise Exception(f"Error running workflow, {reponse_json}, please check logs in {self.work_dir}")
+        prompt_response = ComfyUIRunner.PromptResponse(**reponse_json)
+        if prompt_response.node_errors and len(prompt_response.node_errors.keys()) > 0:
+            logger.error(f"Error running workflow: {prompt_response.node_errors}")
+            return None
+        return prompt_response
+
+    @staticmethod
+    def _write_history(output_dir: str, prompt_id: str, get_history_response: Dict):
+        prompt_history_file = os.path.join(output_dir, f'prompt_history_{prompt_id}.json')
+        # write prompt history to file
+        with open(prompt_history_file, 'w') as f:
+            json.dump(get_history_response, f)
+
+    def _complete(self, prompt_id: str, get_history_response: Dict):
+        """ Update run status from the history of a done prompt, keep the history in the output dir """
+        status = get_history_response[f'{prompt_id}'].get('status', None) or {}
+
+        # files produced by the prompt, consumers fetch outputs from the manifest
+        with self.trace.span('collect_outputs') as span:
+            outputs = build_output_manifest(get_history_response[f'{prompt_id}'], self.workflow_run.output_dir)
+            self.workflow_run.outputs_json = json.dumps([o.model_dump() for o in outputs])
+            span.set('bytes', sum(o.size for o in outputs))
+
+        # TODO: comfyui response is not very clear, need to improve
+        if status.get('status_str', None) == 'success':
+            logger.info(f"Workflow completed successfully: {status}")
+            self._update_status("completed")
+        else: 
+            # Better error handling
+            logger.error(f"[Error]: running workflow: {status}")
+            self._update_status("failed")
 
+        self._write_history(self.workflow_run.output_dir, prompt_id, get_history_response)
 
-    def run(self):
-        try:
-            workflow_config = None
-            workflow_api_config_file = f'{self.workflow.workflow_dir}/workflow_api.json'
-            logger.info(f"Loading workflow from {workflow_api_config_file}")
-            with open(workflow_api_config_file, 'r') as f:
-                workflow_config = json.load(f)
-
-            # override input
-            if self.input_override:
-                def update(d, u):
-                    for k, v in u.items():
-                        if isinstance(v, collections.abc.Mapping):
-                            d[k] = update(d.get(k, {}), v)
-                        else:
-                            d[k] = v
-                    return d
-                workflow_config = update(workflow_config, self.input_override)
-                
+    def _submit_batch(self, results: List[BatchItemResult]):
+        """ Submit a prompt per batch item, items that can not be submitted are failed """
+        for index, input_override in enumerate(self.input_overrides):
+            subfolder = f'item_{index}'
+            result = BatchItemResult(index=index, status=WorkflowRunStatus.PENDING.value,
+                                     output_dir=os.path.join(self.output_dir, subfolder))
+            results.append(result)
+            os.makedirs(result.output_dir, exist_ok=True)
+
+            workflow_config = self._load_workflow_config(input_override)
             if workflow_config is None:
-                logger.error(f"Error loading workflow config from {workflow_api_config_file}")
-                return
+                result.status, result.error = WorkflowRunStatus.FAILED.value, 'can not load workflow config'
+                continue
+            workflow_config = _prefix_outputs(workflow_config, subfolder)
+            try:
+                prompt_response = self._check_prompt_response(
+                    self.comfyui_service.submit_prompt(workflow_config, client_id=self.run_id))
+            except Exception as e:
+                result.status, result.error = WorkflowRunStatus.FAILED.value, str(e)
+                continue
+            if prompt_response is None:
+                result.status, result.error = WorkflowRunStatus.FAILED.value, 'node errors, please check logs'
+                continue
+            result.prompt_id = prompt_response.prompt_id
+            result.status = WorkflowRunStatus.RUNNING.value
+
+    def _run_batch(self):
+        """ Submit every input override as a separate prompt, track each prompt independently """
+        results: List[BatchItemResult] = []
+        tracker = PromptCompletionTracker(self.comfyui_service, client_id=self.run_id, on_event=self._on_prompt_event)
+        tracker.connect()
+        try:
+            with self.trace.span('submit', prompts=len(self.input_overrides)):
+                self._submit_batch(results)
 
-            url = f"http://{self.host}:{self.port}/prompt"
-            response = requests.post(url, json={"prompt": workflow_config})
-            reponse_json = response.json()
-            logger.info(reponse_json)
-            if reponse_json.get('error', None):
-                logger.error(f"Error running workflow: {reponse_json.get('error')}")
-                raise Exception(f"Error running workflow, {reponse_json}, please check logs in {self.work_dir}")
-            prompt_response = ComfyUIRunner.PromptResponse(**response.json())
-            if prompt_response.node_errors and len(prompt_response.node_errors.keys()) > 0:
-                logger.error(f"Error running workflow: {prompt_response.node_errors}")
-                return
-            
             self._update_status("running")
-            
-            get_response = requests.get(url)
-            get_response_json = get_response.json()
-            logger.info(get_response_json)
-            prompt_id = prompt_response.prompt_id
-            logger.info(f"Prompt ID: {prompt_id}")
-
-            def get_prompt_status():
-                logger.info(f"Checking workflow status: {prompt_id}")
-                _reties = 0
-                while _reties < 5:
-                    try:
-                        get_history_response = requests.get(
-                            f'http://{self.host}:{self.port}/history/{prompt_id}',
-                            timeout=10
-                        )
-                        return get_history_response.json()
-                    except Exception as e:
-                        logger.error(f"Error getting prompt history: {e}")
-                        _reties += 1
-                        time.sleep(5)
-                        continue
-                        
-                raise Exception(f"Error getting prompt history for {prompt_id}")
-                
-            while True:
-                logger.info(f"Checking workflow status: {prompt_id}, workflow run dir: {self.work_dir}")
-                get_history_response = get_prompt_status()
-                prompt_status = get_history_response.get(f'{prompt_id}', None)
-
-                if prompt_status is None:
-                    logger.info(f"Prompt {prompt_id} Workflow not completed yet, no status returned")
-                    time.sleep(5)
-                    continue
-                
-                status = prompt_status.get('status', None)
-
-                # TODO: comfyui response is not very clear, need to improve
-                if status.get('status_str', None) == 'error':
-                    logger.error(f"[Error]: running workflow: {status}")
-                    self._update_status("failed")
-                    break
-                    
-                if status is None or not status.get('completed', False):
-                    # pull status again
-                    logger.info(f"Prompt {prompt_id} Workflow not completed yet: {status}")
-                    time.sleep(5)
+            prompt_ids = [r.prompt_id for r in results if r.prompt_id is not None]
+            logger.info(f"Prompt IDs: {prompt_ids}, workflow run dir: {self.work_dir}")
+            with self.trace.span('execute', prompts=len(prompt_ids)):
+                histories = tracker.wait_all(prompt_ids)
+        finally:
+            tracker.close()
+
+        with self.trace.span('collect_outputs') as span:
+            for result in results:
+                if result.prompt_id is None:
                     continue
-                
+                status = histories[result.prompt_id].get('status', None) or {}
+                result.outputs = build_output_manifest(histories[result.prompt_id], self.output_dir)
                 if status.get('status_str', None) == 'success':
-                    logger.info(f"Workflow completed successfully: {status}")
-                    self._update_status("completed")
-                else: 
-                    # Better error handling
-                    logger.error(f"[Error]: running workflow: {status}")
-                    self._update_status("failed")
-
-                output_dir = self.workflow_run.output_dir
-                prompt_history_file = os.path.join(output_dir, f'prompt_history_{prompt_id}.json')
-                # write prompt history to file
-                with open(prompt_history_file, 'w') as f:
-                    json.dump(get_history_response, f)
-                break
+                    result.status = WorkflowRunStatus.COMPLETED.value
+                else:
+                    result.status, result.error = WorkflowRunStatus.FAILED.value, json.dumps(status.get('messages', []))
+                self._write_history(result.output_dir, result.prompt_id, {result.prompt_id: histories[result.prompt_id]})
+            span.set('bytes', sum(o.size for r in results for o in r.outputs))
+
+        self.workflow_run.batch_results_json = json.dumps([r.model_dump() for r in results])
+        self.workflow_run.outputs_json = json.dumps([o.model_dump() for r in results for o in r.outputs])
+        failed = [r.index for r in results if r.status != WorkflowRunStatus.COMPLETED.value]
+        if failed:
+            logger.error(f"[Error]: batch items {failed} failed")
+            self._update_status("failed")
+        else:
+            logger.info(f"Batch of {len(results)} prompts completed successfully")
+            self._update_status("completed")
+
+
+    def run(self):
+        try:
+            if self.input_overrides is not None:
+                return self._run_batch()
+
+            workflow_config = self._load_workflow_config()
+            if workflow_config is None:
+                return
+
+            # subscribe to execution events before submitting, so no event is missed
+            tracker = PromptCompletionTracker(self.comfyui_service, client_id=self.run_id, on_event=self._on_prompt_event)
+            tracker.connect()
+            try:
+                with self.trace.span('submit'):
+                    prompt_response = self._check_prompt_response(
+                        self.comfyui_service.submit_prompt(workflow_config, client_id=self.run_id))
+                if prompt_response is None:
+                    return
+
+                self._update_status("running")
+
+                prompt_id = prompt_response.prompt_id
+                logger.info(f"Prompt ID: {prompt_id}, workflow run dir: {self.work_dir}")
+                with self.trace.span('execute'):
+                    get_history_response = tracker.wait(prompt_id)
+            finally:
+                tracker.close()
+
+            self._complete(prompt_id, get_history_response)
         except Exception as e:
             logger.error(f"Error running workflow: {e}, please check logs in {self.work_dir}")
             self._update_status("failed")
@@ -362,24 +400,42 @@ class ComfyUIRunner(Runner):
 
     def teardown(self):
         try:
-            self.process.terminate()
-            self.process.wait(timeout=ComfyUIRunner.PROC_SHUTDOWN_TIMEOUT_SEC) # wait for 5 seconds
-            returncode = self.process.poll()
-            logger.info(f"Process terminated with return code: {returncode}")
-            if returncode is None:
-                # process has not exit yet, force kill it
-                self.process.kill()
-        except Exception as e:
-            logger.error(f"Error terminating process: {e}. Force killing the process.")
-            self.process.kill()
+            if self.server is None:
+                return
+            with self.trace.span('teardown'):
+                if self.pool is not None:
+                    self.pool.release(self.server)
+                else:
+                    self.server.stop()
         finally:
+            self._finish_trace()
             self._update_status("terminated")
 
+    def _finish_trace(self):
+        # phase durations are persisted with the terminal status
+        self.workflow_run.phase_durations_json = json.dumps(self.trace.durations())
+        if self._owns_trace:
+            self.trace.finish()
+
 
 def run_workflow(workspace: Workspace, workflow: WorkflowRecord, 
-                 input_files: List[str] = [], input_override: Dict[str, Dict] = {}):
+                 input_files: List[str] = [], input_override: Dict[str, Dict] = {},
+                 pool: Optional[ComfyUIServerPool] = None, env: Optional[Dict[str, str]] = None,
+                 move_inputs: bool = False, trace: Optional[Trace] = None,
+                 input_sets: Optional[List[InputSet]] = None):
+    """ Run the workflow, or a batch of input sets on one ComfyUI server when `input_sets` is given:
+    per item results are in batch_results_json, input files of all items are staged into the same
+    run input dir, file names must be unique in the batch.
+    """
     # workflow manifest
-    workflow_to_run = get_workflow_manifest(workflow.workflow_dir)
+    workflow_to_run = workflow_cache.get_manifest(workflow)
+
+    if input_sets is not None:
+        input_files = [f for input_set in input_sets for f in input_set.input_files]
+        names = [os.path.basename(f) for f in input_files]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Input file names must be unique in a batch: {names}")
+        input_override = [input_set.input_override for input_set in input_sets]
 
     # Launch the workflow process
     workflow_run = WorkflowRunRecord(
@@ -395,15 +451,35 @@ def run_workflow(workspace: Workspace, workflow: WorkflowRecord,
     # scan workflow_run queue, and launch workflow process
     # pending_workflow_runs = list_workflow_runs(lambda v: v.status == WorkflowRunStatus.PENDING.value)
     # for run in pending_workflow_runs:
-    logger.info(f"Launching workflow run: {workflow_run.id}")
+    if input_sets is not None:
+        logger.info(f"Launching batch workflow run: {workflow_run.id}, {len(input_sets)} items")
+    else:
+        logger.info(f"Launching workflow run: {workflow_run.id}")
     runner = ComfyUIRunner(
         workspace=workspace,
         workflow=workflow_to_run,
         workflow_run=workflow_run,
-        callback=update_workflow_run
+        callback=submit_workflow_run_update, # committed in the background
+        pool=pool,
+        env=env,
+        move_inputs=move_inputs,
+        trace=trace
         )
-    runner.setup()
-    runner.run()
-    runner.teardown()
+    try:
+        runner.setup()
+        runner.run()
+    finally:
+        # always give the server back, a leaked lease blocks the pooled server forever
+        runner.teardown()
+        # the final status of the run is in the database when the run returns
+        status_writer.flush()
 
     return workflow_run
+
+
+def run_workflow_batch(workspace: Workspace, workflow: WorkflowRecord, input_sets: List[InputSet],
+                       pool: Optional[ComfyUIServerPool] = None, env: Optional[Dict[str, str]] = None,
+                       move_inputs: bool = False, trace: Optional[Trace] = None):
+    """ Run a batch of input sets on one ComfyUI server, see run_workflow """
+    return run_workflow(workspace, workflow, pool=pool, env=env, move_inputs=move_inputs, trace=trace,
+                        input_sets=input_sets)
@@ -8,8 +8,11 @@ import shutil
 from typing import Optional, List, Tuple, Dict
 
 from sqlmodel import Field
+from loguru import logger
 
 from .utils import run_command
+from .gitmeta import read_git_metadata, head_stamp
+from .git_cache import GitMirrorCache
 
 
 
@@ -67,6 +70,8 @@ class ModelDependency(BaseModel):
     rel_file_path: str # relative file path to the model_base_path, this is handle used to reference the model
     category: str | None # model category
     url: str | None
+    sha256: Optional[str] = None # content digest, the model is linked from the model store by digest
+    size: Optional[int] = None
 
 class CodeDependency(BaseModel):
     """  encapsulates a remote code repo
@@ -110,6 +115,21 @@ class Workspace(BaseModel):
     def workflow_run_path(self) -> str:
         return f'{self.base_path}/workflow_runs'
     
+    @computed_field
+    def server_path(self) -> str:
+        # home dirs of shared ComfyUI servers
+        return f'{self.base_path}/servers'
+
+    @computed_field
+    def git_mirror_path(self) -> str:
+        # bare mirrors of code dependencies, shared by workflow checkouts
+        return f'{self.base_path}/git_mirrors'
+
+    @computed_field
+    def download_path(self) -> str:
+        # partial model downloads, outside the models tree so they are never indexed or linked
+        return f'{self.base_path}/.downloads'
+
     @computed_field
     def database_file_path(self) -> str:
         return f'{self.base_path}/workflow.db'
@@ -119,6 +139,21 @@ class Workspace(BaseModel):
         return f'{self.base_path}/user_space'
 
 
+class ModelDirIndex(BaseModel):
+    """ Index entry of a model directory, valid as long as the directory mtime is unchanged """
+    mtime_ns: int
+    subdirs: List[str] = []
+    files: List[str] = [] # non-empty model files
+    empty_files: List[str] = [] # e.g. downloads in progress, re-checked on every scan
+
+
+class InventoryIndex(BaseModel):
+    """ Validators of inventory entries, used to rebuild the inventory incrementally """
+    modules: Dict[str, List[Optional[int]]] = {} # {module path -> git HEAD/refs/config mtimes}
+    model_dirs: Dict[str, ModelDirIndex] = {} # {model dir relative to model path -> dir index}
+    models: Dict[str, List[int]] = {} # {model relative to model path -> size, mtime}
+
+
 class Inventory(BaseModel):
     """ Abstarct inventory over physical workspace that contains all the dependencies
     One physical workspace can have multiple inventories
@@ -127,6 +162,7 @@ class Inventory(BaseModel):
     base_code: CodeDependency
     modules: Dict[str, CodeDependency] # {module name -> module dependency}
     models: Dict[str, Tuple[str, ModelDependency]] # {model category -> (model name, model dependency)}
+    index: Optional[InventoryIndex] = None
 
     def check_module_exist(self, module_name) -> None:
         if self.modules.get(module_name, None) is None:
@@ -165,6 +201,12 @@ class ComfyUIDependencyConfig(BaseModel):
     custom_models: List[ModelDependency] = Field(default = [], description='custom models')
 
 
+class ResourceRequirements(BaseModel):
+    # resources of a run of the workflow, used to place runs on GPUs
+    gpu_memory_mb: int = Field(default=0, description='peak GPU memory of a run, 0 if unknown (a whole device is reserved)')
+    exclusive: bool = Field(default=False, description='run alone on a device')
+
+
 def _validate_dir(dir_path, create=False):
     assert dir_path is not None, f'Directory path is None'
     
@@ -174,14 +216,32 @@ def _validate_dir(dir_path, create=False):
     assert os.path.exists(dir_path) and os.path.isdir(dir_path), f'Failed to create directory {dir_path}'
 
 
-def _create_symlink(src, dst):
+def _create_symlink(src, dst) -> bool:
+    """ Atomically point dst to src, return False if it already did """
+    if os.path.islink(dst) and os.readlink(dst) == src:
+        return False
+
     dir = os.path.dirname(dst)
     if not os.path.exists(dst):
         os.makedirs(dir, exist_ok=True)
 
     tmp_link = f'{dst}.tmp'
+    if os.path.islink(tmp_link):
+        # left over by an interrupted install
+        os.remove(tmp_link)
     os.symlink(src=src, dst=tmp_link, target_is_directory=True)
     os.rename(tmp_link, dst)
+    return True
+
+
+def _write_if_changed(path, content) -> bool:
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return False
+    with open(path, 'w') as f:
+        f.write(content)
+    return True
 
 
 class Workflow(BaseModel):
@@ -209,6 +269,7 @@ class Workflow(BaseModel):
     # dependencies
     python_venv: RuntimeEnv
     dependency_config: ComfyUIDependencyConfig
+    resources: ResourceRequirements = Field(default_factory=ResourceRequirements)
 
     @property
     def main_module_dir(self):
@@ -239,79 +300,64 @@ class Workflow(BaseModel):
         return f'{self.workflow_dir}/extra_model_paths.yaml'
 
 
-    def _clone_main_module(self):
-
-        if os.path.exists(self.main_module_dir):
-            # remove existing directory
-            
-            if os.path.isfile(self.main_module_dir) or os.path.islink(self.main_module_dir):
-                os.remove(self.main_module_dir)
-            elif os.path.isdir(self.main_module_dir):
-                shutil.rmtree(self.main_module_dir)
-            else:
-                raise ValueError(f'Invalid file type: {self.main_module_dir}')
-
+    def _clone_main_module(self, workspace: Workspace) -> bool:
+        # checkout of the workspace git mirror, skipped if already at the pinned commit
         main_module = self.dependency_config.base_code
-        run_command(["git", "clone", main_module.github_url, self.main_module_dir])
-        run_command(["git", "checkout", main_module.commit_sha], cwd=self.main_module_dir)
+        return GitMirrorCache(workspace.git_mirror_path).checkout(
+            main_module.github_url, main_module.commit_sha, self.main_module_dir)
 
-    def prepare_workspace(self, inventory: Inventory):
-        """ Prepare directory structure for the workflow
-        Use (symplink) dependencies from the inventory (also validate the dependencies are correct)
-        """
+    def prepare_dirs(self):
         # TODO: validate workspace
         _validate_dir(self.workflow_dir)
         _validate_dir(f'{self.input_dir}', create=True)
         _validate_dir(f'{self.output_dir}', create=True)
         _validate_dir(f'{self.temp_dir}', create=True)
 
-        # Prepare workflow directory
-        # 1) Clone ComfyUI base repo
-        # 2) Create symbolic link (inside ComfyUI dir) for custom modules, linking to custom modules in workspace inventory
-        # 3) Create symbolic link (inside ComfyUI dir) for custom models, linking to models in workspace inventory
-
-        # Customer Modules
-        def _check_code_module(existing_code_module, required_code_module):
-            # compare the two code modules are the same
-            assert existing_code_module.name == required_code_module.name, 'Name does not match'
-            assert existing_code_module.github_url == required_code_module.github_url, 'Github url does not match'
-            assert existing_code_module.commit_sha == required_code_module.commit_sha, 'Commit sha does not match'
-            return True
-        
-        assert _check_code_module(
+    @staticmethod
+    def _check_code_module(existing_code_module, required_code_module):
+        # compare the two code modules are the same
+        assert existing_code_module.name == required_code_module.name, 'Name does not match'
+        assert existing_code_module.github_url == required_code_module.github_url, 'Github url does not match'
+        assert existing_code_module.commit_sha == required_code_module.commit_sha, 'Commit sha does not match'
+        return True
+
+    @staticmethod
+    def _check_model(existing_model, required_model):
+        # compare the two models are the same
+        assert existing_model.name == required_model.name, 'Name does not match'
+        assert existing_model.file_name == required_model.file_name, 'File name does not match'
+        assert existing_model.rel_file_path == required_model.rel_file_path, 'Rel file path does not match'
+        assert existing_model.category == required_model.category, 'Category does not match'
+        if existing_model.sha256 is not None and required_model.sha256 is not None:
+            assert existing_model.sha256 == required_model.sha256, 'Model digest does not match'
+        return True
+
+    def verify_base_code(self, inventory: Inventory):
+        assert self._check_code_module(
             existing_code_module=inventory.base_code,
             required_code_module=self.dependency_config.base_code
         ), 'Base code module does not match'
-        # clone ComfyUI base repo
-        self._clone_main_module()
 
+    def verify_custom_node(self, inventory: Inventory, custom_node: CodeDependency):
+        inventory.check_module_exist(custom_node.name)
+        assert self._check_code_module(
+            existing_code_module=inventory.modules[custom_node.name],
+            required_code_module=custom_node
+        ), f'Custom node {custom_node.name} does not match'
 
-        for custom_node in self.dependency_config.custom_nodes:
-            inventory.check_module_exist(custom_node.name)
-            assert _check_code_module(
-                existing_code_module=inventory.modules[custom_node.name],
-                required_code_module=custom_node
-            ), f'Custom node {custom_node.name} does not match'
-            
-        # Create symbolic link to custom modules
+    def link_custom_nodes(self, inventory: Inventory) -> bool:
+        """ Create symbolic link to custom modules, return False if all links were already in place """
         # TODO: create virtual inventory if necessary in the future
         custom_modules = [f.path for f in os.scandir(inventory.workspace.module_path) if f.is_dir()]
+        changed = False
         for module in custom_modules:
-            _create_symlink(
+            changed |= _create_symlink(
                 src=module, 
                 dst=f'{self.main_module_dir}/custom_nodes/{os.path.basename(module)}')
+        return changed
 
-
-        # Custom models
-        def _check_model(existing_model, required_model):
-            # compare the two models are the same
-            assert existing_model.name == required_model.name, 'Name does not match'
-            assert existing_model.file_name == required_model.file_name, 'File name does not match'
-            assert existing_model.rel_file_path == required_model.rel_file_path, 'Rel file path does not match'
-            assert existing_model.category == required_model.category, 'Category does not match'
-            return True
-
-        
+    def link_custom_models(self, inventory: Inventory) -> bool:
+        """ Verify and link custom models, return False if all links were already in place """
         # FIXME: workflow should provide an inclusive list of custom models
         # FIXME: install model to inventory on demand 
         # for the time being, we assume all models in the custom_model_dir are used
@@ -320,18 +366,22 @@ class Workflow(BaseModel):
         for custom_model in self.dependency_config.custom_models:
             inventory.check_model_exist(custom_model.rel_file_path)
             _, model_dependency = inventory.models[custom_model.rel_file_path]
-            assert _check_model(model_dependency, custom_model), f'Custom model {custom_model.rel_file_path} does not match'
+            assert self._check_model(model_dependency, custom_model), f'Custom model {custom_model.rel_file_path} does not match'
 
-        # Create symbolic link to custom models
+        # Create symbolic link to custom models, by digest if the model is in the model store
+        changed = False
         for model in self.dependency_config.custom_models:
-            _create_symlink(
-                src=f'{inventory.workspace.model_path}/{model.rel_file_path}', 
+            src = f'{inventory.workspace.model_path}/{model.rel_file_path}'
+            if model.sha256 is not None:
+                blob = f'{inventory.workspace.model_path}/{MODEL_STORE_DIR}/sha256/{model.sha256}'
+                src = blob if os.path.exists(blob) else src
+            changed |= _create_symlink(
+                src=src, 
                 dst=f'{self.main_module_dir}/models/{model.rel_file_path}')
-        
-
-        with open(f'{self.workflow_dir}/manifest.json', 'w') as f:
-            f.write(self.model_dump_json())
+        return changed
 
+    def write_manifest(self) -> bool:
+        """ Write manifest.json and extra_model_paths.yaml, return False if they were up to date """
         import yaml
         
 
@@ -347,33 +397,80 @@ class Workflow(BaseModel):
         #         print(f'Found model category: {model_category}')
         #         extra_model_paths_config['comfyui'][model_category] = f'{self.custom_model_dir}/{model_category}/'
 
-        with open(self.extra_model_paths, 'w') as f:
-            yaml_data = yaml.dump(extra_model_paths_config, default_flow_style=False)
-            f.write(yaml_data)
+        # unchanged files are not rewritten, their mtime invalidates cached manifests
+        changed = _write_if_changed(f'{self.workflow_dir}/manifest.json', self.model_dump_json())
+        changed |= _write_if_changed(self.extra_model_paths, yaml.dump(extra_model_paths_config, default_flow_style=False))
+        return changed
+
+    def prepare_workspace(self, inventory: Inventory):
+        """ Prepare directory structure for the workflow
+        Use (symplink) dependencies from the inventory (also validate the dependencies are correct)
+        See workflow_installer for the concurrent installation of the same steps.
+        """
+        self.prepare_dirs()
+
+        # Prepare workflow directory
+        # 1) Clone ComfyUI base repo
+        # 2) Create symbolic link (inside ComfyUI dir) for custom modules, linking to custom modules in workspace inventory
+        # 3) Create symbolic link (inside ComfyUI dir) for custom models, linking to models in workspace inventory
+        self.verify_base_code(inventory)
+        # clone ComfyUI base repo
+        self._clone_main_module(inventory.workspace)
+
+        # Customer Modules
+        for custom_node in self.dependency_config.custom_nodes:
+            self.verify_custom_node(inventory, custom_node)
+        self.link_custom_nodes(inventory)
+
+        # Custom models
+        self.link_custom_models(inventory)
+
+        self.write_manifest()
         
 
-def reconstruct_inventory(base_path):
-    # build inventory
+MODEL_STORE_DIR = '.store' # see model_store.ModelStore
+
 
-    import os
-    import subprocess
+def _load_inventory(base_path) -> Optional[Inventory]:
+    inventory_file = f'{base_path}/inventory.json'
+    if not os.path.exists(inventory_file):
+        return None
+    try:
+        with open(inventory_file, 'r') as f:
+            return Inventory.model_validate_json(f.read())
+    except Exception as e:
+        logger.warning(f"Can not load {inventory_file}, rescanning workspace: {e}")
+        return None
 
+
+def reconstruct_inventory(base_path, full_rescan: bool = False):
+    """ Build the inventory of the workspace, persisted in inventory.json
+    The previous inventory.json is used as an index: modules are re-read only if their git HEAD/refs changed,
+    model directories are re-listed only if their mtime changed, model entries are reused only if the size and
+    mtime of the file are unchanged (a file replaced in place keeps its directory mtime). `full_rescan` ignores the index.
+    """
     workspace = Workspace(base_path=base_path)
-    
-    def reconstruct_module(module_path):
-        # git remote get-url --push origin
-        # git branch --show-current
-        # git rev-parse HEAD
-        remote_url = subprocess.run(["git", "remote", "get-url", "--push", "origin"], cwd=module_path, capture_output=True, text=True).stdout.strip()
-        # branch = subprocess.run(["git", "branch", "--show-current"], cwd=module_path, capture_output=True, text=True).stdout.strip()
-        commit_sha = subprocess.run(["git", "rev-parse", "HEAD"], cwd=module_path, capture_output=True, text=True).stdout.strip()
-        tags = subprocess.run(["git", "tag", "--points-at", "HEAD"], cwd=module_path, capture_output=True, text=True).stdout.strip()
+    previous = None if full_rescan else _load_inventory(base_path)
+    previous_index = previous.index if previous is not None and previous.index is not None else InventoryIndex()
+    previous_modules = {} if previous is None else {
+        os.path.join(workspace.module_path, name): module for name, module in previous.modules.items()}
+    if previous is not None:
+        previous_modules[workspace.base_code_path] = previous.base_code
+    index = InventoryIndex()
 
+    def reconstruct_module(module_path):
+        stamp = head_stamp(module_path)
+        index.modules[module_path] = stamp
+        cached = previous_modules.get(module_path, None)
+        if cached is not None and stamp and previous_index.modules.get(module_path, None) == stamp:
+            return cached
+
+        # origin push url and HEAD, read from the git dir instead of spawning git
+        remote_url, commit_sha = read_git_metadata(module_path)
         return CodeDependency(
             name=os.path.basename(module_path), 
             github_url=remote_url, 
-            commit_sha=commit_sha,
-            tags=tags)
+            commit_sha=commit_sha)
 
     modules = {}
     
@@ -388,29 +485,83 @@ def reconstruct_inventory(base_path):
 
     models = {}
     models_base_path = workspace.model_path 
-    for root, dirs, files in os.walk(models_base_path):
-        for model_file in files:
-            model_path = os.path.join(root, model_file)
-            model_size = os.path.getsize(model_path)
-            if model_size == 0:
-                # skip empty file
-                continue
-            filename = os.path.basename(model_file)
-            rel_path = os.path.relpath(model_path, models_base_path)
-            category = rel_path.split('/')[0] 
-            models[rel_path] = (category, ModelDependency(
-                name=filename, 
-                file_name=filename, 
-                rel_file_path=rel_path,
-                category=category, 
-                url=f'file:{model_path}'))
-
+    previous_models = {} if previous is None else previous.models
+
+    def add_model(rel_path):
+        model_path = os.path.join(models_base_path, rel_path)
+        try:
+            st = os.stat(model_path)
+        except FileNotFoundError:
+            return
+        stamp = [st.st_size, st.st_mtime_ns]
+        index.models[rel_path] = stamp
+        cached = previous_models.get(rel_path, None)
+        if cached is not None and previous_index.models.get(rel_path, None) == stamp:
+            models[rel_path] = cached
+            return
+        filename = os.path.basename(rel_path)
+        category = rel_path.split('/')[0] 
+        models[rel_path] = (category, ModelDependency(
+            name=filename, 
+            file_name=filename, 
+            rel_file_path=rel_path,
+            category=category, 
+            url=f'file:{model_path}'))
+
+    def scan_model_dir(rel_dir):
+        dir_path = os.path.join(models_base_path, rel_dir) if rel_dir else models_base_path
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        entry = previous_index.model_dirs.get(rel_dir, None)
+        if entry is not None and not rel_dir:
+            # the content addressed store is not a model category
+            entry.subdirs = [name for name in entry.subdirs if name != MODEL_STORE_DIR]
+        if entry is None or entry.mtime_ns != mtime_ns:
+            # directory content changed, list it
+            entry = ModelDirIndex(mtime_ns=mtime_ns)
+            with os.scandir(dir_path) as it:
+                for dir_entry in it:
+                    if not rel_dir and dir_entry.name == MODEL_STORE_DIR:
+                        continue
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        entry.subdirs.append(dir_entry.name)
+                    elif dir_entry.is_dir() or not os.path.exists(dir_entry.path):
+                        # symlinked dirs are not followed, broken links are not models
+                        continue
+                    elif dir_entry.stat().st_size == 0:
+                        # skip empty file
+                        entry.empty_files.append(dir_entry.name)
+                    else:
+                        entry.files.append(dir_entry.name)
+        else:
+            entry = entry.model_copy(deep=True)
+            # files still being written do not change the directory mtime
+            for name in list(entry.empty_files):
+                try:
+                    size = os.path.getsize(os.path.join(dir_path, name))
+                except FileNotFoundError:
+                    entry.empty_files.remove(name)
+                    continue
+                if size > 0:
+                    entry.empty_files.remove(name)
+                    entry.files.append(name)
+        index.model_dirs[rel_dir] = entry
+
+        for name in entry.files:
+            add_model(os.path.join(rel_dir, name) if rel_dir else name)
+        for name in entry.subdirs:
+            scan_model_dir(os.path.join(rel_dir, name) if rel_dir else name)
+
+    scan_model_dir('')
 
     inventory = Inventory(
         workspace=workspace,
         base_code=reconstruct_module(workspace.base_code_path),
         modules=modules,
-        models=models)
+        models=models,
+        index=index)
 
     with open(f'{base_path}/inventory.json', 'w') as f:
         f.write(inventory.model_dump_json())
@@ -420,6 +571,16 @@ def reconstruct_inventory(base_path):
 # Main ComfyUI repo
 # main_code_repo=CodeRepo(github_url="git@github.com:comfyanonymous/ComfyUI.git", commit_sha='4ca9b9cc29fefaa899cba67d61a8252ae9f16c0d', tag='v0.0.1')
 
+def _installed_workflow_id(workflow_dir: str) -> str:
+    # a re-install keeps the id of the installed manifest, so an unchanged workflow writes an identical manifest
+    try:
+        with open(f'{workflow_dir}/manifest.json', 'r') as f:
+            workflow_id = json.load(f).get('id', None)
+    except (OSError, ValueError):
+        workflow_id = None
+    return workflow_id if workflow_id else str(uuid.uuid4())
+
+
 def reconstruct_workflow(base_path):
     
     # ComfyUI base code v0.0.7
@@ -438,6 +599,8 @@ def reconstruct_workflow(base_path):
             models.append(ModelDependency(**m))
         for m in dependency['modules']:
             modules.append(CodeDependency(**m))
+        # optional, e.g. {"gpu_memory_mb": 6000}
+        resources = ResourceRequirements(**dependency.get('resources', {}))
     
     dependency_config = ComfyUIDependencyConfig(
                             base_code=code, 
@@ -446,13 +609,14 @@ def reconstruct_workflow(base_path):
 
     name = os.path.basename(base_path)
     workflow = Workflow(
-        id=str(uuid.uuid4()),
+        id=_installed_workflow_id(base_path),
         name=name,
         category="comfyui",
         description="Example workflow for comfyui", 
         workflow_dir=base_path,
         python_venv=RuntimeEnv(venv_path="/home/ruoyu.huang/workspace/xiaoapp/venv"),
-        dependency_config=dependency_config
+        dependency_config=dependency_config,
+        resources=resources
     )
     
     return workflow
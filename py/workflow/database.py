@@ -1,15 +1,109 @@
 # ORM layer
+import base64
+import json
 from enum import Enum
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from sqlmodel import SQLModel, Field, create_engine, Session, select
 import os
-from pydantic import computed_field
-from sqlalchemy import JSON
+import threading
+import time
+from datetime import datetime
+from pydantic import BaseModel, computed_field
+from sqlalchemy import JSON, Index, event, inspect, text, tuple_
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.pool import StaticPool
+from loguru import logger
 
-# TODO: pointing to the workflow.db on the workspace
-# FIXME: database access should be attached to the workspace
-DATABASE_URL = "sqlite:////home/ruoyu.huang/workspace/xiaoapp/comfyui_workspace/workflow.db"
-engine = create_engine(DATABASE_URL, echo=True)
+from .dao import Workspace
+
+# FIXME: database access should be attached to the workspace, the default is used until init_db(workspace)
+DATABASE_FILE_PATH = os.environ.get(
+    'WORKFLOW_DATABASE_PATH', "/home/ruoyu.huang/workspace/xiaoapp/comfyui_workspace/workflow.db")
+# wait for the write lock of a concurrent writer instead of failing with `database is locked`
+DATABASE_BUSY_TIMEOUT_MS = int(os.environ.get('WORKFLOW_DATABASE_BUSY_TIMEOUT_MS', 30000))
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+class DatabaseConfig(BaseModel):
+    """ Connection settings of the run state database, any SQLAlchemy URL
+
+    A local SQLite file by default, a shared server database (e.g. postgresql://...) lets
+    several scheduler nodes and the API share run state.
+    """
+    url: str
+    echo: bool = False # log SQL statements
+    # connection pool, not used by in-memory SQLite
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_pre_ping: bool = True # test connections on checkout, drops connections closed by the server
+    pool_recycle_sec: int = 1800 # reconnect connections older than this, -1 to keep them forever
+
+    @classmethod
+    def sqlite_file(cls, database_file_path: str, **kwargs) -> 'DatabaseConfig':
+        return cls(url=f"sqlite:///{database_file_path}", **kwargs)
+
+    @classmethod
+    def from_env(cls, default_url: Optional[str] = None) -> 'DatabaseConfig':
+        """ WORKFLOW_DATABASE_URL (or `default_url`, or the default SQLite file) and WORKFLOW_DATABASE_* settings """
+        return cls(
+            url=os.environ.get('WORKFLOW_DATABASE_URL', default_url or f"sqlite:///{DATABASE_FILE_PATH}"),
+            echo=_env_flag('WORKFLOW_DATABASE_ECHO', '0'),
+            pool_size=int(os.environ.get('WORKFLOW_DATABASE_POOL_SIZE', 5)),
+            max_overflow=int(os.environ.get('WORKFLOW_DATABASE_MAX_OVERFLOW', 10)),
+            pool_pre_ping=_env_flag('WORKFLOW_DATABASE_POOL_PRE_PING', '1'),
+            pool_recycle_sec=int(os.environ.get('WORKFLOW_DATABASE_POOL_RECYCLE_SEC', 1800)),
+        )
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # readers do not block the writer and the writer does not block readers
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # WAL is durable at checkpoints with synchronous=NORMAL, a commit is not an fsync
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={DATABASE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+def create_db_engine(config: DatabaseConfig) -> Engine:
+    """ Engine shared by the threads of the process
+    SQLite databases are in WAL mode with a busy timeout, an in-memory database is a single shared connection.
+    """
+    url = make_url(config.url)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(
+            config.url, echo=config.echo, pool_size=config.pool_size, max_overflow=config.max_overflow,
+            pool_pre_ping=config.pool_pre_ping, pool_recycle=config.pool_recycle_sec)
+
+    connect_args = {'check_same_thread': False, 'timeout': DATABASE_BUSY_TIMEOUT_MS / 1000}
+    if url.database in (None, '', ':memory:'):
+        return create_engine(config.url, echo=config.echo, connect_args=connect_args, poolclass=StaticPool)
+    db_engine = create_engine(
+        config.url, echo=config.echo, connect_args=connect_args, pool_size=config.pool_size,
+        max_overflow=config.max_overflow, pool_pre_ping=config.pool_pre_ping, pool_recycle=config.pool_recycle_sec)
+    event.listen(db_engine, 'connect', _set_sqlite_pragmas)
+    return db_engine
+
+
+engine = create_db_engine(DatabaseConfig.from_env())
+_configured = False # configure_database() was called, e.g. by the API at startup
+
+
+def configure_database(config: DatabaseConfig):
+    """ Point the database operations of the process to another database """
+    global engine, _configured
+    status_writer.flush()
+    engine.dispose()
+    engine = create_db_engine(config)
+    status_writer.engine = engine
+    _configured = True
+
+
+def is_database_configured() -> bool:
+    return _configured
 
 class WorkflowRecord(SQLModel, table=True):
     # a record of a workflow in database
@@ -35,6 +129,13 @@ class WorkflowRunStatus(Enum):
 
 class WorkflowRunRecord(SQLModel, table=True):
     # a record of a workflow run in database
+    # runs are listed newest first by status or by workflow, (created_at, id) is the page key
+    __table_args__ = (
+        Index('ix_workflowrunrecord_status_created_at', 'status', 'created_at'),
+        Index('ix_workflowrunrecord_workflow_id_created_at', 'workflow_id', 'created_at'),
+        Index('ix_workflowrunrecord_created_at', 'created_at'),
+    )
+
     id: int = Field(primary_key=True)
     workflow_id: int # foreign key to WorkflowRecord
 
@@ -55,6 +156,21 @@ class WorkflowRunRecord(SQLModel, table=True):
     host: str | None = None
     port: int | None = None
 
+    # node level progress of the running prompt, a json dict
+    progress_json: str | None = None
+
+    # per item results of a batch run, a json list
+    batch_results_json: str | None = None
+
+    # bytes of input files copied to stage the run inputs, 0 when all inputs were linked or moved
+    input_bytes_copied: int | None = None
+
+    # files produced by the run (node id, filename, subfolder, type, size, sha256), a json list
+    outputs_json: str | None = None
+
+    # seconds per phase of the run (stage_inputs, server_start, execute, ...), a json dict
+    phase_durations_json: str | None = None
+
 
     @computed_field
     def input_dir(self) -> str:
@@ -74,20 +190,82 @@ class WorkflowRunRecord(SQLModel, table=True):
         return os.path.join(self.runtime_dir, "workflow_run.log")
 
 
-def init_db():
-    SQLModel.metadata.create_all(engine)
+class SchemaVersion(SQLModel, table=True):
+    # applied schema migrations, one row per migration
+    version: int = Field(primary_key=True)
+    description: str
+    applied_at: str
 
 
-def list_workflows():
-    with Session(engine) as session:
-        stmt = select(WorkflowRecord)
-        workflows = session.exec(stmt)
+def _add_column(conn: Connection, table_name: str, column_name: str):
+    # add a nullable column declared on the model, if not there yet
+    inspector = inspect(conn)
+    if column_name in {c['name'] for c in inspector.get_columns(table_name)}:
+        return
+    column = SQLModel.metadata.tables[table_name].columns[column_name]
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}'))
 
-        results = []
-        for workflow in workflows:
-            print(workflow)
-            results.append(workflow)
-        return results
+
+def _create_indexes(conn: Connection, table_name: str):
+    for index in SQLModel.metadata.tables[table_name].indexes:
+        index.create(conn, checkfirst=True)
+
+
+# Schema changes after the first release, in order. A migration brings a database of the previous
+# version to its version, migrations of a new database are recorded without being applied
+# (create_all creates the current schema).
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, 'run progress, batch results, staging and outputs columns', lambda conn: [
+        _add_column(conn, 'workflowrunrecord', c)
+        for c in ('progress_json', 'batch_results_json', 'input_bytes_copied', 'outputs_json')]),
+    (2, 'run listing indexes', lambda conn: _create_indexes(conn, 'workflowrunrecord')),
+    (3, 'run phase durations', lambda conn: _add_column(conn, 'workflowrunrecord', 'phase_durations_json')),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(db_engine: Optional[Engine] = None) -> int:
+    """ Create or upgrade the schema to SCHEMA_VERSION, return the number of migrations applied """
+    db_engine = db_engine if db_engine is not None else engine
+    with db_engine.begin() as conn:
+        inspector = inspect(conn)
+        new_database = not inspector.has_table(WorkflowRecord.__tablename__)
+        SQLModel.metadata.create_all(conn)
+        applied = set(conn.execute(select(SchemaVersion.version)).scalars())
+
+        count = 0
+        for version, description, upgrade in MIGRATIONS:
+            if version in applied:
+                continue
+            if not new_database:
+                logger.info(f"Migrating database to version {version}: {description}")
+                upgrade(conn)
+                count += 1
+            conn.execute(SchemaVersion.__table__.insert().values(
+                version=version, description=description, applied_at=datetime.now().isoformat()))
+    return count
+
+
+def init_db(workspace: Optional[Workspace] = None, config: Optional[DatabaseConfig] = None):
+    # the configured database (WORKFLOW_DATABASE_URL) or the workflow.db in the workspace base dir
+    if config is None and workspace is not None:
+        config = DatabaseConfig.from_env(default_url=f"sqlite:///{workspace.database_file_path}")
+    if config is not None:
+        configure_database(config)
+    migrate()
+
+
+def list_workflows(limit: Optional[int] = None, after_id: Optional[int] = None) -> List[WorkflowRecord]:
+    # workflows ordered by id, a page of `limit` workflows after `after_id`
+    with Session(engine) as session:
+        stmt = select(WorkflowRecord).order_by(WorkflowRecord.id)
+        if after_id is not None:
+            stmt = stmt.where(WorkflowRecord.id > after_id)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return list(session.exec(stmt))
 
 
 def get_workflow_by_id(workflow_id: int):
@@ -96,6 +274,19 @@ def get_workflow_by_id(workflow_id: int):
         return workflow
 
 
+def get_workflow_by_dir(workflow_dir: str):
+    with Session(engine) as session:
+        stmt = select(WorkflowRecord).where(WorkflowRecord.workflow_dir == workflow_dir)
+        return session.exec(stmt).first()
+
+
+def get_workflow_version(workflow_id: int):
+    # (workflow_dir, updated_at) of a workflow, a cheap query to revalidate cached workflows
+    with Session(engine) as session:
+        stmt = select(WorkflowRecord.workflow_dir, WorkflowRecord.updated_at).where(WorkflowRecord.id == workflow_id)
+        return session.exec(stmt).first()
+
+
 def create_workflow(workflow_record: WorkflowRecord):
     with Session(engine) as session:
         session.add(workflow_record)
@@ -103,6 +294,12 @@ def create_workflow(workflow_record: WorkflowRecord):
         session.refresh(workflow_record)
         print(f"Workflow created: {workflow_record}")
 
+def update_workflow(workflow_record: WorkflowRecord):
+    with Session(engine) as session:
+        session.add(workflow_record)
+        session.commit()
+        session.refresh(workflow_record)
+
 def create_workflow_run(workflow_run_record: WorkflowRunRecord):
     with Session(engine) as session:
         session.add(workflow_run_record)
@@ -110,6 +307,10 @@ def create_workflow_run(workflow_run_record: WorkflowRunRecord):
         session.refresh(workflow_run_record)
         return workflow_run_record
 
+def get_workflow_run_by_id(workflow_run_id: int):
+    with Session(engine) as session:
+        return session.get(WorkflowRunRecord, workflow_run_id)
+
 def update_workflow_run(workflow_run_record: WorkflowRunRecord):
     with Session(engine) as session:
         session.add(workflow_run_record)
@@ -117,6 +318,7 @@ def update_workflow_run(workflow_run_record: WorkflowRunRecord):
         session.refresh(workflow_run_record)
 
 def list_workflow_runs(filter_fn):
+    # loads every run, use query_workflow_runs for filtered and paginated listings
     with Session(engine) as session:
         stmt = select(WorkflowRunRecord)
         workflow_runs = session.exec(stmt)
@@ -126,3 +328,151 @@ def list_workflow_runs(filter_fn):
                 results.append(workflow_run)
         return results
 
+
+
+class StatusWriter:
+    """ Write-behind queue of workflow run updates
+
+    Runners submit a snapshot of the run record on every status change and go on, a background
+    thread commits the pending snapshots in one transaction. Updates of the same run are coalesced,
+    only the last snapshot is written. flush() waits until submitted updates are committed.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, db_engine: Engine, batch_interval_sec: float = 0.2):
+        self.engine = db_engine
+        self.batch_interval_sec = batch_interval_sec # time to collect updates before a commit
+        self._pending: Dict[int, WorkflowRunRecord] = {}
+        self._attempts: Dict[int, int] = {}
+        self._writing = False
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.commits = 0 # transactions, for monitoring
+        self.writes = 0 # run records written
+
+    def submit(self, workflow_run: WorkflowRunRecord):
+        # copy, the runner keeps updating its record while the snapshot waits for the commit
+        snapshot = WorkflowRunRecord(**workflow_run.model_dump(include=set(WorkflowRunRecord.model_fields)))
+        with self._cond:
+            self._pending[workflow_run.id] = snapshot
+            self._attempts.pop(workflow_run.id, None)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='status-writer', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+            # let updates of the other runs accumulate
+            time.sleep(self.batch_interval_sec)
+            with self._cond:
+                batch, self._pending = self._pending, {}
+                self._writing = True
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def _write(self, batch: Dict[int, WorkflowRunRecord]):
+        try:
+            with Session(self.engine) as session:
+                for workflow_run in batch.values():
+                    session.merge(workflow_run)
+                session.commit()
+            self.commits += 1
+            self.writes += len(batch)
+        except Exception as e:
+            logger.error(f"Error writing {len(batch)} workflow run updates: {e}")
+            with self._cond:
+                for run_id, workflow_run in batch.items():
+                    if run_id in self._pending:
+                        continue # superseded by a newer snapshot
+                    attempts = self._attempts.get(run_id, 0) + 1
+                    if attempts >= StatusWriter.MAX_ATTEMPTS:
+                        logger.error(f"Dropping update of workflow run {run_id}: {workflow_run.status}")
+                        self._attempts.pop(run_id, None)
+                        continue
+                    self._attempts[run_id] = attempts
+                    self._pending[run_id] = workflow_run
+            time.sleep(self.batch_interval_sec)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """ Wait until submitted updates are committed (or dropped), return False on timeout """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._writing, timeout=timeout)
+
+
+status_writer = StatusWriter(engine)
+
+
+def submit_workflow_run_update(workflow_run: WorkflowRunRecord):
+    """ Status callback of runners, the update is committed in the background """
+    status_writer.submit(workflow_run)
+
+
+class WorkflowRunSummary(BaseModel):
+    """ Projection of a run for list views, the json columns are not loaded """
+    id: int
+    workflow_id: int
+    status: str
+    created_at: str
+    updated_at: str | None = None
+
+
+class WorkflowRunPage(BaseModel):
+    runs: List[WorkflowRunSummary]
+    next_cursor: str | None = None # None on the last page
+
+
+def _encode_cursor(run: WorkflowRunSummary) -> str:
+    return base64.urlsafe_b64encode(json.dumps([run.created_at, run.id]).encode()).decode()
+
+
+def _decode_cursor(cursor: str):
+    try:
+        created_at, run_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(created_at), int(run_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def query_workflow_runs(status: Union[str, List[str], None] = None,
+                        workflow_id: Optional[int] = None,
+                        created_after: Optional[str] = None,
+                        created_before: Optional[str] = None,
+                        limit: int = 50,
+                        cursor: Optional[str] = None) -> WorkflowRunPage:
+    """ A page of runs, newest first, filtered in SQL
+
+    Pages are keyed by (created_at, id) of the last run: the next page is an index range scan
+    from the cursor whatever the page number. created_at bounds are ISO timestamps,
+    `created_after` inclusive and `created_before` exclusive.
+    """
+    columns = (WorkflowRunRecord.id, WorkflowRunRecord.workflow_id, WorkflowRunRecord.status,
+               WorkflowRunRecord.created_at, WorkflowRunRecord.updated_at)
+    stmt = select(*columns)
+    if isinstance(status, str):
+        stmt = stmt.where(WorkflowRunRecord.status == status)
+    elif status:
+        stmt = stmt.where(WorkflowRunRecord.status.in_(status))
+    if workflow_id is not None:
+        stmt = stmt.where(WorkflowRunRecord.workflow_id == workflow_id)
+    if created_after is not None:
+        stmt = stmt.where(WorkflowRunRecord.created_at >= created_after)
+    if created_before is not None:
+        stmt = stmt.where(WorkflowRunRecord.created_at < created_before)
+    if cursor is not None:
+        stmt = stmt.where(tuple_(WorkflowRunRecord.created_at, WorkflowRunRecord.id) < _decode_cursor(cursor))
+    # one more row tells whether there is a next page
+    stmt = stmt.order_by(WorkflowRunRecord.created_at.desc(), WorkflowRunRecord.id.desc()).limit(limit + 1)
+
+    with Session(engine) as session:
+        rows = session.exec(stmt).all()
+    runs = [WorkflowRunSummary(**row._mapping) for row in rows[:limit]]
+    next_cursor = _encode_cursor(runs[-1]) if len(rows) > limit else None
+    return WorkflowRunPage(runs=runs, next_cursor=next_cursor)
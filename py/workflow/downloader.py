@@ -0,0 +1,271 @@
+""" Parallel, resumable model downloader
+Missing models of a workflow (ModelDependency.url) are fetched into the workspace inventory:
+    - files are split in parts fetched in parallel with HTTP range requests
+    - parts land in `<workspace>/.downloads/<key>-<model>.part`, outside the models tree, so the inventory
+      and the model store never see a partial file; finished parts are recorded in `<...>.part.json` so an
+      interrupted download resumes where it stopped (restarted if the remote file changed)
+    - size and sha256 are verified while streaming: the part at the hash cursor is hashed as it
+      arrives, parts finished ahead of the cursor are hashed from the page cache when it reaches them
+    - range requests of all downloads in the process share one concurrency limit
+Servers without range support are downloaded in one stream.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from pydantic import BaseModel
+from loguru import logger
+
+from .dao import Inventory, ModelDependency, Workspace
+from .streams import update_digest
+
+
+class DownloadError(RuntimeError):
+    """ Download failed or the downloaded file does not match the expected size/sha256 """
+
+
+# range requests in flight, shared by all downloads of the process
+download_slots = threading.BoundedSemaphore(int(os.environ.get('MODEL_DOWNLOAD_CONCURRENCY', '8')))
+
+
+class _PartState(BaseModel):
+    """ Resume state of a download, persisted next to the part file """
+    url: str
+    size: int
+    part_size: int
+    etag: Optional[str] = None
+    done: List[int] = []
+
+
+class _OrderedHasher:
+    """ sha256 of a file written out of order, fed in order """
+
+    def __init__(self, path: str, part_size: int, size: int):
+        self.path = path
+        self.part_size = part_size
+        self.size = size
+        self.digest = hashlib.sha256()
+        self.position = 0
+        self.done: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def _catch_up(self, end: int):
+        # bytes already on disk, hashed from the page cache
+        self.position += update_digest(self.digest, self.path, start=self.position, end=end)
+        if self.position < end:
+            raise DownloadError(f"Short read of {self.path} at {self.position}")
+
+    def _advance(self):
+        while self.position // self.part_size in self.done and self.position < self.size:
+            part = self.position // self.part_size
+            self._catch_up(min((part + 1) * self.part_size, self.size))
+
+    def feed(self, offset: int, data: bytes):
+        """ `data` was written at `offset` """
+        with self._lock:
+            if self.position // self.part_size != offset // self.part_size or self.position > offset:
+                return # not at the hash cursor, hashed later
+            if self.position < offset:
+                self._catch_up(offset)
+            self.digest.update(data)
+            self.position += len(data)
+
+    def part_done(self, part: int):
+        with self._lock:
+            self.done.add(part)
+            self._advance()
+
+    def hexdigest(self) -> str:
+        with self._lock:
+            self._advance()
+            if self.position != self.size:
+                raise DownloadError(f"Hashed {self.position} of {self.size} bytes of {self.path}")
+            return self.digest.hexdigest()
+
+
+class ModelDownloader:
+    """ Download models into the workspace model dir
+
+    downloader = ModelDownloader(workspace)
+    downloader.fetch_missing(inventory, workflow.dependency_config.custom_models)
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    PART_SIZE = 64 * 1024 * 1024
+    CONNECTIONS_PER_FILE = 4
+    CONNECT_TIMEOUT_SEC = 10
+    READ_TIMEOUT_SEC = 60
+
+    def __init__(self, workspace: Workspace, part_size: Optional[int] = None,
+                 connections_per_file: Optional[int] = None, session: Optional[requests.Session] = None):
+        self.workspace = workspace
+        self.part_size = part_size if part_size is not None else ModelDownloader.PART_SIZE
+        self.connections_per_file = (connections_per_file if connections_per_file is not None
+                                     else ModelDownloader.CONNECTIONS_PER_FILE)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=self.connections_per_file)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self.timeout = (ModelDownloader.CONNECT_TIMEOUT_SEC, ModelDownloader.READ_TIMEOUT_SEC)
+
+    def _probe(self, url: str) -> requests.Response:
+        # a 1 byte range request tells the size and whether ranges are supported
+        with download_slots:
+            response = self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True,
+                                        timeout=self.timeout, allow_redirects=True)
+            response.close()
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def _load_state(state_file: str) -> Optional[_PartState]:
+        if not os.path.exists(state_file):
+            return None
+        try:
+            with open(state_file, 'r') as f:
+                return _PartState.model_validate_json(f.read())
+        except Exception as e:
+            logger.warning(f"Ignoring broken download state {state_file}: {e}")
+            return None
+
+    @staticmethod
+    def _save_state(state_file: str, state: _PartState):
+        tmp_file = f'{state_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(state.model_dump_json())
+        os.replace(tmp_file, state_file)
+
+    def _fetch_part(self, url: str, fd: int, part: int, state: _PartState, hasher: _OrderedHasher):
+        start = part * state.part_size
+        end = min(start + state.part_size, state.size) - 1
+        with download_slots:
+            with self.session.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True,
+                                  timeout=self.timeout) as response:
+                if response.status_code != 206:
+                    raise DownloadError(f"Range request {start}-{end} of {url} returned {response.status_code}")
+                offset = start
+                for data in response.iter_content(chunk_size=ModelDownloader.CHUNK_SIZE):
+                    if offset + len(data) > end + 1:
+                        raise DownloadError(f"Range request {start}-{end} of {url} returned too many bytes")
+                    os.pwrite(fd, data, offset)
+                    hasher.feed(offset, data)
+                    offset += len(data)
+                if offset != end + 1:
+                    raise DownloadError(f"Range request {start}-{end} of {url} returned {offset - start} bytes")
+
+    def _download_ranges(self, url: str, part_file: str, state_file: str, state: _PartState) -> str:
+        parts = (state.size + state.part_size - 1) // state.part_size
+        hasher = _OrderedHasher(part_file, state.part_size, state.size)
+        lock = threading.Lock()
+
+        mode = os.O_RDWR | os.O_CREAT
+        fd = os.open(part_file, mode, 0o644)
+        try:
+            os.ftruncate(fd, state.size)
+            for part in state.done:
+                hasher.part_done(part)
+            pending = [part for part in range(parts) if part not in set(state.done)]
+            if len(pending) < parts:
+                logger.info(f"Resuming {url}: {parts - len(pending)}/{parts} parts done")
+
+            def fetch(part: int):
+                self._fetch_part(url, fd, part, state, hasher)
+                with lock:
+                    state.done.append(part)
+                    self._save_state(state_file, state)
+                hasher.part_done(part)
+
+            with ThreadPoolExecutor(max_workers=self.connections_per_file) as executor:
+                for future in [executor.submit(fetch, part) for part in pending]:
+                    future.result()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return hasher.hexdigest()
+
+    def _download_stream(self, url: str, part_file: str) -> str:
+        digest = hashlib.sha256()
+        with download_slots:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                with open(part_file, 'wb') as f:
+                    for data in response.iter_content(chunk_size=ModelDownloader.CHUNK_SIZE):
+                        f.write(data)
+                        digest.update(data)
+        return digest.hexdigest()
+
+    def staging_files(self, dest: str) -> Tuple[str, str]:
+        """ Part and state files of a download to `dest`, keyed by the destination to resume it """
+        key = hashlib.sha1(os.path.abspath(dest).encode()).hexdigest()[:12]
+        part_file = os.path.join(self.workspace.download_path, f'{key}-{os.path.basename(dest)}.part')
+        return part_file, f'{part_file}.json'
+
+    def download(self, url: str, dest: str, size: Optional[int] = None, sha256: Optional[str] = None) -> str:
+        """ Download `url` to `dest`, verify the size and sha256 if given, return the sha256 """
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.makedirs(self.workspace.download_path, exist_ok=True)
+        part_file, state_file = self.staging_files(dest)
+
+        probe = self._probe(url)
+        total = None
+        if probe.status_code == 206 and '/' in probe.headers.get('Content-Range', ''):
+            total = probe.headers['Content-Range'].rsplit('/', 1)[1]
+            total = int(total) if total.isdigit() else None
+        etag = probe.headers.get('ETag', None)
+        if size is not None and total is not None and size != total:
+            raise DownloadError(f"{url} has {total} bytes, expected {size}")
+
+        if total is not None:
+            state = self._load_state(state_file)
+            if (state is None or state.url != url or state.size != total or state.etag != etag
+                    or state.part_size != self.part_size or not os.path.exists(part_file)):
+                # new download, or the remote file changed
+                state = _PartState(url=url, size=total, part_size=self.part_size, etag=etag)
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+                self._save_state(state_file, state)
+            digest = self._download_ranges(url, part_file, state_file, state)
+        else:
+            logger.info(f"{url} does not support range requests, downloading in one stream")
+            digest = self._download_stream(url, part_file)
+
+        actual_size = os.path.getsize(part_file)
+        if (size is not None and actual_size != size) or (sha256 is not None and digest != sha256):
+            for path in (part_file, state_file):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise DownloadError(f"{url} does not match: {actual_size} bytes sha256 {digest}, expected {size} bytes sha256 {sha256}")
+
+        # a rename, unless the models tree is on another file system
+        shutil.move(part_file, dest)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        logger.info(f"Downloaded {url} to {dest} ({actual_size} bytes)")
+        return digest
+
+    def fetch_missing(self, inventory: Inventory, models: List[ModelDependency],
+                      max_files: Optional[int] = None) -> List[ModelDependency]:
+        """ Download the models not in the inventory, files in parallel, return the downloaded models """
+        missing = [
+            model for model in models
+            if inventory.models.get(model.rel_file_path, None) is None
+            and model.url is not None and model.url.startswith(('http://', 'https://'))
+        ]
+        if not missing:
+            return []
+
+        def fetch(model: ModelDependency) -> ModelDependency:
+            dest = os.path.join(self.workspace.model_path, model.rel_file_path)
+            digest = self.download(model.url, dest, size=model.size, sha256=model.sha256)
+            return model.model_copy(update={'sha256': digest, 'size': os.path.getsize(dest)})
+
+        with ThreadPoolExecutor(max_workers=max_files or len(missing)) as executor:
+            return list(executor.map(fetch, missing))
@@ -0,0 +1,184 @@
+""" In-process pub/sub of workflow run events
+Runners publish a RunEvent on every status change and progress update, subscribers receive the
+events of a run, of a workflow or of all runs as soon as they are published, without querying
+the database. Publishing never blocks the runner: every subscriber has a bounded buffer, the oldest
+event is dropped when a slow subscriber falls behind.
+
+    with event_bus.subscribe(run_id=42) as subscription:
+        event = subscription.get(timeout=1)
+
+    async with event_bus.subscribe_async(workflow_id=4) as subscription: # from a coroutine
+        async for event in subscription:
+            ...
+"""
+import asyncio
+import collections
+import itertools
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from pydantic import BaseModel
+
+from .database import WorkflowRunRecord
+
+
+class RunEvent(BaseModel):
+    seq: int = 0 # publication order, assigned by the bus
+    type: str # status, progress
+    run_id: int
+    workflow_id: int
+    status: str
+    updated_at: str | None = None
+    progress_json: str | None = None
+    timestamp: float # publication time, time.time()
+
+
+class Subscription:
+    """ Events of a run, of a workflow or of all runs (no filter), read with get() """
+
+    def __init__(self, bus: 'EventBus', run_id: Optional[int], workflow_id: Optional[int], max_pending: int):
+        self.bus = bus
+        self.run_id = run_id
+        self.workflow_id = workflow_id
+        self.max_pending = max_pending
+        self.dropped = 0 # events dropped because the subscriber fell behind
+        self._events = collections.deque()
+        self._cond = threading.Condition()
+
+    def _deliver(self, event: RunEvent):
+        # called on the publisher thread
+        with self._cond:
+            if len(self._events) >= self.max_pending:
+                self._events.popleft()
+                self.dropped += 1
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[RunEvent]:
+        """ Next event, None on timeout """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._events, timeout=timeout):
+                return None
+            return self._events.popleft()
+
+    def close(self):
+        self.bus._unsubscribe(self)
+
+    def __enter__(self) -> 'Subscription':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class AsyncSubscription(Subscription):
+    """ Subscription read from an event loop, events are handed over to the loop thread """
+
+    def __init__(self, bus: 'EventBus', run_id: Optional[int], workflow_id: Optional[int], max_pending: int,
+                 loop: asyncio.AbstractEventLoop):
+        super().__init__(bus, run_id, workflow_id, max_pending)
+        self.loop = loop
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def _deliver(self, event: RunEvent):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            pass # loop closed, the subscriber is gone
+
+    def _put(self, event: RunEvent):
+        if self._queue.qsize() >= self.max_pending:
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(event)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[RunEvent]:
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> RunEvent:
+        return await self._queue.get()
+
+    async def __aenter__(self) -> 'AsyncSubscription':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class EventBus:
+    """ Subscribers are indexed by run and by workflow, publishing costs the number of interested subscribers """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+        self._by_run: Dict[int, Set[Subscription]] = collections.defaultdict(set)
+        self._by_workflow: Dict[int, Set[Subscription]] = collections.defaultdict(set)
+        self._all: Set[Subscription] = set()
+
+    def _index(self, subscription: Subscription) -> Set[Subscription]:
+        if subscription.run_id is not None:
+            return self._by_run[subscription.run_id]
+        if subscription.workflow_id is not None:
+            return self._by_workflow[subscription.workflow_id]
+        return self._all
+
+    def subscribe(self, run_id: Optional[int] = None, workflow_id: Optional[int] = None,
+                  max_pending: int = 1000) -> Subscription:
+        subscription = Subscription(self, run_id, workflow_id, max_pending)
+        with self._lock:
+            self._index(subscription).add(subscription)
+        return subscription
+
+    def subscribe_async(self, run_id: Optional[int] = None, workflow_id: Optional[int] = None,
+                        max_pending: int = 1000, loop: Optional[asyncio.AbstractEventLoop] = None) -> AsyncSubscription:
+        """ Subscribe from a coroutine, events are read on the event loop (default: the running loop) """
+        loop = loop if loop is not None else asyncio.get_running_loop()
+        subscription = AsyncSubscription(self, run_id, workflow_id, max_pending, loop)
+        with self._lock:
+            self._index(subscription).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscribers = self._index(subscription)
+            subscribers.discard(subscription)
+            # drop empty entries, runs come and go
+            if not subscribers and subscribers is not self._all:
+                if subscription.run_id is not None:
+                    self._by_run.pop(subscription.run_id, None)
+                else:
+                    self._by_workflow.pop(subscription.workflow_id, None)
+
+    def publish(self, event: RunEvent) -> RunEvent:
+        with self._lock:
+            event.seq = next(self._seq)
+            subscribers = list(self._by_run.get(event.run_id, ()))
+            subscribers.extend(self._by_workflow.get(event.workflow_id, ()))
+            subscribers.extend(self._all)
+        for subscription in subscribers:
+            subscription._deliver(event)
+        return event
+
+    def publish_run(self, workflow_run: WorkflowRunRecord, type: str = 'status') -> RunEvent:
+        return self.publish(RunEvent(
+            type=type,
+            run_id=workflow_run.id,
+            workflow_id=workflow_run.workflow_id,
+            status=workflow_run.status,
+            updated_at=workflow_run.updated_at,
+            progress_json=workflow_run.progress_json,
+            timestamp=time.time(),
+        ))
+
+
+# run events of the process
+event_bus = EventBus()
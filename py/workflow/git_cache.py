@@ -0,0 +1,124 @@
+""" Shared git object cache of the workspace
+Code dependencies are cloned once per url into a bare mirror (`<workspace>/git_mirrors`), checkouts
+of workflows are `--shared` clones of the mirror (objects are borrowed through `alternates`, only the
+work tree is written) at the pinned commit. A checkout already at the pinned commit is left untouched.
+Mirrors must not be pruned of commits checkouts still use: they are only fetched into, and automatic gc
+(run by fetch) is turned off on them, so objects no longer reachable from a ref of the remote are kept.
+"""
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import threading
+from typing import Dict
+
+from .gitmeta import read_git_metadata
+from .utils import logger, run_command
+
+try:
+    import fcntl
+except ImportError: # windows
+    fcntl = None
+    import msvcrt
+
+
+def _lock_exclusive(lock_file):
+    """ Lock the open file until it is closed, blocking """
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            pass # LK_LOCK gives up after 10 attempts, keep waiting
+
+
+class GitMirrorCache:
+    """ Bare mirrors keyed by url, and checkouts borrowing their objects
+
+    cache = GitMirrorCache(workspace.git_mirror_path)
+    cache.checkout(url, commit_sha, dest) # False if dest was already at commit_sha
+    """
+
+    def __init__(self, mirror_path: str):
+        self.mirror_path = mirror_path
+        self._lock = threading.Lock()
+        self._url_locks: Dict[str, threading.Lock] = {}
+
+    def mirror_dir(self, url: str) -> str:
+        name = re.sub(r'\.git$', '', url.rstrip('/').rsplit('/', 1)[-1].rsplit(':', 1)[-1]) or 'repo'
+        return os.path.join(self.mirror_path, f'{name}-{hashlib.sha1(url.encode()).hexdigest()[:12]}.git')
+
+    def _url_lock(self, url: str) -> threading.Lock:
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    @staticmethod
+    def has_commit(repo_dir: str, commit_sha: str) -> bool:
+        return subprocess.run(["git", "cat-file", "-e", f"{commit_sha}^{{commit}}"], cwd=repo_dir,
+                              capture_output=True).returncode == 0
+
+    @staticmethod
+    def keep_objects(mirror_dir: str):
+        """ Turn off automatic gc and pruning of the mirror, checkouts depend on its objects """
+        for key, value in (('gc.auto', '0'), ('gc.pruneExpire', 'never'), ('gc.reflogExpireUnreachable', 'never')):
+            subprocess.run(["git", "config", key, value], cwd=mirror_dir, check=True, capture_output=True)
+
+    def mirror(self, url: str, commit_sha: str) -> str:
+        """ Mirror of the url containing commit_sha, cloned or fetched if needed """
+        mirror_dir = self.mirror_dir(url)
+        os.makedirs(self.mirror_path, exist_ok=True)
+        # threads of this process, then other processes (installers) sharing the workspace
+        with self._url_lock(url), open(f'{mirror_dir}.lock', 'w') as lock_file:
+            _lock_exclusive(lock_file)
+            if not os.path.isdir(mirror_dir):
+                logger.info(f"Mirroring {url} to {mirror_dir}")
+                tmp_dir = f'{mirror_dir}.tmp'
+                if os.path.exists(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+                run_command(["git", "clone", "--mirror", url, tmp_dir])
+                self.keep_objects(tmp_dir)
+                os.rename(tmp_dir, mirror_dir)
+            elif not self.has_commit(mirror_dir, commit_sha):
+                logger.info(f"Fetching {url} into {mirror_dir}")
+                self.keep_objects(mirror_dir) # mirrors of older installers
+                run_command(["git", "fetch", "--tags", "origin", "+refs/*:refs/*"], cwd=mirror_dir)
+
+            if not self.has_commit(mirror_dir, commit_sha):
+                raise ValueError(f'Commit {commit_sha} not found in {url}')
+        return mirror_dir
+
+    def checkout(self, url: str, commit_sha: str, dest: str) -> bool:
+        """ Check out commit_sha of url at dest, return False if dest was already there """
+        if not os.path.islink(dest) and os.path.isdir(dest):
+            remote_url, head = read_git_metadata(dest)
+            if head == commit_sha and remote_url == url:
+                logger.info(f"{dest} already at {commit_sha}")
+                return False
+
+        mirror_dir = self.mirror(url, commit_sha)
+
+        if not os.path.islink(dest) and os.path.isdir(os.path.join(dest, '.git')):
+            alternates = os.path.join(dest, '.git', 'objects', 'info', 'alternates')
+            if os.path.exists(alternates):
+                with open(alternates, 'r') as f:
+                    shared = os.path.normpath(os.path.join(mirror_dir, 'objects')) in (
+                        os.path.normpath(line.strip()) for line in f)
+                if shared:
+                    # objects of the mirror are visible to the checkout, only the work tree changes
+                    run_command(["git", "checkout", "--force", "--detach", commit_sha], cwd=dest)
+                    return True
+
+        if os.path.isfile(dest) or os.path.islink(dest):
+            os.remove(dest)
+        elif os.path.isdir(dest):
+            shutil.rmtree(dest)
+
+        run_command(["git", "clone", "--shared", "--no-checkout", mirror_dir, dest])
+        # origin points to the real remote, the inventory compares remote urls
+        run_command(["git", "remote", "set-url", "origin", url], cwd=dest)
+        run_command(["git", "checkout", "--detach", commit_sha], cwd=dest)
+        return True
@@ -0,0 +1,144 @@
+""" Read git metadata of a checkout without spawning git
+HEAD, refs (loose and packed) and the remote url are read straight from the git dir, which is
+orders of magnitude cheaper than `git rev-parse` / `git remote get-url` per module.
+Worktrees and submodules (`.git` file with `gitdir:`) are supported, and repositories that can not
+be read directly (e.g. reftable) fall back to git commands.
+"""
+import os
+import re
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+
+_SECTION = re.compile(r'^\[\s*([^\s\]"]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]$')
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def git_dirs(repo_path: str) -> Optional[Tuple[str, str]]:
+    """ (git dir, common git dir) of a checkout, None if it is not a git checkout """
+    dot_git = os.path.join(repo_path, '.git')
+    if os.path.isdir(dot_git):
+        git_dir = dot_git
+    elif os.path.isfile(dot_git):
+        content = _read(dot_git) or ''
+        if not content.startswith('gitdir:'):
+            return None
+        git_dir = os.path.normpath(os.path.join(repo_path, content[len('gitdir:'):].strip()))
+    else:
+        return None
+
+    common_dir = git_dir
+    commondir = _read(os.path.join(git_dir, 'commondir'))
+    if commondir:
+        common_dir = os.path.normpath(os.path.join(git_dir, commondir))
+    return git_dir, common_dir
+
+
+def _head_ref(git_dir: str) -> Optional[str]:
+    head = _read(os.path.join(git_dir, 'HEAD'))
+    if head is not None and head.startswith('ref:'):
+        return head[len('ref:'):].strip()
+    return None
+
+
+def _packed_refs(common_dir: str) -> Dict[str, str]:
+    refs = {}
+    content = _read(os.path.join(common_dir, 'packed-refs')) or ''
+    for line in content.splitlines():
+        if not line or line.startswith('#') or line.startswith('^'):
+            continue
+        sha, _, ref = line.partition(' ')
+        refs[ref.strip()] = sha
+    return refs
+
+
+def _resolve_ref(git_dir: str, common_dir: str, ref: str, depth: int = 0) -> Optional[str]:
+    if depth > 5:
+        return None
+    # per worktree refs (HEAD, refs/bisect, ...) live in the git dir, shared refs in the common dir
+    for base in (git_dir, common_dir):
+        value = _read(os.path.join(base, ref))
+        if value is None:
+            continue
+        if value.startswith('ref:'):
+            return _resolve_ref(git_dir, common_dir, value[len('ref:'):].strip(), depth + 1)
+        return value
+    return _packed_refs(common_dir).get(ref, None)
+
+
+def read_config(common_dir: str) -> Dict[str, Dict[str, str]]:
+    """ Minimal git config parser, {'remote.origin' -> {'url': ...}} """
+    sections: Dict[str, Dict[str, str]] = {}
+    current = None
+    content = _read(os.path.join(common_dir, 'config')) or ''
+    for raw_line in content.splitlines():
+        line = raw_line.strip()
+        if not line or line[0] in '#;':
+            continue
+        match = _SECTION.match(line)
+        if match:
+            name, sub = match.group(1).lower(), match.group(2)
+            current = sections.setdefault(name if sub is None else f'{name}.{sub}', {})
+            continue
+        if current is None or '=' not in line:
+            continue
+        key, _, value = line.partition('=')
+        current.setdefault(key.strip().lower(), value.strip().strip('"'))
+    return sections
+
+
+def head_stamp(repo_path: str) -> List[Optional[int]]:
+    """ Mtimes of the files HEAD, its ref, remote url depend on; unchanged stamp means unchanged metadata """
+    dirs = git_dirs(repo_path)
+    if dirs is None:
+        return []
+    git_dir, common_dir = dirs
+    ref = _head_ref(git_dir)
+    return [
+        _mtime(os.path.join(git_dir, 'HEAD')),
+        _mtime(os.path.join(common_dir, ref)) if ref else None,
+        _mtime(os.path.join(common_dir, 'packed-refs')),
+        _mtime(os.path.join(common_dir, 'config')),
+    ]
+
+
+def _read_git_metadata_subprocess(repo_path: str) -> Tuple[str, str]:
+    remote_url = subprocess.run(["git", "remote", "get-url", "--push", "origin"], cwd=repo_path, capture_output=True, text=True).stdout.strip()
+    commit_sha = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_path, capture_output=True, text=True).stdout.strip()
+    return remote_url, commit_sha
+
+
+def read_git_metadata(repo_path: str) -> Tuple[str, str]:
+    """ (push url of origin, HEAD commit sha) of a checkout, empty strings when unknown """
+    dirs = git_dirs(repo_path)
+    if dirs is None:
+        return '', ''
+    git_dir, common_dir = dirs
+
+    head = _read(os.path.join(git_dir, 'HEAD'))
+    ref = _head_ref(git_dir)
+    commit_sha = _resolve_ref(git_dir, common_dir, ref) if ref else head
+    if not commit_sha or not re.fullmatch(r'[0-9a-f]{40}([0-9a-f]{24})?', commit_sha):
+        # e.g. reftable repositories, unborn branches
+        logger.debug(f"Can not read git metadata of {repo_path} directly, using git")
+        return _read_git_metadata_subprocess(repo_path)
+
+    origin = read_config(common_dir).get('remote.origin', {})
+    remote_url = origin.get('pushurl', origin.get('url', ''))
+    return remote_url, commit_sha
@@ -0,0 +1,216 @@
+""" GPU allocation of ComfyUI processes
+Devices of the node are discovered with their memory (nvidia-smi, or a fake provider for tests and
+CPU-only nodes). A run leases GPU memory on one device according to the resource requirements of
+its workflow manifest, and the ComfyUI process only sees that device (CUDA_VISIBLE_DEVICES).
+Small workflows are packed onto a shared device (best fit), runs that fit nowhere wait and are placed
+as soon as leases are released. Waiters are placed in arrival order, a later waiter that fits is placed
+before an earlier one that does not (backfill); once the oldest waiter has waited STARVATION_SEC, a device
+is reserved for it, so a stream of small runs can not starve a large one.
+
+    allocator = GpuAllocator(discover_devices())
+    with allocator.allocate(workflow.resources) as lease:
+        run_workflow(..., env=lease.env)
+"""
+import shutil
+import subprocess
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+from loguru import logger
+
+from .dao import ResourceRequirements
+
+
+class GpuDevice(BaseModel):
+    index: int
+    name: str = 'gpu'
+    memory_total_mb: int
+
+
+class DeviceProvider(ABC):
+    @abstractmethod
+    def discover(self) -> List[GpuDevice]:
+        pass
+
+
+class NvidiaSmiProvider(DeviceProvider):
+    """ CUDA devices of the node, none if nvidia-smi is not available """
+
+    def discover(self) -> List[GpuDevice]:
+        if shutil.which('nvidia-smi') is None:
+            return []
+        try:
+            result = subprocess.run(
+                ['nvidia-smi', '--query-gpu=index,name,memory.total', '--format=csv,noheader,nounits'],
+                capture_output=True, text=True, check=True, timeout=30)
+        except (subprocess.SubprocessError, OSError) as e:
+            logger.warning(f"Error listing GPUs with nvidia-smi: {e}")
+            return []
+        devices = []
+        for line in result.stdout.strip().splitlines():
+            index, name, memory_total_mb = [v.strip() for v in line.split(',')]
+            devices.append(GpuDevice(index=int(index), name=name, memory_total_mb=int(memory_total_mb)))
+        return devices
+
+
+class FakeDeviceProvider(DeviceProvider):
+    """ Simulated devices, e.g. FakeDeviceProvider([24576, 24576]) for two 24GB GPUs """
+
+    def __init__(self, memory_total_mb: List[int]):
+        self.devices = [GpuDevice(index=i, name='fake', memory_total_mb=m) for i, m in enumerate(memory_total_mb)]
+
+    def discover(self) -> List[GpuDevice]:
+        return list(self.devices)
+
+
+def discover_devices(provider: Optional[DeviceProvider] = None) -> List[GpuDevice]:
+    return (provider if provider is not None else NvidiaSmiProvider()).discover()
+
+
+class GpuLease:
+    """ GPU memory of a run on a device, None on a node without GPU """
+
+    def __init__(self, allocator: 'GpuAllocator', device: Optional[GpuDevice], memory_mb: int, exclusive: bool):
+        self.allocator = allocator
+        self.device = device
+        self.memory_mb = memory_mb
+        self.exclusive = exclusive
+        self.released = False
+
+    @property
+    def env(self) -> Dict[str, str]:
+        """ Env vars of the ComfyUI process, only the leased device is visible """
+        if self.device is None:
+            return {}
+        return {'CUDA_VISIBLE_DEVICES': str(self.device.index)}
+
+    def release(self):
+        self.allocator.release(self)
+
+    def __enter__(self) -> 'GpuLease':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class _Waiter:
+    def __init__(self, memory_mb: int, exclusive: bool):
+        self.memory_mb = memory_mb
+        self.exclusive = exclusive
+        self.device: Optional[GpuDevice] = None
+        self.arrived_at = time.monotonic()
+
+
+class GpuAllocator:
+    """ Place runs on devices by GPU memory, runs that do not fit are queued """
+
+    STARVATION_SEC = 30 # wait of the oldest waiter before a device is reserved for it
+
+    def __init__(self, devices: List[GpuDevice], reserved_mb: int = 0):
+        self.devices = devices
+        self.reserved_mb = reserved_mb # kept free on every device, e.g. for the CUDA context
+        self._lock = threading.Condition()
+        self._used_mb: Dict[int, int] = {d.index: 0 for d in devices}
+        self._leases: Dict[int, int] = {d.index: 0 for d in devices}
+        self._exclusive: Dict[int, bool] = {d.index: False for d in devices}
+        self._waiters: List[_Waiter] = []
+
+    def _capacity(self, device: GpuDevice) -> int:
+        return device.memory_total_mb - self.reserved_mb
+
+    def _memory_of(self, requirements: ResourceRequirements) -> int:
+        # unknown requirements reserve a whole device, a guess would oversubscribe it
+        return requirements.gpu_memory_mb if requirements.gpu_memory_mb > 0 else max(
+            self._capacity(d) for d in self.devices)
+
+    def _place(self, memory_mb: int, exclusive: bool, reserved: Optional[int] = None) -> Optional[GpuDevice]:
+        # best fit: the busiest device that still fits, free devices are kept for large workflows
+        candidates = [
+            d for d in self.devices
+            if d.index != reserved
+            and not self._exclusive[d.index]
+            and not (exclusive and self._leases[d.index])
+            and self._used_mb[d.index] + memory_mb <= self._capacity(d)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda d: (self._capacity(d) - self._used_mb[d.index] - memory_mb, d.index))
+
+    def _assign(self, device: GpuDevice, memory_mb: int, exclusive: bool):
+        self._used_mb[device.index] += memory_mb
+        self._leases[device.index] += 1
+        self._exclusive[device.index] = exclusive
+
+    def _reserve(self, memory_mb: int) -> int:
+        # the least used device large enough, it is the first to free up the memory
+        return min((d for d in self.devices if memory_mb <= self._capacity(d)),
+                   key=lambda d: (self._used_mb[d.index], d.index)).index
+
+    def _grant_waiters(self):
+        # in arrival order, a waiter that fits is placed even if an earlier one does not (backfill),
+        # except on the device reserved for the oldest waiter that waited too long
+        reserved: Optional[int] = None
+        now = time.monotonic()
+        for waiter in self._waiters:
+            if waiter.device is not None:
+                continue
+            device = self._place(waiter.memory_mb, waiter.exclusive, reserved=reserved)
+            if device is not None:
+                self._assign(device, waiter.memory_mb, waiter.exclusive)
+                waiter.device = device
+            elif reserved is None and now - waiter.arrived_at >= GpuAllocator.STARVATION_SEC:
+                reserved = self._reserve(waiter.memory_mb)
+        self._lock.notify_all()
+
+    def allocate(self, requirements: Optional[ResourceRequirements] = None, timeout: Optional[float] = None) -> GpuLease:
+        """ Lease GPU memory for a run, wait until a device fits, TimeoutError after `timeout` """
+        requirements = requirements if requirements is not None else ResourceRequirements()
+        if not self.devices:
+            return GpuLease(self, None, 0, requirements.exclusive)
+
+        memory_mb = self._memory_of(requirements)
+        if not any(memory_mb <= self._capacity(d) for d in self.devices):
+            raise ValueError(f"No device has {memory_mb}MB of GPU memory: {self.devices}")
+
+        waiter = _Waiter(memory_mb, requirements.exclusive)
+        started = time.monotonic()
+        with self._lock:
+            self._waiters.append(waiter)
+            self._grant_waiters()
+            try:
+                if not self._lock.wait_for(lambda: waiter.device is not None, timeout=timeout):
+                    raise TimeoutError(f"No GPU with {memory_mb}MB free after {timeout}s")
+            finally:
+                self._waiters.remove(waiter)
+
+        waited = time.monotonic() - started
+        if waited > 1:
+            logger.info(f"Waited {waited:.1f}s for {memory_mb}MB on GPU {waiter.device.index}")
+        return GpuLease(self, waiter.device, memory_mb, requirements.exclusive)
+
+    def release(self, lease: GpuLease):
+        if lease.released or lease.device is None:
+            lease.released = True
+            return
+        with self._lock:
+            lease.released = True
+            index = lease.device.index
+            self._used_mb[index] -= lease.memory_mb
+            self._leases[index] -= 1
+            if self._leases[index] == 0:
+                self._exclusive[index] = False
+            self._grant_waiters()
+
+    def usage(self) -> List[Dict]:
+        """ Leased memory and runs per device, and the runs waiting for a device """
+        with self._lock:
+            return [
+                {'index': d.index, 'memory_total_mb': d.memory_total_mb, 'memory_used_mb': self._used_mb[d.index],
+                 'leases': self._leases[d.index], 'waiting': sum(1 for w in self._waiters if w.device is None)}
+                for d in self.devices
+            ]
@@ -0,0 +1,210 @@
+""" Content addressed model store
+Models stay where ComfyUI expects them (`models/<category>/...`), and every model file is also
+hard linked into the store by content: `models/.store/sha256/<digest>`.
+    - the hash index (`models/.store/index.json`) maps model files to sha256 and size, a file is
+      re-hashed only when its size, mtime or inode changes
+    - hashing streams files in large chunks, files are hashed in parallel (hashlib releases the GIL)
+    - dedup replaces identical files stored under different names by hard links to one blob
+Workflows link models by digest, so renaming a model file does not break installed workflows.
+Hard linked files share their content, model files must be replaced, never modified in place.
+"""
+import json
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+from loguru import logger
+
+from .dao import Inventory, Workspace, MODEL_STORE_DIR
+from .streams import sha256_file
+
+
+class StoredModel(BaseModel):
+    """ Hash index entry of a model file """
+    size: int
+    mtime_ns: int
+    ino: int
+    sha256: str
+
+
+class ModelStore:
+    """ Hash index and blobs of the models of a workspace
+
+    store = ModelStore(workspace)
+    store.scan() # hash new or changed model files
+    store.dedup() # hard link duplicates to one blob
+    store.blob_path(digest)
+    """
+
+    STORE_DIR = MODEL_STORE_DIR
+
+    def __init__(self, workspace: Workspace, max_workers: Optional[int] = None):
+        self.workspace = workspace
+        self.model_path = workspace.model_path
+        self.store_path = os.path.join(self.model_path, ModelStore.STORE_DIR)
+        self.max_workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self.index: Dict[str, StoredModel] = self._load_index() # {model rel path -> entry}
+
+    @property
+    def index_file(self) -> str:
+        return os.path.join(self.store_path, 'index.json')
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.store_path, 'sha256', digest)
+
+    def _load_index(self) -> Dict[str, StoredModel]:
+        if not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, 'r') as f:
+                return {rel_path: StoredModel(**entry) for rel_path, entry in json.load(f).items()}
+        except Exception as e:
+            logger.warning(f"Can not load model hash index {self.index_file}, rehashing: {e}")
+            return {}
+
+    def _save_index(self):
+        os.makedirs(self.store_path, exist_ok=True)
+        tmp_file = f'{self.index_file}.{uuid.uuid4()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({rel_path: entry.model_dump() for rel_path, entry in self.index.items()}, f)
+        os.replace(tmp_file, self.index_file)
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        """ sha256 of a file, streamed in large chunks """
+        return sha256_file(path)
+
+    def _list_models(self) -> Dict[str, os.stat_result]:
+        """ Non-empty model files, symlinks are not followed, the store itself is skipped """
+        models = {}
+        for root, dirs, files in os.walk(self.model_path):
+            if root == self.model_path and ModelStore.STORE_DIR in dirs:
+                dirs.remove(ModelStore.STORE_DIR)
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    continue
+                st = os.stat(path)
+                if st.st_size > 0:
+                    models[os.path.relpath(path, self.model_path)] = st
+        return models
+
+    def _link_blob(self, path: str, entry: StoredModel):
+        blob = self.blob_path(entry.sha256)
+        if os.path.exists(blob):
+            return
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+        except FileExistsError:
+            pass
+
+    def _drop_blob_if_modified(self, entry: StoredModel, st: os.stat_result):
+        if st.st_ino != entry.ino:
+            # the file was replaced, the blob still has the indexed content
+            return
+        # the file was modified in place, the blob (same inode) no longer has the indexed content
+        blob = self.blob_path(entry.sha256)
+        try:
+            if os.stat(blob).st_ino == entry.ino:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+
+    def scan(self, full: bool = False) -> Dict[str, StoredModel]:
+        """ Hash new and changed model files (all files if `full`), persist and return the index """
+        models = self._list_models()
+        to_hash = []
+        index = {}
+        for rel_path, st in models.items():
+            entry = self.index.get(rel_path, None)
+            if (not full and entry is not None
+                    and (entry.size, entry.mtime_ns, entry.ino) == (st.st_size, st.st_mtime_ns, st.st_ino)):
+                index[rel_path] = entry
+            else:
+                if entry is not None:
+                    self._drop_blob_if_modified(entry, st)
+                to_hash.append(rel_path)
+
+        if to_hash:
+            total = sum(models[rel_path].st_size for rel_path in to_hash)
+            logger.info(f"Hashing {len(to_hash)} model files ({total} bytes) with {self.max_workers} workers")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                digests = executor.map(lambda p: self.hash_file(os.path.join(self.model_path, p)), to_hash)
+                for rel_path, digest in zip(to_hash, digests):
+                    st = models[rel_path]
+                    index[rel_path] = StoredModel(size=st.st_size, mtime_ns=st.st_mtime_ns, ino=st.st_ino, sha256=digest)
+
+        for rel_path, entry in index.items():
+            self._link_blob(os.path.join(self.model_path, rel_path), entry)
+
+        with self._lock:
+            self.index = index
+            self._save_index()
+        return index
+
+    def duplicates(self) -> Dict[str, List[str]]:
+        """ {digest -> model files} of digests stored in more than one inode """
+        by_digest: Dict[str, List[str]] = {}
+        for rel_path, entry in self.index.items():
+            by_digest.setdefault(entry.sha256, []).append(rel_path)
+        return {
+            digest: sorted(paths) for digest, paths in by_digest.items()
+            if len({self.index[p].ino for p in paths}) > 1
+        }
+
+    def dedup(self) -> int:
+        """ Replace duplicated model files by hard links to their blob, return the bytes saved """
+        saved = 0
+        for digest, rel_paths in self.duplicates().items():
+            blob = self.blob_path(digest)
+            blob_ino = os.stat(blob).st_ino
+            for rel_path in rel_paths:
+                entry = self.index[rel_path]
+                if entry.ino == blob_ino:
+                    continue
+                path = os.path.join(self.model_path, rel_path)
+                tmp_path = f'{path}.{uuid.uuid4()}.tmp'
+                os.link(blob, tmp_path)
+                os.replace(tmp_path, path)
+                st = os.stat(path)
+                self.index[rel_path] = StoredModel(size=st.st_size, mtime_ns=st.st_mtime_ns, ino=st.st_ino, sha256=digest)
+                saved += entry.size
+                logger.info(f"Deduplicated {rel_path} -> {digest}")
+        with self._lock:
+            self._save_index()
+        return saved
+
+    def gc(self) -> int:
+        """ Remove blobs no model file links to, return the bytes freed """
+        freed = 0
+        blob_dir = os.path.join(self.store_path, 'sha256')
+        if not os.path.isdir(blob_dir):
+            return freed
+        for dir_entry in os.scandir(blob_dir):
+            st = dir_entry.stat(follow_symlinks=False)
+            if st.st_nlink == 1:
+                os.remove(dir_entry.path)
+                freed += st.st_size
+        return freed
+
+    def annotate(self, inventory: Inventory) -> Inventory:
+        """ Set sha256 and size of the inventory models from the hash index """
+        for _, model in inventory.models.values():
+            entry = self.index.get(model.rel_file_path, None)
+            if entry is not None:
+                model.sha256 = entry.sha256
+                model.size = entry.size
+        return inventory
+
+
+if __name__ == "__main__":
+    import sys
+    store = ModelStore(Workspace(base_path=sys.argv[1]))
+    store.scan(full='--full' in sys.argv)
+    if '--dedup' in sys.argv:
+        print(f'[INFO] Saved {store.dedup()} bytes')
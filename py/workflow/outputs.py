@@ -0,0 +1,65 @@
+""" Output manifest of a prompt
+ComfyUI lists the files every output node produced in the `outputs` section of the prompt history:
+    {node_id: {'images': [{'filename': ..., 'subfolder': ..., 'type': 'output'}], 'gifs': [...], ...}}
+The manifest resolves them to files of the run, with size and sha256, so consumers fetch exactly the
+produced artifacts (no walk of the output dir) and can skip re-uploading identical outputs.
+"""
+import os
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+from loguru import logger
+
+from .streams import sha256_file
+
+
+class OutputFile(BaseModel):
+    node_id: str
+    kind: str # output key of the node, e.g. images, gifs, audio
+    filename: str
+    subfolder: str = ''
+    type: str = 'output' # output or temp (previews)
+    path: str
+    size: int
+    sha256: str
+
+    @property
+    def rel_path(self) -> str:
+        """ Path relative to the run output (or temp) dir """
+        return os.path.join(self.subfolder, self.filename) if self.subfolder else self.filename
+
+
+def build_output_manifest(history: Dict, output_dir: str, temp_dir: Optional[str] = None) -> List[OutputFile]:
+    """ Files produced by a prompt, from its history entry; temp files only if `temp_dir` is given """
+    base_dirs = {'output': output_dir}
+    if temp_dir is not None:
+        base_dirs['temp'] = temp_dir
+
+    manifest = []
+    seen = set()
+    for node_id, node_outputs in (history.get('outputs', None) or {}).items():
+        for kind, items in (node_outputs or {}).items():
+            if not isinstance(items, list):
+                continue
+            for item in items:
+                if not isinstance(item, dict) or 'filename' not in item:
+                    continue # e.g. text outputs
+                file_type = item.get('type', 'output')
+                base_dir = base_dirs.get(file_type, None)
+                if base_dir is None:
+                    continue
+                subfolder = item.get('subfolder', '') or ''
+                path = os.path.normpath(os.path.join(base_dir, subfolder, item['filename']))
+                if os.path.commonpath([path, os.path.normpath(base_dir)]) != os.path.normpath(base_dir):
+                    logger.warning(f"Ignoring output outside of {base_dir}: {path}")
+                    continue
+                if path in seen:
+                    continue
+                if not os.path.isfile(path):
+                    logger.warning(f"Output {path} of node {node_id} not found")
+                    continue
+                seen.add(path)
+                manifest.append(OutputFile(
+                    node_id=str(node_id), kind=kind, filename=item['filename'], subfolder=subfolder,
+                    type=file_type, path=path, size=os.path.getsize(path), sha256=sha256_file(path)))
+    return manifest
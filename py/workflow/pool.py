@@ -0,0 +1,217 @@
+""" Pool of warm ComfyUI servers
+Launching ComfyUI (python imports, custom nodes, model loading) dominates the latency of a
+workflow run. The pool keeps servers of each workflow alive between runs and leases a ready
+server to a workflow run, the server is switched to the run input/output dirs without restart.
+"""
+import os
+import time
+import uuid
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+from loguru import logger
+
+from .dao import Workflow, Workspace
+from .database import WorkflowRunRecord
+from .server import ComfyUIServer
+
+
+class PoolConfig(BaseModel):
+    min_size: int = Field(default=0, description='warm servers kept per workflow, even when idle')
+    max_size: int = Field(default=1, description='max servers per workflow')
+    idle_timeout_sec: float = Field(default=600, description='stop servers idle for longer than this')
+    startup_timeout_sec: float = Field(default=600, description='max time to wait for a new server to be ready')
+    evict_interval_sec: float = Field(default=30, description='how often idle servers are checked')
+
+
+class _PooledServer:
+    """ Book keeping of a server in the pool """
+
+    def __init__(self, server: ComfyUIServer):
+        self.server = server
+        self.busy = True # a new server is reserved by the lease that creates it
+        self.last_used = time.monotonic()
+
+
+class ComfyUIServerPool:
+    """ Keep warm ComfyUI servers per workflow manifest and lease them to workflow runs
+
+    pool = ComfyUIServerPool(workspace, PoolConfig(max_size=2))
+    server = pool.lease(workflow, workflow_run) # a ready server bound to the workflow run
+    ...
+    pool.release(server)
+    """
+
+    def __init__(self, workspace: Workspace, config: Optional[PoolConfig] = None,
+                 server_factory: Optional[Callable[[Workflow, str, Dict[str, str]], ComfyUIServer]] = None):
+        self.workspace = workspace
+        self.config = config if config is not None else PoolConfig()
+        self.server_factory = server_factory if server_factory is not None else self._create_server
+
+        self._lock = threading.Condition()
+        self._servers: Dict[Tuple, List[_PooledServer]] = {} # {(workflow dir, env) -> servers}
+        self._closed = False
+
+        self._evictor = threading.Thread(target=self._evict_loop, daemon=True)
+        self._evictor.start()
+
+    @staticmethod
+    def _key(workflow: Workflow, env: Optional[Dict[str, str]] = None) -> Tuple:
+        # a workflow is identified by its installation directory,
+        # servers with different env (e.g. CUDA devices) are not interchangeable
+        return (workflow.workflow_dir, tuple(sorted((env or {}).items())))
+
+    def _create_server(self, workflow: Workflow, home_dir: str, env: Dict[str, str]) -> ComfyUIServer:
+        return ComfyUIServer(workflow, home_dir=home_dir, shared=True, env=env)
+
+    def _start_server(self, workflow: Workflow, env: Optional[Dict[str, str]]) -> _PooledServer:
+        home_dir = os.path.join(self.workspace.server_path, str(uuid.uuid4()))
+        entry = _PooledServer(self.server_factory(workflow, home_dir, dict(env or {})))
+        logger.info(f"Starting pooled ComfyUI server for {self._key(workflow, env)} in {home_dir}")
+        return entry
+
+    def _remove(self, key: Tuple, entry: _PooledServer):
+        servers = self._servers.get(key, [])
+        if entry in servers:
+            servers.remove(entry)
+        if not servers:
+            self._servers.pop(key, None)
+
+    def lease(self, workflow: Workflow, workflow_run: WorkflowRunRecord,
+              timeout: Optional[float] = None, env: Optional[Dict[str, str]] = None) -> ComfyUIServer:
+        """ Lease a ready server of the workflow (and env), start one if the pool is not full,
+        otherwise wait for a server to be released
+        """
+        key = self._key(workflow, env)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        entry = None
+        with self._lock:
+            while entry is None:
+                if self._closed:
+                    raise RuntimeError("ComfyUI server pool is shut down")
+
+                servers = self._servers.setdefault(key, [])
+                for candidate in list(servers):
+                    if candidate.busy:
+                        continue
+                    if not candidate.server.is_alive():
+                        logger.warning(f"Dropping dead ComfyUI server {candidate.server.home_dir}")
+                        self._remove(key, candidate)
+                        continue
+                    candidate.busy = True
+                    entry = candidate
+                    break
+
+                if entry is None and len(servers) < self.config.max_size:
+                    # reserve a slot, start the server outside of the lock
+                    entry = self._start_server(workflow, env)
+                    servers.append(entry)
+                    break
+
+                if entry is None:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"No ComfyUI server available for {key} after {timeout}s")
+                    self._lock.wait(remaining)
+
+        server = entry.server
+        if server.process is None:
+            try:
+                server.start()
+                server.wait_until_ready(timeout=self.config.startup_timeout_sec)
+            except Exception:
+                server.stop()
+                with self._lock:
+                    self._remove(key, entry)
+                    self._lock.notify_all()
+                raise
+
+        server.bind(workflow_run)
+        logger.info(f"Leased ComfyUI server {server.host}:{server.port} to workflow run {workflow_run.id}")
+        return server
+
+    def release(self, server: ComfyUIServer):
+        """ Return a leased server to the pool, dead servers are dropped """
+        with self._lock:
+            for key, servers in list(self._servers.items()):
+                for entry in servers:
+                    if entry.server is not server:
+                        continue
+                    server.unbind()
+                    entry.busy = False
+                    entry.last_used = time.monotonic()
+                    if self._closed or not server.is_alive():
+                        server.stop()
+                        self._remove(key, entry)
+                    self._lock.notify_all()
+                    return
+        logger.warning(f"Releasing unknown ComfyUI server {server.home_dir}, stopping it")
+        server.stop()
+
+    def warm_up(self, workflow: Workflow, env: Optional[Dict[str, str]] = None):
+        """ Start servers until the workflow has `min_size` servers """
+        key = self._key(workflow, env)
+        while True:
+            with self._lock:
+                servers = self._servers.setdefault(key, [])
+                if self._closed or len(servers) >= min(self.config.min_size, self.config.max_size):
+                    return
+                entry = self._start_server(workflow, env)
+                servers.append(entry)
+            try:
+                entry.server.start()
+                entry.server.wait_until_ready(timeout=self.config.startup_timeout_sec)
+            except Exception:
+                entry.server.stop()
+                with self._lock:
+                    self._remove(key, entry)
+                raise
+            with self._lock:
+                entry.busy = False
+                entry.last_used = time.monotonic()
+                self._lock.notify_all()
+
+    def evict_idle(self):
+        """ Stop servers idle for longer than `idle_timeout_sec`, keep `min_size` per workflow """
+        to_stop = []
+        now = time.monotonic()
+        with self._lock:
+            for key, servers in list(self._servers.items()):
+                for entry in list(servers):
+                    if entry.busy:
+                        continue
+                    if not entry.server.is_alive():
+                        to_stop.append(entry.server)
+                        self._remove(key, entry)
+                    elif len(servers) > self.config.min_size and now - entry.last_used > self.config.idle_timeout_sec:
+                        to_stop.append(entry.server)
+                        self._remove(key, entry)
+        for server in to_stop:
+            logger.info(f"Evicting idle ComfyUI server {server.host}:{server.port}")
+            server.stop()
+
+    def _evict_loop(self):
+        while True:
+            with self._lock:
+                self._lock.wait_for(lambda: self._closed, timeout=self.config.evict_interval_sec)
+                if self._closed:
+                    return
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error(f"Error evicting idle ComfyUI servers: {e}")
+
+    def shutdown(self):
+        """ Stop all idle servers, leased servers are stopped when released """
+        with self._lock:
+            self._closed = True
+            idle = []
+            for key, servers in list(self._servers.items()):
+                for entry in list(servers):
+                    if not entry.busy:
+                        idle.append(entry.server)
+                        self._remove(key, entry)
+            self._lock.notify_all()
+        for server in idle:
+            server.stop()
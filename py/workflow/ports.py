@@ -0,0 +1,124 @@
+""" Port allocation of ComfyUI servers
+Ports are handed out in order from the node port range, a port is leased until the server is stopped:
+    - a lock file per port (flock) is held by the lease, other processes of the node skip the port,
+      the lock goes away with the process if it dies
+    - the port is bound (not listening) until the server is launched, ports used by other programs
+      are skipped
+"""
+import errno
+import os
+import socket
+import tempfile
+import threading
+from typing import Optional, Set
+
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError: # windows, ports are only leased within the process
+    fcntl = None
+
+
+# ports of ComfyUI servers on the node, give processes disjoint ranges to avoid lock contention
+PORT_RANGE = os.environ.get('COMFYUI_PORT_RANGE', '8189-49151')
+PORT_LOCK_DIR = os.environ.get('COMFYUI_PORT_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'comfyui_ports'))
+
+
+class PortsExhausted(RuntimeError):
+    """ No free port in the range """
+
+
+class PortLease:
+    """ A port reserved for a ComfyUI server, release() when the server is stopped """
+
+    def __init__(self, allocator: 'PortAllocator', port: int, lock_fd: int, hold: socket.socket):
+        self.allocator = allocator
+        self.port = port
+        self._lock_fd: Optional[int] = lock_fd
+        self._hold: Optional[socket.socket] = hold
+
+    def unhold(self):
+        """ Unbind the port right before the server binds it, the port stays leased """
+        if self._hold is not None:
+            self._hold.close()
+            self._hold = None
+
+    def release(self):
+        self.unhold()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd) # drops the flock
+            self._lock_fd = None
+            self.allocator._release(self.port)
+
+    @property
+    def released(self) -> bool:
+        return self._lock_fd is None
+
+
+class PortAllocator:
+
+    def __init__(self, port_range: str = PORT_RANGE, lock_dir: str = PORT_LOCK_DIR, host: str = '0.0.0.0'):
+        first, last = (int(p) for p in port_range.split('-'))
+        assert 0 < first <= last < 65536, f'Invalid port range {port_range}'
+        self.first = first
+        self.last = last
+        self.lock_dir = lock_dir
+        self.host = host
+        self._lock = threading.Lock()
+        self._leased: Set[int] = set()
+        self._next = first # next port to try, ports are not reused right after release (TIME_WAIT)
+
+    def _lock_port(self, port: int) -> Optional[int]:
+        fd = os.open(os.path.join(self.lock_dir, f'{port}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is None:
+            return fd
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except OSError as e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+
+    def _bind(self, port: int) -> Optional[socket.socket]:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind(('' if self.host == '0.0.0.0' else self.host, port))
+            return sock
+        except OSError:
+            sock.close()
+            return None
+
+    def reserve(self) -> PortLease:
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with self._lock:
+            for _ in range(self.last - self.first + 1):
+                port = self._next
+                self._next = self.first if port == self.last else port + 1
+                if port in self._leased:
+                    continue
+                lock_fd = self._lock_port(port)
+                if lock_fd is None:
+                    continue # leased by another process of the node
+                hold = self._bind(port)
+                if hold is None:
+                    os.close(lock_fd)
+                    continue # used by another program
+                self._leased.add(port)
+                return PortLease(self, port, lock_fd, hold)
+        raise PortsExhausted(f"No free port in {self.first}-{self.last}, {len(self._leased)} leased by this process")
+
+    def _release(self, port: int):
+        with self._lock:
+            self._leased.discard(port)
+        logger.debug(f"Released port {port}")
+
+    def leased(self) -> Set[int]:
+        with self._lock:
+            return set(self._leased)
+
+
+# ports of the ComfyUI servers of the process
+port_allocator = PortAllocator()
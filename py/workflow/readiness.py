@@ -0,0 +1,166 @@
+""" Readiness of a starting ComfyUI server
+Probe the server with short timed requests, starting sub-second and backing off exponentially,
+stop as soon as the server process exits, and fail when the startup deadline passes.
+Startup latency of every server is recorded in a histogram per workflow to track cold starts.
+"""
+import asyncio
+import bisect
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+
+
+class ServerStartupError(RuntimeError):
+    """ ComfyUI server failed to become ready """
+
+
+class StartupHistogram:
+    """ Startup latency histogram, cumulative bucket counts like Prometheus histograms """
+
+    BUCKETS_SEC = [0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300]
+
+    def __init__(self, buckets: Optional[List[float]] = None):
+        self.buckets = buckets if buckets is not None else StartupHistogram.BUCKETS_SEC
+        self.counts = [0] * (len(self.buckets) + 1) # last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.failures = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def snapshot(self) -> Dict:
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'count': self.count, 'sum': self.sum, 'failures': self.failures}
+
+
+class StartupMetrics:
+    """ Startup latency histograms keyed by workflow """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, StartupHistogram] = {}
+
+    def _histogram(self, workflow: str) -> StartupHistogram:
+        return self._histograms.setdefault(workflow, StartupHistogram())
+
+    def observe(self, workflow: str, seconds: float):
+        with self._lock:
+            self._histogram(workflow).observe(seconds)
+
+    def observe_failure(self, workflow: str):
+        with self._lock:
+            self._histogram(workflow).failures += 1
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {workflow: h.snapshot() for workflow, h in self._histograms.items()}
+
+
+# process wide startup metrics
+startup_metrics = StartupMetrics()
+
+
+class ReadinessProbe:
+    """ Wait for a ComfyUI server process to accept requests
+
+    probe = ReadinessProbe(service, process, deadline_sec=300)
+    elapsed = probe.wait() # raise ServerStartupError on early exit or deadline
+
+    With an AsyncComfyService and an asyncio subprocess, `await probe.wait_async()` probes on the event loop.
+    """
+
+    INITIAL_INTERVAL_SEC = 0.1
+    MAX_INTERVAL_SEC = 2
+    BACKOFF = 2
+    PROBE_TIMEOUT_SEC = 1 # a hung server must not block the probe
+    DEADLINE_SEC = 300
+
+    def __init__(self, service, process, deadline_sec: Optional[float] = None, log_file: Optional[str] = None):
+        self.service = service # ComfyService, or AsyncComfyService for wait_async()
+        self.process = process # subprocess.Popen, or asyncio.subprocess.Process for wait_async()
+        self.deadline_sec = deadline_sec if deadline_sec is not None else ReadinessProbe.DEADLINE_SEC
+        self.log_file = log_file
+
+    def _exited(self) -> bool:
+        if self.process is None:
+            return True
+        if isinstance(self.process, subprocess.Popen):
+            return self.process.poll() is not None
+        return self.process.returncode is not None
+
+    def _sleep(self, seconds: float):
+        # wake up immediately if the process exits while waiting
+        if self.process is None:
+            time.sleep(seconds)
+            return
+        try:
+            self.process.wait(timeout=seconds)
+        except subprocess.TimeoutExpired:
+            pass
+
+    async def _sleep_async(self, seconds: float):
+        if self.process is None:
+            await asyncio.sleep(seconds)
+            return
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def _start(self):
+        self._started = time.monotonic()
+        self._deadline = self._started + self.deadline_sec
+        self._interval = ReadinessProbe.INITIAL_INTERVAL_SEC
+        self._attempts = 0
+
+    def _check_exited(self):
+        if self._exited():
+            returncode = None if self.process is None else self.process.returncode
+            raise ServerStartupError(
+                f"ComfyUI server exited with code {returncode} before ready, please check logs in {self.log_file}")
+        self._attempts += 1
+
+    def _ready(self) -> float:
+        elapsed = time.monotonic() - self._started
+        logger.info(f"ComfyUI server {self.service.host}:{self.service.port} ready in {elapsed:.2f}s after {self._attempts} probes")
+        return elapsed
+
+    def _next_sleep(self) -> float:
+        """ Wait before the next probe, backing off, ServerStartupError past the deadline """
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            raise ServerStartupError(
+                f"ComfyUI server {self.service.host}:{self.service.port} not ready after {self.deadline_sec}s")
+        logger.debug(f"Waiting for ComfyUI server to be ready: {self.service.host}:{self.service.port}")
+        seconds = min(self._interval, remaining)
+        self._interval = min(self._interval * ReadinessProbe.BACKOFF, ReadinessProbe.MAX_INTERVAL_SEC)
+        return seconds
+
+    def wait(self) -> float:
+        """ Block until the server is ready, return the startup latency in seconds """
+        self._start()
+        while True:
+            self._check_exited()
+            if self.service.is_server_ready(timeout=ReadinessProbe.PROBE_TIMEOUT_SEC):
+                return self._ready()
+            self._sleep(self._next_sleep())
+
+    async def wait_async(self) -> float:
+        """ Same probing as wait(), without blocking the event loop """
+        self._start()
+        while True:
+            self._check_exited()
+            if await self.service.is_server_ready(timeout=ReadinessProbe.PROBE_TIMEOUT_SEC):
+                return self._ready()
+            await self._sleep_async(self._next_sleep())
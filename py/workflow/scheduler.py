@@ -2,34 +2,63 @@
 import os
 import boto3
 from datetime import datetime
-from typing import Dict
+from typing import Callable, Dict, List, Optional
 import io
 import time
 import uuid
 import json
 import shutil
+import signal
+import sys
 from boto3.dynamodb.conditions import Key, Attr
 
 from .dao import Workspace, reconstruct_workflow, reconstruct_inventory, get_workflow_manifest
-from .controller import run_workflow 
+from .controller import run_workflow, run_workflow_batch, InputSet
+from .pool import ComfyUIServerPool, PoolConfig
+from .server import cleanup
+from .template import compile_workflow
+from .streams import copy_stream, LazyFile
+from .cache import workflow_cache
+from .outputs import OutputFile
+from .gpu import GpuAllocator, discover_devices
+from .admission import admission_controller, AdmissionRejected, Ticket
+from .tracing import tracer, Trace
+from .slots import SlotConfig, SlotScheduler
 from loguru import logger
+from pydantic import BaseModel, Field
 
 from .database import *
 
 from job_queue import JobQueue, DynamoDBJobQueue, SingleThreadJobScheduler, EchoWorkflow, Workflow, JobRequest, JobResponse, File
 
 def write_input_file(input_file_path, file: File):
-    # make directory if not exist
-    os.makedirs(os.path.dirname(input_file_path), exist_ok=True)
-    
-    # write input buffer to file on disk
-    with open(input_file_path, 'wb') as f:
-        f.write(file.content.read())
+    # stream the input to file on disk in chunks, memory is bounded whatever the file size
+    copy_stream(file.content, input_file_path)
     
 
+def resolve_input_override(workflow_dir: str, input_override: Dict) -> Dict:
+    """ Interpolate request parameters into the override template of the workflow,
+    unknown parameters are rejected before the job is launched
+    """
+    return compile_workflow(workflow_dir).resolve(input_override)
+
+
+def collect_outputs(workflow_run: WorkflowRunRecord) -> List[OutputFile]:
+    """ Output files of a run, as indexed from the prompt history when the run completed """
+    if not workflow_run.outputs_json:
+        return []
+    return [OutputFile(**output) for output in json.loads(workflow_run.outputs_json)
+            if output['type'] == 'output']
+
+
 class ComfyWorkflow(Workflow):
-    def __call__(self, request: JobRequest) -> JobResponse:
-        logger.info(f'Processing job {request}')
+    def __init__(self, pool: ComfyUIServerPool | None = None, gpu_allocator: GpuAllocator | None = None):
+        super().__init__()
+        self.pool = pool # warm ComfyUI servers shared by the jobs
+        self.gpu_allocator = gpu_allocator # places runs on GPUs by memory, None to use the slot devices
+
+    def __call__(self, request: JobRequest, slot: Optional[SlotConfig] = None) -> JobResponse:
+        logger.info(f'Processing job {request} on slot {slot}')
         
         # FIXME: workflow should be already installed in the workspace
         base_path = "/home/ruoyu.huang/workspace/xiaoapp/comfyui_workspace"
@@ -37,80 +66,179 @@ class ComfyWorkflow(Workflow):
         # for each job, launch the workflow process
         # FIXME: different poller should dispatch to different workflow
         workflow_id = request.Params.get('workflow_id', 4)
-        workflow_record_to_run = get_workflow_by_id(workflow_id)
+        workflow_record_to_run = workflow_cache.get_record(workflow_id)
         logger.info(workflow_record_to_run)
 
+        # phases of the job, the runner adds the phases of the run
+        trace = tracer.start_trace(workflow=workflow_record_to_run.name)
+        try:
+            return self._process(request, slot, workspace, workflow_record_to_run, trace)
+        finally:
+            trace.finish()
+
+    def _process(self, request: JobRequest, slot: Optional[SlotConfig], workspace: Workspace,
+                 workflow_record_to_run: WorkflowRecord, trace: Trace) -> JobResponse:
         temp_input_file_dir = f'/{uuid.uuid4()}'
         input_files = []
-        for input_file in request.InputFiles:
-            file_name = input_file.Name
-            logger.info(f'Processing input file {file_name}')
-            if input_file.content is None:
-                raise Exception('Input file content is None')
-            
-            download_file_path = f'{workspace.user_space_path}/{temp_input_file_dir}/{file_name}'
-            # make directory if not exist
-            write_input_file(download_file_path, input_file)
-            input_files.append(download_file_path)
-        
-        # Resolve input override
-        input_override = request.Params.get('input_override', {})
-        workflow_input_override_json_file = f'{workflow_record_to_run.workflow_dir}/input_override.json'
-        override_template = {}
-        with open(workflow_input_override_json_file, 'r') as f:
-            workflow_input_override_json = json.load(f)
-            
-            # override value using parameters from request
-            override_value = workflow_input_override_json.get('override_value', {})
-            override_value.update(input_override)
-            
-            # interpolate override value into override template
-            override_template=workflow_input_override_json.get('override_template', {})
-            # recursively update the input value in override template
-            def update_input_value(override_value, override_template):
-                for k, v in override_template.items():
-                    if isinstance(v, dict):
-                        update_input_value(override_value, v)
-                    else:
-                        if v in override_value:
-                            override_template[k] = override_value[v]
-            update_input_value(
-                override_value, 
-                override_template
-            )
+        with trace.span('download_inputs', files=len(request.InputFiles)) as span:
+            for input_file in request.InputFiles:
+                file_name = input_file.Name
+                logger.info(f'Processing input file {file_name}')
+                if input_file.content is None:
+                    raise Exception('Input file content is None')
 
-        # Launch workflow
-        logger.info(f'Launching workflow {workflow_record_to_run}')
-        workflow_run = run_workflow(
-            workspace, 
-            workflow_record_to_run,
-            input_files=input_files,
-            input_override=override_template
-        )
+                download_file_path = f'{workspace.user_space_path}/{temp_input_file_dir}/{file_name}'
+                # make directory if not exist
+                write_input_file(download_file_path, input_file)
+                input_files.append(download_file_path)
+            span.set('bytes', sum(os.path.getsize(f) for f in input_files))
+
+        # Batch job: a list of input overrides, all run as prompts on the same ComfyUI server
+        batch = request.Params.get('batch', None)
+
+        env = dict(slot.env) if slot is not None else None
+        gpu_lease = None
+        if self.gpu_allocator is not None:
+            # wait for a device with enough free memory for the workflow
+            with trace.span('gpu_wait'):
+                gpu_lease = self.gpu_allocator.allocate(workflow_cache.get_manifest(workflow_record_to_run).resources)
+            env = {**(env or {}), **gpu_lease.env}
+        try:
+            workflow_run = self._run(workspace, workflow_record_to_run, request, input_files, batch, env, trace)
+        finally:
+            if gpu_lease is not None:
+                gpu_lease.release()
         logger.info(workflow_run)
+        # input files were moved to the run input dir, drop the per job upload dir
+        shutil.rmtree(f'{workspace.user_space_path}/{temp_input_file_dir}', ignore_errors=True)
 
-        # Recursively list all files from the output directory
+        # Files produced by the output nodes, the history and temp files of the run are not returned
         output_files = []
-        for root, dirs, files in os.walk(workflow_run.output_dir):
-            for file in files:
-                logger.info(f'Processing file {root}, {dirs}, {file}')
-                with open(f'{root}/{file}', 'rb') as f:
-                    content = f.read()
-                    out_file = File(Name=file)
-                    out_file.content = io.BytesIO(content)
-                    output_files.append(out_file)
-        
+        with trace.span('return_outputs') as span:
+            outputs = collect_outputs(workflow_run)
+            for output in outputs:
+                logger.info(f'Returning output {output.rel_path} of node {output.node_id} ({output.size} bytes)')
+                # batch outputs are named item_{index}/{file}
+                out_file = File(Name=output.rel_path if batch else output.filename)
+                # opened when the consumer reads it, read in chunks
+                out_file.content = LazyFile(output.path)
+                output_files.append(out_file)
+            span.set('bytes', sum(o.size for o in outputs))
+
         return JobResponse(OutputFiles=output_files)
-        
+
+    def _run(self, workspace: Workspace, workflow_record_to_run: WorkflowRecord, request: JobRequest,
+             input_files: List[str], batch: Optional[List[Dict]], env: Optional[Dict[str, str]],
+             trace: Optional[Trace] = None) -> WorkflowRunRecord:
+        """ Run the job on a ComfyUI server with the given env (devices of the run) """
+        # Launch workflow
+        logger.info(f'Launching workflow {workflow_record_to_run}')
+        if batch:
+            input_sets = [
+                InputSet(
+                    # input files are shared by all items of the batch
+                    input_files=input_files if index == 0 else [],
+                    input_override=resolve_input_override(workflow_record_to_run.workflow_dir, input_override)
+                )
+                for index, input_override in enumerate(batch)
+            ]
+            return run_workflow_batch(
+                workspace,
+                workflow_record_to_run,
+                input_sets,
+                pool=self.pool,
+                env=env,
+                move_inputs=True,
+                trace=trace
+            )
+        else:
+            # Resolve input override
+            override_template = resolve_input_override(
+                workflow_record_to_run.workflow_dir, request.Params.get('input_override', {}))
+            return run_workflow(
+                workspace, 
+                workflow_record_to_run,
+                input_files=input_files,
+                input_override=override_template,
+                pool=self.pool,
+                env=env,
+                move_inputs=True,
+                trace=trace
+            )
+
+
+class _SlottedWorkflow(Workflow):
+    """ Run the wrapped workflow on a free slot of the scheduler """
+
+    def __init__(self, scheduler: SlotScheduler, workflow: ComfyWorkflow):
+        super().__init__()
+        self.scheduler = scheduler
+        self.workflow = workflow
+
+    def __call__(self, request: JobRequest) -> JobResponse:
+        ticket = self._admit(request)
+        try:
+            with self.scheduler.acquire_slot() as slot:
+                return self.workflow(request, slot)
+        finally:
+            ticket.release()
+
+    def _admit(self, request: JobRequest) -> Ticket:
+        # the poller holds its job until the run is admitted, other jobs stay on the job queue
+        workflow_id = request.Params.get('workflow_id', 4)
+        priority = request.Params.get('priority', 'batch')
+        while True:
+            try:
+                ticket = admission_controller.request(workflow_id, priority=priority)
+                break
+            except AdmissionRejected as e:
+                logger.info(f'Run of workflow {workflow_id} not admitted: {e}, retry in {e.retry_after_sec}s')
+                time.sleep(e.retry_after_sec)
+        ticket.wait()
+        return ticket
+
 
 if __name__ == '__main__':
-    job_queue = DynamoDBJobQueue(
-        table_name='xiaoapp-job-queue', 
-        secondary_index_name='QueueIndex', 
-        bucket_name='xiaoapp-job-data'
+    def make_job_queue():
+        return DynamoDBJobQueue(
+            table_name='xiaoapp-job-queue', 
+            secondary_index_name='QueueIndex', 
+            bucket_name='xiaoapp-job-data'
+        )
+
+    workspace = Workspace(base_path="/home/ruoyu.huang/workspace/xiaoapp/comfyui_workspace")
+    init_db(workspace)
+
+    pool = ComfyUIServerPool(
+        workspace,
+        PoolConfig(
+            min_size=int(os.environ.get('COMFYUI_POOL_MIN_SIZE', 0)),
+            max_size=int(os.environ.get('COMFYUI_POOL_MAX_SIZE', 1)),
+            idle_timeout_sec=float(os.environ.get('COMFYUI_POOL_IDLE_TIMEOUT_SEC', 600)),
+        )
+    )
+
+    # one slot per CUDA device group, e.g. "0;1" runs two jobs on GPU 0 and GPU 1
+    slot_devices = os.environ.get('SCHEDULER_SLOT_DEVICES', '0').split(';')
+    scheduler = SlotScheduler(
+        lambda: SingleThreadJobScheduler(make_job_queue()),
+        slots=[SlotConfig(slot_id=i, cuda_visible_devices=d) for i, d in enumerate(slot_devices)],
+        prefetch=int(os.environ.get('SCHEDULER_PREFETCH', 0)),
     )
+    # GPU memory based placement when the node has GPUs, slots only bound concurrency then
+    devices = discover_devices()
+    gpu_allocator = GpuAllocator(devices, reserved_mb=int(os.environ.get('SCHEDULER_GPU_RESERVED_MB', 512))) if devices else None
+    scheduler.register_workflow('echo', _SlottedWorkflow(scheduler, ComfyWorkflow(pool=pool, gpu_allocator=gpu_allocator)))
+
+    def handle_signal(signum, frame):
+        # let in-flight runs finish before killing ComfyUI servers
+        scheduler.shutdown(timeout=float(os.environ.get('SCHEDULER_DRAIN_TIMEOUT_SEC', 3600)))
+        pool.shutdown()
+        cleanup()
+        status_writer.flush(timeout=10)
+        sys.exit(0)
 
-    scheduler = SingleThreadJobScheduler(job_queue)
-    scheduler.register_workflow('echo', ComfyWorkflow())
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
     scheduler.run()
 
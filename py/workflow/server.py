@@ -0,0 +1,252 @@
+""" ComfyUI server process
+A server is launched from the workflow directory (ComfyUI main module, custom nodes and models),
+and can be reused across workflow runs: the server reads inputs from and writes outputs to
+`{home_dir}/input`, `{home_dir}/output` and `{home_dir}/temp`, which are switched to the
+directories of the bound workflow run without restarting the process.
+"""
+import os
+import sys
+import time
+import atexit
+import signal
+import subprocess
+from queue import Queue
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from .client import ComfyService
+from .dao import Workflow
+from .database import WorkflowRunRecord
+from .readiness import ReadinessProbe, ServerStartupError, startup_metrics
+from .ports import port_allocator, PortLease
+
+
+# a global registry of all subprocesses
+subprocesses = Queue()
+
+def cleanup():
+    for i in range(subprocesses.qsize()):
+        process = subprocesses.get()
+        if process.poll() is None:  # Check if the process is still running
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+def handle_signal(signum, frame):
+    cleanup()
+    sys.exit(0)
+
+# Register the cleanup function to be called on exit
+atexit.register(cleanup)
+
+# Register signal handlers
+signal.signal(signal.SIGTERM, handle_signal)
+signal.signal(signal.SIGINT, handle_signal)
+
+
+def _switch_symlink(src, dst):
+    """ Atomically point symlink `dst` to `src` """
+    tmp_link = f'{dst}.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(src=src, dst=tmp_link, target_is_directory=True)
+    os.replace(tmp_link, dst)
+
+
+class ComfyUIServer:
+    """ A ComfyUI server running in a subprocess, using the workflow venv and ComfyUI main module
+
+    Standalone server (home_dir is the workflow run dir): input/output/temp are the run directories.
+    Shared server (home_dir is a dedicated server dir): input/output/temp are symlinks,
+    `bind` points them to the workflow run directories and `unbind` points them back to idle dirs.
+    """
+
+    SHUTDOWN_TIMEOUT_SEC = 5
+    STARTUP_TIMEOUT_SEC = 300
+
+    def __init__(self, workflow: Workflow, home_dir: str, host: str = '0.0.0.0', port: Optional[str] = None,
+                 log_file: Optional[str] = None, shared: bool = False, env: Optional[Dict[str, str]] = None):
+        self.workflow = workflow
+        self.home_dir = home_dir
+        self.host = host
+        # a free port of the node, leased until the server is stopped
+        self.port_lease: Optional[PortLease] = port_allocator.reserve() if port is None else None
+        self.port = port if port is not None else str(self.port_lease.port)
+        self.log_file = log_file if log_file is not None else os.path.join(home_dir, 'server.log')
+        self.shared = shared
+        self.env = env if env is not None else {} # extra env vars, e.g. CUDA_VISIBLE_DEVICES of the slot
+        self.service = ComfyService(self.host, self.port)
+        self.process: Optional[subprocess.Popen] = None
+        self.bound_run_id: Optional[int] = None
+        self.startup_sec: Optional[float] = None
+
+    @property
+    def input_dir(self):
+        return os.path.join(self.home_dir, 'input')
+
+    @property
+    def output_dir(self):
+        return os.path.join(self.home_dir, 'output')
+
+    @property
+    def temp_dir(self):
+        return os.path.join(self.home_dir, 'temp')
+
+    @property
+    def idle_dir(self):
+        return os.path.join(self.home_dir, 'idle')
+
+    def _prepare_home_dir(self):
+        os.makedirs(self.home_dir, exist_ok=True)
+        if not self.shared:
+            for d in [self.input_dir, self.output_dir, self.temp_dir]:
+                os.makedirs(d, exist_ok=True)
+            return
+
+        # shared server starts with its io dirs pointing to empty idle dirs
+        for name in ['input', 'output', 'temp']:
+            idle = os.path.join(self.idle_dir, name)
+            os.makedirs(idle, exist_ok=True)
+            _switch_symlink(idle, os.path.join(self.home_dir, name))
+
+    def server_env(self) -> Dict[str, str]:
+        """ Env vars of the ComfyUI process """
+        python_env = {
+            "PYTHONENCODING": "utf-8", # is this required?
+            'PYTHONPATH': self.workflow.main_module_dir, # points to ComfyUI, so that main module can be found
+            'CUDA_VISIBLE_DEVICES': '0' # default device, the run env sets the allocated device
+        }
+        python_env.update(self.env)
+        return python_env
+
+    def server_args(self) -> List[str]:
+        """ ComfyUI main module args """
+        # ComfyUI args
+        # extra model paths config
+        # 1) model path
+        # 2) extra custom model path
+        # 3) workflow/run input path
+        # 4) run output path
+        return [
+            '--listen', self.host,
+            '--port', self.port,
+            '--input-directory', self.input_dir,
+            '--output-directory', self.output_dir,
+            '--temp-directory', self.temp_dir,
+            '--extra-model-paths-config', self.workflow.extra_model_paths,
+            '--verbose',
+        ]
+
+    def _launch(self, extra_args: List[str]):
+        """ Launch ComfyUI server in a subprocess, using conda venv and python module
+        """
+
+        # venv
+        python_path = self.workflow.python_venv.virtualenv_python_path
+        python_env = self.server_env()
+
+        extra_args = extra_args if extra_args is not None else []
+
+
+        command = f'{python_path} -m main ' + ' '.join(extra_args)
+        process = None
+
+        try:
+            with open(self.log_file, "w") as f:
+                if sys.platform == "win32":
+                    process = subprocess.Popen(
+                        command.split(),
+                        stdout=f,
+                        stderr=f,
+                        text=True,
+                        env=python_env,
+                        cwd=self.home_dir,
+                        encoding="utf-8",
+                        shell=True,  # win32 only
+                        creationflags=subprocess.CREATE_NEW_PROCESS_GROUP,  # win32 only
+                    )
+                else:
+                    print(f"Running: {command}")
+                    process = subprocess.Popen(
+                        command.split(),
+                        text=True,
+                        env=python_env,
+                        encoding="utf-8",
+                        cwd=self.home_dir,
+                        stdout=f,
+                        stderr=f,
+                    )
+                subprocesses.put(process)
+                return process
+        except KeyboardInterrupt:
+            if process is not None:
+                os._exit(1)
+
+    def unhold_port(self):
+        """ Let the server process bind the leased port, call right before launching it """
+        if self.port_lease is not None:
+            self.port_lease.unhold()
+
+    def release_port(self):
+        if self.port_lease is not None:
+            self.port_lease.release()
+
+    def start(self):
+        """ Launch the ComfyUI server, does not wait for the server to be ready """
+        self._prepare_home_dir()
+        self.unhold_port()
+        self.process = self._launch(self.server_args())
+
+    def wait_until_ready(self, timeout: Optional[float] = None):
+        """ Block until the server accepts requests, raise ServerStartupError if the process exits or timeout """
+        probe = ReadinessProbe(
+            self.service, self.process,
+            deadline_sec=timeout if timeout is not None else ComfyUIServer.STARTUP_TIMEOUT_SEC,
+            log_file=self.log_file)
+        try:
+            self.startup_sec = probe.wait()
+        except ServerStartupError:
+            startup_metrics.observe_failure(self.workflow.name)
+            raise
+        startup_metrics.observe(self.workflow.name, self.startup_sec)
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def bind(self, workflow_run: WorkflowRunRecord):
+        """ Point server input/output/temp dirs to the workflow run dirs """
+        if self.shared:
+            _switch_symlink(workflow_run.input_dir, self.input_dir)
+            _switch_symlink(workflow_run.output_dir, self.output_dir)
+            _switch_symlink(workflow_run.temp_dir, self.temp_dir)
+        self.bound_run_id = workflow_run.id
+
+    def unbind(self):
+        """ Detach the server from the workflow run, so later runs can not touch its files """
+        if self.shared:
+            for name in ['input', 'output', 'temp']:
+                _switch_symlink(os.path.join(self.idle_dir, name), os.path.join(self.home_dir, name))
+        self.bound_run_id = None
+
+    def stop(self):
+        self.service.close()
+        try:
+            if self.process is None:
+                return
+            try:
+                self.process.terminate()
+                self.process.wait(timeout=ComfyUIServer.SHUTDOWN_TIMEOUT_SEC) # wait for 5 seconds
+                returncode = self.process.poll()
+                logger.info(f"Process terminated with return code: {returncode}")
+                if returncode is None:
+                    # process has not exit yet, force kill it
+                    self.process.kill()
+            except Exception as e:
+                logger.error(f"Error terminating process: {e}. Force killing the process.")
+                self.process.kill()
+        finally:
+            # the process is gone, the port can be leased to another server
+            self.release_port()
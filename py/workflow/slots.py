@@ -0,0 +1,128 @@
+""" Execution slots of the job scheduler
+A node runs jobs concurrently on N execution slots, each slot with its own resources (CUDA devices).
+Jobs are polled by job queue schedulers (job_queue.SingleThreadJobScheduler), one per poller thread:
+a job queue scheduler claims one job at a time, calls the registered workflow and reports the response
+(or the error) of the job to the job queue.
+    - there are `len(slots) + prefetch` pollers, a poller holding a job waits for a free slot,
+      so at most `prefetch` jobs (with their input files) are claimed ahead of execution
+    - a job is in flight while its workflow is called, waiting for admission, for a slot or running
+    - shutdown() waits for the jobs in flight. The job queue scheduler owns its claim loop and can not
+      be stopped, so a job claimed while draining is run to completion like the others, it is never
+      dropped; the drain ends when no job is in flight (or on timeout)
+
+    scheduler = SlotScheduler(lambda: SingleThreadJobScheduler(make_job_queue()),
+                              slots=[SlotConfig(slot_id=0), SlotConfig(slot_id=1, cuda_visible_devices='1')])
+    scheduler.register_workflow('echo', workflow) # workflow(request) uses `with scheduler.acquire_slot() as slot`
+    scheduler.run()
+"""
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from pydantic import BaseModel, Field
+from loguru import logger
+
+
+class SlotConfig(BaseModel):
+    """ An execution slot, a job runs on one slot with the slot resources """
+    slot_id: int
+    cuda_visible_devices: str = Field(default='0', description='CUDA_VISIBLE_DEVICES of the ComfyUI server')
+
+    @property
+    def env(self) -> Dict[str, str]:
+        return {'CUDA_VISIBLE_DEVICES': self.cuda_visible_devices}
+
+
+class SlotScheduler:
+
+    REPORT_GRACE_SEC = 1.0 # the job queue scheduler reports the last outcome after its workflow returned
+
+    def __init__(self, scheduler_factory: Callable[[], Any], slots: List[SlotConfig], prefetch: int = 0):
+        assert len(slots) > 0, 'At least one execution slot is required'
+        # one job queue scheduler (register_workflow(name, workflow), run()) per poller thread
+        self.scheduler_factory = scheduler_factory
+        self.slots = slots
+        self.prefetch = prefetch
+        self.workflows: Dict[str, Callable[[Any], Any]] = {}
+
+        self._free_slots: List[SlotConfig] = list(slots)
+        self._lock = threading.Condition()
+        self._turns = itertools.count() # jobs get a free slot in the order they asked for one
+        self._next_turn = 0
+        self._in_flight = 0 # jobs claimed by pollers, waiting for admission, for a slot or running
+        self._draining = threading.Event()
+        self._stopped = threading.Event()
+
+    def register_workflow(self, name: str, workflow: Callable[[Any], Any]):
+        self.workflows[name] = workflow
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return self._in_flight
+
+    @contextmanager
+    def acquire_slot(self) -> Iterator[SlotConfig]:
+        """ Wait for a free slot for a claimed job """
+        with self._lock:
+            turn = next(self._turns)
+            self._lock.wait_for(lambda: self._next_turn == turn and self._free_slots)
+            self._next_turn += 1
+            slot = self._free_slots.pop(0)
+            self._lock.notify_all()
+        try:
+            yield slot
+        finally:
+            with self._lock:
+                self._free_slots.append(slot)
+                self._lock.notify_all()
+
+    def _tracked(self, name: str, workflow: Callable[[Any], Any]) -> Callable[[Any], Any]:
+        # the job queue scheduler calls the workflow with a job it claimed
+        def call(request):
+            with self._lock:
+                if self._draining.is_set():
+                    logger.warning(f'Job of workflow {name} claimed while draining, running it to completion')
+                self._in_flight += 1
+            try:
+                return workflow(request)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._lock.notify_all()
+        return call
+
+    def _poll(self, poller_id: int):
+        job_scheduler = self.scheduler_factory()
+        for name, workflow in self.workflows.items():
+            job_scheduler.register_workflow(name, self._tracked(name, workflow))
+        logger.info(f'Job poller {poller_id} started')
+        try:
+            job_scheduler.run()
+        except Exception as e:
+            logger.error(f'Job poller {poller_id} error: {e}')
+
+    def start(self) -> List[threading.Thread]:
+        pollers = [threading.Thread(target=self._poll, args=(poller_id,), daemon=True)
+                   for poller_id in range(len(self.slots) + self.prefetch)]
+        for poller in pollers:
+            poller.start()
+        return pollers
+
+    def run(self):
+        """ Start the pollers and block until shutdown """
+        self.start()
+        self._stopped.wait()
+
+    def shutdown(self, timeout: Optional[float] = None) -> bool:
+        """ Wait for in-flight jobs to finish and their outcomes to be reported, return False on timeout """
+        with self._lock:
+            self._draining.set()
+            logger.info(f'Draining scheduler, {self._in_flight} jobs in flight')
+            drained = self._lock.wait_for(lambda: self._in_flight == 0, timeout=timeout)
+        if drained:
+            time.sleep(SlotScheduler.REPORT_GRACE_SEC)
+        self._stopped.set()
+        return drained
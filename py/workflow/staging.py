@@ -0,0 +1,97 @@
+""" Staging of run input files into the run input dir
+Inputs are large media files, the cheapest way to place a file in the run input dir is used:
+    - move: files owned by the run (e.g. written by the scheduler for this job) are renamed
+    - hardlink: same file system, no data is written
+    - reflink: copy-on-write clone (btrfs, xfs, ...) when hard links are not possible
+    - copy: across devices only
+Bytes actually copied are reported per run.
+"""
+import errno
+import os
+import shutil
+from typing import List
+
+from pydantic import BaseModel
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError: # windows, no reflink
+    fcntl = None
+
+
+FICLONE = 0x40049409 # linux ioctl, clone the content of a file (reflink)
+
+
+class StagedFile(BaseModel):
+    src: str
+    dst: str
+    method: str # move, hardlink, reflink, copy
+    size: int
+    bytes_copied: int = 0
+
+
+class StagingReport(BaseModel):
+    files: List[StagedFile] = []
+
+    @property
+    def bytes_copied(self) -> int:
+        return sum(f.bytes_copied for f in self.files)
+
+    @property
+    def bytes_staged(self) -> int:
+        return sum(f.size for f in self.files)
+
+
+def _reflink(src: str, dst: str) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return True
+    except OSError as e:
+        if os.path.exists(dst):
+            os.remove(dst)
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EPERM):
+            raise
+        return False
+
+
+def stage_file(src: str, dst_dir: str, move: bool = False) -> StagedFile:
+    """ Place `src` in `dst_dir` (same file name) without copying data when possible """
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    size = os.path.getsize(src)
+    if os.path.lexists(dst):
+        # same semantics as copy, the staged file replaces an existing one
+        os.remove(dst)
+
+    if move:
+        try:
+            os.rename(src, dst)
+            return StagedFile(src=src, dst=dst, method='move', size=size)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    try:
+        os.link(src, dst)
+        return StagedFile(src=src, dst=dst, method='hardlink', size=size)
+    except OSError as e:
+        # cross device, file system without hard links, protected_hardlinks ...
+        logger.debug(f"Can not hard link {src} to {dst}: {e}")
+
+    if _reflink(src, dst):
+        return StagedFile(src=src, dst=dst, method='reflink', size=size)
+
+    shutil.copy(src, dst)
+    return StagedFile(src=src, dst=dst, method='copy', size=size, bytes_copied=size)
+
+
+def stage_files(files: List[str], dst_dir: str, move: bool = False) -> StagingReport:
+    report = StagingReport(files=[stage_file(f, dst_dir, move=move) for f in files])
+    if report.files:
+        logger.info(f"Staged {len(report.files)} input files ({report.bytes_staged} bytes) to {dst_dir}, "
+                    f"{report.bytes_copied} bytes copied")
+    return report
@@ -0,0 +1,107 @@
+""" Streaming file I/O between jobs and workflow runs
+Job inputs and outputs are large media files, they are never held in memory as a whole:
+inputs are copied from the job stream to disk in chunks, outputs are returned as lazily
+opened files, read in chunks by the consumer.
+Files are hashed the same way: sha256 streamed through one reused buffer.
+"""
+import hashlib
+import io
+import os
+import shutil
+from typing import BinaryIO, Iterator, Optional
+
+
+CHUNK_SIZE = 1024 * 1024
+HASH_CHUNK_SIZE = 8 * 1024 * 1024 # large reads, hashlib releases the GIL while hashing them
+
+
+def copy_stream(src: BinaryIO, dst_path: str, chunk_size: int = CHUNK_SIZE) -> int:
+    """ Copy a readable stream to a file in chunks, return the bytes written """
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    with open(dst_path, 'wb') as f:
+        shutil.copyfileobj(src, f, chunk_size)
+        return f.tell()
+
+
+def update_digest(digest, path: str, start: int = 0, end: Optional[int] = None,
+                  chunk_size: int = HASH_CHUNK_SIZE) -> int:
+    """ Feed bytes [start, end) of a file (to the end of file by default) to `digest`, return the bytes fed """
+    fed = 0
+    with open(path, 'rb', buffering=0) as f:
+        f.seek(start)
+        remaining = (end if end is not None else os.fstat(f.fileno()).st_size) - start
+        view = memoryview(bytearray(max(1, min(chunk_size, remaining))))
+        while end is None or fed < end - start:
+            n = f.readinto(view if end is None else view[:min(len(view), end - start - fed)])
+            if not n:
+                break
+            digest.update(view[:n])
+            fed += n
+    return fed
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    update_digest(digest, path)
+    return digest.hexdigest()
+
+
+class LazyFile(io.RawIOBase):
+    """ Read-only file opened on first read, and closed at end of file or on close()
+
+    Many outputs can be handed out without holding a file descriptor or the content of each.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.name = os.path.basename(path)
+        self._f: Optional[io.FileIO] = None
+        self._eof = False
+
+    def _file(self) -> io.FileIO:
+        if self._f is None:
+            self._f = io.FileIO(self.path, 'rb')
+        return self._f
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self._eof:
+            return 0
+        n = self._file().readinto(buffer)
+        if not n:
+            # release the descriptor, the file can be re-opened by seek()
+            self._eof = True
+            self._f.close()
+            self._f = None
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._eof = False
+        return self._file().seek(offset, whence)
+
+    def tell(self) -> int:
+        if self._f is None:
+            return os.path.getsize(self.path) if self._eof else 0
+        return self._f.tell()
+
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+    def chunks(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        super().close()
@@ -0,0 +1,152 @@
+""" Compiled input override templates
+A workflow has a ComfyUI API graph (`workflow_api.json`) and an override template (`input_override.json`):
+    {
+        "override_value": {"seed": 42},                                 # default parameter values
+        "override_template": {"3": {"inputs": {"seed": "seed"}}}        # template leaves name parameters
+    }
+Both files are parsed once per workflow into a list of (input path, parameter) slots and cached by file mtime.
+Parameters of a job are applied as flat slot assignments on a copy-on-write copy of the base graph:
+only the nodes and input dicts on an assigned path are copied, everything else is shared with the cache,
+so rendered graphs must be treated as read-only.
+"""
+import collections
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from loguru import logger
+
+
+Path = Tuple[str, ...]
+
+
+class OverrideTemplateError(ValueError):
+    """ Override template or job parameters do not match the workflow """
+
+
+class _Slot:
+    """ A template leaf, the value of `param` (or the literal if no value is given) goes to `path` """
+
+    def __init__(self, path: Path, literal: Any):
+        self.path = path
+        self.literal = literal
+        # only string leaves name parameters, other leaves are constants
+        self.param = literal if isinstance(literal, str) else None
+
+
+def _flatten(tree: Dict, prefix: Path = ()) -> Iterable[Tuple[Path, Any]]:
+    """ (path, leaf value) pairs of a nested dict, dicts are walked and everything else is a leaf """
+    for k, v in tree.items():
+        if isinstance(v, collections.abc.Mapping):
+            yield from _flatten(v, prefix + (str(k),))
+        else:
+            yield prefix + (str(k),), v
+
+
+def _assign(graph: Dict, assignments: Iterable[Tuple[Path, Any]]) -> Dict:
+    """ Copy-on-write assignment of values to paths of the graph """
+    result = dict(graph)
+    copied: Set[Path] = set()
+    for path, value in assignments:
+        node = result
+        for depth, key in enumerate(path[:-1]):
+            prefix = path[:depth + 1]
+            if prefix not in copied:
+                child = node.get(key, None)
+                node[key] = dict(child) if isinstance(child, collections.abc.Mapping) else {}
+                copied.add(prefix)
+            node = node[key]
+        node[path[-1]] = value
+    return result
+
+
+class CompiledWorkflow:
+    """ Base graph and override slots of a workflow
+
+    compiled = compile_workflow(workflow_dir)
+    prompt = compiled.render({'seed': 1}) # graph ready for /prompt
+    override = compiled.resolve({'seed': 1}) # override as stored on the workflow run
+    """
+
+    def __init__(self, workflow_dir: str, graph: Dict, override_value: Dict, override_template: Dict):
+        self.workflow_dir = workflow_dir
+        self.graph = graph
+        self.defaults = override_value
+        self.slots: List[_Slot] = [_Slot(path, literal) for path, literal in _flatten(override_template)]
+        self.params: Set[str] = set(override_value.keys()) | {s.param for s in self.slots if s.param is not None}
+
+        # template must target existing nodes of the graph
+        unknown_nodes = sorted({s.path[0] for s in self.slots if s.path[0] not in graph})
+        if unknown_nodes:
+            raise OverrideTemplateError(
+                f"Override template of {workflow_dir} references nodes not in workflow_api.json: {unknown_nodes}")
+
+    def validate(self, params: Dict):
+        """ Reject parameters that no template slot consumes """
+        unknown = sorted(set(params.keys()) - self.params)
+        if unknown:
+            raise OverrideTemplateError(
+                f"Unknown input override parameters {unknown} for {self.workflow_dir}, expected one of {sorted(self.params)}")
+
+    def _values(self, params: Dict) -> Iterable[Tuple[Path, Any]]:
+        self.validate(params)
+        for slot in self.slots:
+            if slot.param is not None and slot.param in params:
+                yield slot.path, params[slot.param]
+            elif slot.param is not None and slot.param in self.defaults:
+                yield slot.path, self.defaults[slot.param]
+            else:
+                yield slot.path, slot.literal
+
+    def resolve(self, params: Dict) -> Dict:
+        """ Override of the job parameters, a nested {node_id: {'inputs': {...}}} dict """
+        return _assign({}, self._values(params))
+
+    def render(self, params: Dict) -> Dict:
+        """ Base graph with the job parameters applied """
+        return _assign(self.graph, self._values(params))
+
+    def apply(self, input_override: Optional[Dict]) -> Dict:
+        """ Base graph with a resolved override (nested dict) merged in """
+        if not input_override:
+            return self.graph
+        return _assign(self.graph, _flatten(input_override))
+
+
+_lock = threading.Lock()
+_cache: Dict[str, Tuple[Tuple, CompiledWorkflow]] = {} # {workflow dir -> (file mtimes, compiled)}
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def compile_workflow(workflow_dir: str) -> CompiledWorkflow:
+    """ Compiled workflow of the workflow dir, recompiled when workflow_api.json or input_override.json change """
+    workflow_api_file = os.path.join(workflow_dir, 'workflow_api.json')
+    input_override_file = os.path.join(workflow_dir, 'input_override.json')
+    key = (_mtime(workflow_api_file), _mtime(input_override_file))
+
+    with _lock:
+        cached = _cache.get(workflow_dir, None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+    logger.info(f"Compiling workflow {workflow_api_file}")
+    with open(workflow_api_file, 'r') as f:
+        graph = json.load(f)
+    override_value, override_template = {}, {}
+    if key[1] is not None:
+        with open(input_override_file, 'r') as f:
+            workflow_input_override_json = json.load(f)
+        override_value = workflow_input_override_json.get('override_value', {})
+        override_template = workflow_input_override_json.get('override_template', {})
+    compiled = CompiledWorkflow(workflow_dir, graph, override_value, override_template)
+
+    with _lock:
+        _cache[workflow_dir] = (key, compiled)
+    return compiled
@@ -0,0 +1,92 @@
+""" Run admission: limits, priority queue, rejection and async waiting """
+import asyncio
+import threading
+
+import pytest
+
+from .admission import AdmissionController, AdmissionConfig, AdmissionRejected
+
+
+def test_limits_per_node_and_per_workflow():
+    controller = AdmissionController(AdmissionConfig(max_running=3, max_running_per_workflow=2))
+    a1 = controller.request('a')
+    a2 = controller.request('a')
+    a3 = controller.request('a')
+    b1 = controller.request('b')
+    assert [t.granted for t in (a1, a2, a3, b1)] == [True, True, False, True]
+    assert controller.request('c', queue=False) is None
+
+    # a free node slot goes to the first pending run of a workflow under its limit
+    b1.release()
+    assert not a3.granted
+    a1.release()
+    assert a3.granted
+    assert controller.metrics()['running_per_workflow'] == {'a': 2}
+
+
+def test_priority_classes_and_rejection():
+    controller = AdmissionController(AdmissionConfig(max_running=1, max_pending=2, default_run_sec=10))
+    running = controller.request('a')
+    background = controller.request('a', priority='background')
+    interactive = controller.request('b', priority='interactive')
+    with pytest.raises(AdmissionRejected) as e:
+        controller.request('c')
+    assert e.value.retry_after_sec == 30
+
+    running.release()
+    assert interactive.granted and not background.granted
+    metrics = controller.metrics()
+    assert (metrics['pending'], metrics['rejected'], metrics['admitted']) == (1, 1, 2)
+    assert metrics['pending_per_priority']['background'] == 1
+
+
+def test_wait_timeout_cancels_the_ticket():
+    controller = AdmissionController(AdmissionConfig(max_running=1))
+    running = controller.request('a')
+    pending = controller.request('a')
+    with pytest.raises(AdmissionRejected):
+        pending.wait(timeout=0.01)
+    running.release()
+    assert not pending.granted
+    assert controller.metrics()['running'] == 0
+
+
+def test_async_waiters():
+    controller = AdmissionController(AdmissionConfig(max_running=1))
+    running = controller.request('a')
+
+    async def main():
+        queued = controller.request('a')
+        cancelled = controller.request('a')
+        cancelled_task = asyncio.create_task(cancelled.wait_async())
+        await asyncio.sleep(0)
+        cancelled_task.cancel()
+        threading.Timer(0.05, running.release).start()
+        await asyncio.wait_for(queued.wait_async(), timeout=5)
+        return queued
+
+    queued = asyncio.run(main())
+    assert queued.granted
+    assert controller.metrics()['pending'] == 0
+
+
+def test_limits_are_shared_by_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(AdmissionController, 'NODE_POLL_INTERVAL_SEC', 0.01)
+    # two controllers on the same lock dir stand for the API and the scheduler processes
+    config = AdmissionConfig(max_running=2, max_running_per_workflow=1, lock_dir=str(tmp_path))
+    api, scheduler = AdmissionController(config), AdmissionController(config)
+
+    a = api.request('a')
+    assert a.granted and scheduler.request('a', queue=False) is None
+    b = scheduler.request('b')
+    assert b.granted
+    c = scheduler.request('c')
+    assert not c.granted and api.request('c', queue=False) is None
+
+    # a slot freed by the other process is picked up
+    a.release()
+    c.wait(timeout=5)
+    assert scheduler.metrics()['running'] == 2 and api.metrics()['running'] == 0
+    b.release()
+    c.release()
+    assert api.request('a', queue=False).granted
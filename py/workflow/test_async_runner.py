@@ -0,0 +1,179 @@
+""" AsyncComfyUIRunner and AsyncComfyService against a fake ComfyUI server """
+import asyncio
+import json
+import sys
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from .async_runner import AsyncComfyService, AsyncComfyUIRunner
+from .dao import Workspace
+from .database import WorkflowRunRecord
+from .readiness import ReadinessProbe, ServerStartupError
+from .test_runner import make_workflow
+
+
+class FakeComfyUI:
+    """ /queue, /prompt, /history and /ws of a ComfyUI server, prompts finish right away unless `hang` """
+
+    def __init__(self, not_ready_probes=0, hang=False):
+        self.not_ready_probes = not_ready_probes
+        self.hang = hang
+        self.probes = 0
+        self.prompts = []
+        self.sockets = {}
+        self.done = set()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/queue', self.queue)
+        app.router.add_post('/prompt', self.prompt)
+        app.router.add_get('/history/{prompt_id}', self.history)
+        app.router.add_get('/ws', self.ws)
+        return app
+
+    async def queue(self, request):
+        self.probes += 1
+        if self.probes <= self.not_ready_probes:
+            return web.Response(status=503)
+        return web.json_response({'queue_running': [], 'queue_pending': []})
+
+    async def prompt(self, request):
+        body = await request.json()
+        self.prompts.append(body['prompt'])
+        prompt_id = f'p{len(self.prompts)}'
+        if not self.hang:
+            asyncio.create_task(self._execute(prompt_id, self.sockets.get(body['client_id'], None)))
+        return web.json_response({'prompt_id': prompt_id, 'number': len(self.prompts), 'node_errors': {}})
+
+    async def _execute(self, prompt_id, ws):
+        if ws is not None:
+            for event in [{'type': 'executing', 'data': {'node': '3', 'prompt_id': prompt_id}},
+                          {'type': 'progress', 'data': {'node': '3', 'prompt_id': prompt_id, 'value': 1, 'max': 2}},
+                          {'type': 'executing', 'data': {'node': None, 'prompt_id': prompt_id}}]:
+                await ws.send_str(json.dumps(event))
+        self.done.add(prompt_id)
+
+    async def history(self, request):
+        prompt_id = request.match_info['prompt_id']
+        if prompt_id not in self.done:
+            return web.json_response({})
+        return web.json_response({prompt_id: {'status': {'status_str': 'success', 'completed': True}, 'outputs': {}}})
+
+    async def ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets[request.query['clientId']] = ws
+        async for _ in ws:
+            pass
+        return ws
+
+
+@pytest.fixture(autouse=True)
+def fast_probes(monkeypatch):
+    monkeypatch.setattr(ReadinessProbe, 'INITIAL_INTERVAL_SEC', 0.01)
+    monkeypatch.setattr(ReadinessProbe, 'MAX_INTERVAL_SEC', 0.01)
+
+
+async def _serve(comfyui: FakeComfyUI) -> TestServer:
+    server = TestServer(comfyui.app(), host='127.0.0.1')
+    await server.start_server()
+    return server
+
+
+def _runner(tmp_path, monkeypatch, server: TestServer, statuses, code='import time; time.sleep(60)'):
+    workflow = make_workflow(tmp_path)
+    (tmp_path / 'workflow' / 'input').mkdir(parents=True)
+    workflow_run = WorkflowRunRecord(id=1, workflow_id=1, status='pending', created_at='now')
+    runner = AsyncComfyUIRunner(Workspace(base_path=str(tmp_path)), workflow, workflow_run,
+                                callback=lambda r: statuses.append(r.status))
+    runner.host, runner.port = server.host, str(server.port)
+    monkeypatch.setattr(runner, '_load_workflow_config', lambda: {'3': {'inputs': {}}})
+
+    async def launch(comfyui_server):
+        # a stand-in for the ComfyUI main process
+        return await asyncio.create_subprocess_exec(sys.executable, '-c', code)
+    monkeypatch.setattr(runner, '_launch', launch)
+    return runner
+
+
+def test_service_requests():
+    async def main():
+        comfyui = FakeComfyUI(not_ready_probes=1)
+        server = await _serve(comfyui)
+        async with aiohttp.ClientSession() as session:
+            service = AsyncComfyService(server.host, str(server.port), session)
+            assert await service.is_server_ready(timeout=1) is False
+            assert await service.is_server_ready(timeout=1) is True
+            ws = await service.connect_events('client')
+            response = await service.post_prompt({'3': {}}, 'client')
+            assert response['prompt_id'] == 'p1'
+            message = await ws.receive_json()
+            assert message['type'] == 'executing' and message['data']['prompt_id'] == 'p1'
+            await ws.close()
+            await asyncio.sleep(0.05)
+            assert 'p1' in await service.get_history('p1')
+        await server.close()
+        # nothing listens any more
+        async with aiohttp.ClientSession() as session:
+            service = AsyncComfyService(server.host, str(server.port), session)
+            assert await service.is_server_ready(timeout=1) is False
+            assert await service.connect_events('client') is None
+
+    asyncio.run(main())
+
+
+def test_run_completes_with_progress(tmp_path, monkeypatch):
+    statuses = []
+
+    async def main():
+        comfyui = FakeComfyUI(not_ready_probes=2)
+        server = await _serve(comfyui)
+        runner = _runner(tmp_path, monkeypatch, server, statuses)
+        await runner.execute()
+        await server.close()
+        return runner, comfyui
+
+    runner, comfyui = asyncio.run(main())
+    assert comfyui.probes == 3 and len(comfyui.prompts) == 1
+    assert statuses[:2] == ['pending', 'ready']
+    assert 'running' in statuses and statuses[-2:] == ['completed', 'terminated']
+    assert json.loads(runner.workflow_run.progress_json)['node'] == '3'
+    assert runner.process.returncode is not None
+
+
+def test_server_exit_fails_the_startup(tmp_path, monkeypatch):
+    statuses = []
+
+    async def main():
+        server = await _serve(FakeComfyUI(not_ready_probes=1000))
+        runner = _runner(tmp_path, monkeypatch, server, statuses, code='raise SystemExit(1)')
+        with pytest.raises(ServerStartupError):
+            await runner.execute()
+        await server.close()
+
+    asyncio.run(main())
+    assert statuses[-2:] == ['failed', 'terminated']
+
+
+def test_cancel_terminates_the_server(tmp_path, monkeypatch):
+    statuses = []
+
+    async def main():
+        server = await _serve(FakeComfyUI(hang=True))
+        runner = _runner(tmp_path, monkeypatch, server, statuses)
+        task = asyncio.create_task(runner.execute())
+        while 'running' not in statuses:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await server.close()
+        return runner
+
+    runner = asyncio.run(main())
+    # the ComfyUI server does not outlive the run
+    assert runner.process.returncode is not None
+    assert statuses[-1] == 'terminated' and 'completed' not in statuses
@@ -0,0 +1,101 @@
+""" Workflow cache hits, revalidation and LRU eviction, with an in-memory workflow table """
+import os
+
+import pytest
+
+from .cache import WorkflowCache, WorkflowNotFound
+from .dao import Workflow, RuntimeEnv, ComfyUIDependencyConfig, CodeDependency, get_workflow_manifest
+from .database import WorkflowRecord
+
+
+def write_manifest(workflow_dir, name):
+    os.makedirs(workflow_dir, exist_ok=True)
+    workflow = Workflow(
+        name=name, workflow_dir=workflow_dir, python_venv=RuntimeEnv(venv_path='/tmp/venv'),
+        dependency_config=ComfyUIDependencyConfig(
+            base_code=CodeDependency(name='ComfyUI', github_url='https://github.com/comfyanonymous/ComfyUI', commit_sha='abc')))
+    with open(os.path.join(workflow_dir, 'manifest.json'), 'w') as f:
+        f.write(workflow.model_dump_json())
+
+
+class FakeTable:
+    def __init__(self):
+        self.records = {}
+        self.loads = 0
+        self.manifest_loads = 0
+
+    def load_record(self, workflow_id):
+        self.loads += 1
+        return self.records.get(workflow_id, None)
+
+    def load_version(self, workflow_id):
+        record = self.records.get(workflow_id, None)
+        return None if record is None else (record.workflow_dir, record.updated_at)
+
+    def cache(self, **kwargs):
+        def load_manifest(workflow_dir):
+            self.manifest_loads += 1
+            return get_workflow_manifest(workflow_dir)
+        return WorkflowCache(load_record=self.load_record, load_version=self.load_version,
+                             load_manifest=load_manifest, **kwargs)
+
+    def add(self, workflow_id, workflow_dir, updated_at=None):
+        self.records[workflow_id] = WorkflowRecord(
+            id=workflow_id, name=f'wf{workflow_id}', created_at='now', workflow_dir=workflow_dir, updated_at=updated_at)
+
+
+def test_hot_workflow_is_a_lookup(tmp_path):
+    table = FakeTable()
+    table.add(1, str(tmp_path / 'wf1'))
+    write_manifest(str(tmp_path / 'wf1'), 'wf1')
+    cache = table.cache()
+
+    first = cache.get(1)
+    assert first.manifest.name == 'wf1'
+    assert cache.get(1) is first
+    assert cache.get_record(1) is first.record
+    assert (table.loads, table.manifest_loads) == (1, 1)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    with pytest.raises(WorkflowNotFound):
+        cache.get(2)
+    assert cache.get_record(2) is None
+
+
+def test_revalidation_by_updated_at_and_mtime(tmp_path):
+    table = FakeTable()
+    workflow_dir = str(tmp_path / 'wf1')
+    table.add(1, workflow_dir)
+    write_manifest(workflow_dir, 'wf1')
+    cache = table.cache(revalidate_interval_sec=0)
+
+    first = cache.get(1)
+    # unchanged, revalidated without reloading
+    assert cache.get(1) is first
+
+    table.add(1, workflow_dir, updated_at='later')
+    second = cache.get(1)
+    assert second is not first and second.record.updated_at == 'later'
+
+    write_manifest(workflow_dir, 'wf1-v2')
+    os.utime(os.path.join(workflow_dir, 'manifest.json'), ns=(0, 10**9))
+    assert cache.get(1).manifest.name == 'wf1-v2'
+    assert table.manifest_loads == 3
+
+
+def test_lru_eviction(tmp_path):
+    table = FakeTable()
+    for workflow_id in range(3):
+        table.add(workflow_id, str(tmp_path / f'wf{workflow_id}'))
+        write_manifest(str(tmp_path / f'wf{workflow_id}'), f'wf{workflow_id}')
+    cache = table.cache(max_size=2)
+
+    cache.get(0)
+    cache.get(1)
+    cache.get(0) # 1 is now least recently used
+    cache.get(2)
+    assert table.loads == 3
+    cache.get(0)
+    assert table.loads == 3
+    cache.get(1)
+    assert table.loads == 4
@@ -0,0 +1,101 @@
+""" ComfyService against a local HTTP stand-in of the ComfyUI API """
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from .client import ComfyService
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+    connections = set()
+    requests = []
+    queue_status = 200
+
+    def _reply(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _record(self):
+        _Handler.connections.add(self.client_address)
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        _Handler.requests.append((self.command, self.path, body))
+
+    def do_GET(self):
+        self._record()
+        if self.path == '/queue':
+            self._reply({'queue_running': [], 'queue_pending': []}, status=_Handler.queue_status)
+        elif self.path.startswith('/history/'):
+            self._reply({})
+        elif self.path.startswith('/object_info'):
+            self._reply({'KSampler': {}})
+        else:
+            self._reply({}, status=404)
+
+    def do_POST(self):
+        self._record()
+        if self.path == '/prompt':
+            self._reply({'prompt_id': 'p1', 'number': 1, 'node_errors': {}})
+        else:
+            self._reply({})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def service():
+    _Handler.connections.clear()
+    _Handler.requests.clear()
+    _Handler.queue_status = 200
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    service = ComfyService('127.0.0.1', str(httpd.server_address[1]))
+    yield service
+    service.close()
+    httpd.shutdown()
+
+
+def test_typed_endpoints(service):
+    assert service.is_server_ready(timeout=1)
+    assert service.submit_prompt({'3': {}}, client_id='c1')['prompt_id'] == 'p1'
+    assert service.get_history('p1') == {}
+    assert service.get_queue()['queue_pending'] == []
+    assert 'KSampler' in service.get_object_info()
+    service.interrupt()
+    service.free(unload_models=True)
+
+    assert ('POST', '/prompt', {'prompt': {'3': {}}, 'client_id': 'c1'}) in _Handler.requests
+    assert ('POST', '/free', {'unload_models': True, 'free_memory': False}) in _Handler.requests
+
+
+def test_connection_is_reused_and_latency_recorded(service):
+    for _ in range(20):
+        service.get_history('p1')
+    assert len(_Handler.connections) == 1
+
+    stats = service.stats()
+    assert stats['history']['count'] == 20
+    assert stats['history']['errors'] == 0
+
+
+def test_unreachable_server_is_not_ready():
+    service = ComfyService('127.0.0.1', '1')
+    assert not service.is_server_ready(timeout=1)
+    assert service.stats()['queue']['errors'] == 1
+
+
+def test_readiness_probe_is_not_retried(service):
+    _Handler.queue_status = 503
+    assert not service.is_server_ready(timeout=1)
+    # one request per probe, a 503 of a GET would be retried by the session
+    assert _Handler.requests == [('GET', '/queue', None)]
+    service.get_queue()
+    assert len(_Handler.requests) == 1 + 1 + ComfyService.MAX_RETRIES
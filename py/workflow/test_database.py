@@ -1,4 +1,67 @@
-from .database import init_db, list_workflows, list_workflow_runs
+import sqlite3
+
+from sqlalchemy import inspect
+
+from .database import (
+    init_db, list_workflows, list_workflow_runs, migrate, create_db_engine, DatabaseConfig, SCHEMA_VERSION,
+    WorkflowRecord, WorkflowRunRecord, WorkflowRunStatus,
+    create_workflow, get_workflow_by_id, get_workflow_by_dir, get_workflow_version,
+    create_workflow_run, update_workflow_run, get_workflow_run_by_id
+)
+
+
+def test_workflow_crud(db):
+    create_workflow(WorkflowRecord(name='wf', created_at='2024-01-01', workflow_dir='/wf', updated_at='t0'))
+    workflow = get_workflow_by_dir('/wf')
+    assert get_workflow_by_id(workflow.id).name == 'wf'
+    assert tuple(get_workflow_version(workflow.id)) == ('/wf', 't0')
+    assert get_workflow_by_dir('/other') is None
+    assert [w.id for w in list_workflows()] == [workflow.id]
+
+
+def test_workflow_run_crud(db):
+    workflow_run = create_workflow_run(WorkflowRunRecord(
+        workflow_id=1, status=WorkflowRunStatus.PENDING.value, created_at='2024-01-01'))
+    workflow_run.status = WorkflowRunStatus.COMPLETED.value
+    workflow_run.outputs_json = '[]'
+    update_workflow_run(workflow_run)
+
+    stored = get_workflow_run_by_id(workflow_run.id)
+    assert (stored.status, stored.outputs_json) == ('completed', '[]')
+    assert [r.id for r in list_workflow_runs(lambda r: r.status == 'completed')] == [workflow_run.id]
+
+
+def test_migrate_first_release_schema(tmp_path):
+    database_file_path = str(tmp_path / 'workflow.db')
+    with sqlite3.connect(database_file_path) as conn:
+        conn.executescript('''
+            CREATE TABLE workflowrecord (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, created_at VARCHAR NOT NULL,
+                workflow_dir VARCHAR NOT NULL, description VARCHAR, updated_at VARCHAR);
+            CREATE TABLE workflowrunrecord (id INTEGER PRIMARY KEY, workflow_id INTEGER NOT NULL, status VARCHAR NOT NULL,
+                created_at VARCHAR NOT NULL, updated_at VARCHAR, input_files_json VARCHAR, input_override_json VARCHAR,
+                runtime_dir VARCHAR, host VARCHAR, port INTEGER);
+            INSERT INTO workflowrunrecord (workflow_id, status, created_at) VALUES (1, 'completed', '2024-01-01');
+        ''')
+
+    engine = create_db_engine(DatabaseConfig.sqlite_file(database_file_path))
+    assert migrate(engine) == SCHEMA_VERSION
+    assert migrate(engine) == 0
+
+    inspector = inspect(engine)
+    columns = {c['name'] for c in inspector.get_columns('workflowrunrecord')}
+    assert {'progress_json', 'batch_results_json', 'input_bytes_copied', 'outputs_json'} <= columns
+    assert 'ix_workflowrunrecord_status_created_at' in {i['name'] for i in inspector.get_indexes('workflowrunrecord')}
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('SELECT max(version) FROM schemaversion').scalar() == SCHEMA_VERSION
+        assert conn.exec_driver_sql('SELECT status FROM workflowrunrecord').scalar() == 'completed'
+
+
+def test_new_database_is_at_schema_version(tmp_path):
+    engine = create_db_engine(DatabaseConfig(url='sqlite://'))
+    assert migrate(engine) == 0
+    with engine.connect() as conn:
+        versions = conn.exec_driver_sql('SELECT version FROM schemaversion ORDER BY version').scalars().all()
+    assert versions[-1] == SCHEMA_VERSION
 
 
 if __name__ == "__main__":
@@ -10,4 +73,4 @@ if __name__ == "__main__":
 
     workflow_runs = list_workflow_runs(lambda v: True)
     for workflow_run in workflow_runs:
-        print(f'[INFO] Workflow run: {workflow_run}')
\ No newline at end of file
+        print(f'[INFO] Workflow run: {workflow_run}')
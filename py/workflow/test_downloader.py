@@ -0,0 +1,131 @@
+""" ModelDownloader against a local HTTP stand-in of a model host """
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from .dao import Workspace, Inventory, CodeDependency, ModelDependency
+from .model_store import ModelStore
+from .downloader import ModelDownloader, DownloadError, _PartState
+
+
+CONTENT = os.urandom(1000)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    ranges = True
+    ranges_served = []
+    fail_from = None # ranges starting at or after this offset fail, an interrupted download
+
+    def do_GET(self):
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if match and _Handler.ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            if _Handler.fail_from is not None and start >= _Handler.fail_from:
+                self.send_response(500)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            _Handler.ranges_served.append((start, end))
+            data = CONTENT[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(CONTENT)}')
+        else:
+            data = CONTENT
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def url():
+    _Handler.ranges = True
+    _Handler.ranges_served = []
+    _Handler.fail_from = None
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/model.safetensors'
+    httpd.shutdown()
+
+
+def test_parallel_range_download(tmp_path, url):
+    downloader = ModelDownloader(Workspace(base_path=str(tmp_path)), part_size=128, connections_per_file=3)
+    dest = str(tmp_path / 'models/checkpoints/model.safetensors')
+    digest = downloader.download(url, dest, size=len(CONTENT), sha256=hashlib.sha256(CONTENT).hexdigest())
+
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    with open(dest, 'rb') as f:
+        assert f.read() == CONTENT
+    assert len(_Handler.ranges_served) == 1 + 8 # probe and parts
+    assert not any(os.path.exists(path) for path in downloader.staging_files(dest))
+
+
+def test_resume_fetches_missing_parts_only(tmp_path, url):
+    dest = str(tmp_path / 'model.safetensors')
+    downloader = ModelDownloader(Workspace(base_path=str(tmp_path)), part_size=256)
+    part_file, state_file = downloader.staging_files(dest)
+    os.makedirs(os.path.dirname(part_file))
+    with open(part_file, 'wb') as f:
+        f.write(CONTENT[:512] + b'\0' * (len(CONTENT) - 512))
+    with open(state_file, 'w') as f:
+        f.write(_PartState(url=url, size=len(CONTENT), part_size=256, etag='"v1"', done=[0, 1]).model_dump_json())
+
+    assert downloader.download(url, dest) == hashlib.sha256(CONTENT).hexdigest()
+    assert sorted(_Handler.ranges_served[1:]) == [(512, 767), (768, 999)]
+
+
+def test_checksum_mismatch_and_stream_fallback(tmp_path, url):
+    downloader = ModelDownloader(Workspace(base_path=str(tmp_path)), part_size=256)
+    dest = str(tmp_path / 'model.safetensors')
+    with pytest.raises(DownloadError):
+        downloader.download(url, dest, sha256='0' * 64)
+    assert not os.path.exists(dest) and not os.path.exists(downloader.staging_files(dest)[0])
+
+    _Handler.ranges = False
+    assert downloader.download(url, dest) == hashlib.sha256(CONTENT).hexdigest()
+
+
+def test_fetch_missing(tmp_path, url):
+    workspace = Workspace(base_path=str(tmp_path))
+    inventory = Inventory(
+        workspace=workspace,
+        base_code=CodeDependency(name='ComfyUI', github_url='', commit_sha=''),
+        modules={},
+        models={})
+    models = [ModelDependency(name='model', file_name='model.safetensors', rel_file_path='checkpoints/model.safetensors',
+                              category='checkpoints', url=url),
+              ModelDependency(name='local', file_name='local.safetensors', rel_file_path='checkpoints/local.safetensors',
+                              category='checkpoints', url='file:/nowhere')]
+    downloaded = ModelDownloader(workspace, part_size=300).fetch_missing(inventory, models)
+    assert [m.rel_file_path for m in downloaded] == ['checkpoints/model.safetensors']
+    assert downloaded[0].sha256 == hashlib.sha256(CONTENT).hexdigest()
+    assert os.path.getsize(f'{workspace.model_path}/checkpoints/model.safetensors') == len(CONTENT)
+
+
+def test_partial_download_is_outside_the_models_tree(tmp_path, url):
+    workspace = Workspace(base_path=str(tmp_path))
+    downloader = ModelDownloader(workspace, part_size=256, connections_per_file=1)
+    dest = f'{workspace.model_path}/checkpoints/model.safetensors'
+    _Handler.fail_from = 512
+    with pytest.raises(Exception):
+        downloader.download(url, dest)
+
+    # the finished parts are kept for a resume, the models tree has no partial file to index or link
+    part_file, state_file = downloader.staging_files(dest)
+    assert os.path.exists(part_file) and os.path.exists(state_file)
+    assert not part_file.startswith(workspace.model_path)
+    assert [files for _, _, files in os.walk(workspace.model_path) if files] == []
+    assert ModelStore(workspace).scan() == {}
+
+    _Handler.fail_from = None
+    assert downloader.download(url, dest) == hashlib.sha256(CONTENT).hexdigest()
+    assert sorted(ModelStore(workspace).scan()) == ['checkpoints/model.safetensors']
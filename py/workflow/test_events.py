@@ -0,0 +1,51 @@
+""" Run event fan-out to sync and async subscribers """
+import asyncio
+import threading
+
+from .database import WorkflowRunRecord
+from .events import EventBus
+
+
+def _run(run_id, workflow_id, status='running'):
+    return WorkflowRunRecord(id=run_id, workflow_id=workflow_id, status=status, created_at='2024-01-01')
+
+
+def test_subscribers_receive_matching_events():
+    bus = EventBus()
+    by_run = bus.subscribe(run_id=1)
+    by_workflow = bus.subscribe(workflow_id=10)
+    everything = bus.subscribe()
+
+    bus.publish_run(_run(1, 10, 'ready'))
+    bus.publish_run(_run(2, 10, 'running'), type='progress')
+    bus.publish_run(_run(3, 20, 'failed'))
+
+    assert [e.status for e in iter(lambda: by_run.get(timeout=0), None)] == ['ready']
+    assert [(e.run_id, e.type) for e in iter(lambda: by_workflow.get(timeout=0), None)] == [(1, 'status'), (2, 'progress')]
+    assert [e.seq for e in iter(lambda: everything.get(timeout=0), None)] == [1, 2, 3]
+
+    by_run.close()
+    bus.publish_run(_run(1, 10, 'completed'))
+    assert by_run.get(timeout=0) is None
+    assert not bus._by_run
+
+
+def test_slow_subscriber_drops_oldest():
+    bus = EventBus()
+    with bus.subscribe(run_id=1, max_pending=2) as subscription:
+        for status in ('pending', 'ready', 'running'):
+            bus.publish_run(_run(1, 10, status))
+        assert subscription.dropped == 1
+        assert [subscription.get().status, subscription.get().status] == ['ready', 'running']
+
+
+def test_async_subscriber_receives_events_from_threads():
+    bus = EventBus()
+
+    async def watch():
+        async with bus.subscribe_async(workflow_id=10) as subscription:
+            threading.Thread(target=lambda: [bus.publish_run(_run(i, 10)) for i in range(3)]).start()
+            return [(await subscription.get(timeout=5)).run_id for _ in range(3)]
+
+    assert asyncio.run(watch()) == [0, 1, 2]
+    assert not bus._by_workflow
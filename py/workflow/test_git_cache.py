@@ -0,0 +1,55 @@
+""" Git mirror cache and shared checkouts, against a local repository as remote """
+import os
+import subprocess
+
+from . import git_cache
+from .git_cache import GitMirrorCache
+
+
+def git(cwd, *args):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+def commit(path, name):
+    with open(os.path.join(path, name), 'w') as f:
+        f.write(name)
+    git(path, 'add', name)
+    git(path, '-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-q', '-m', name)
+    return git(path, 'rev-parse', 'HEAD')
+
+
+def test_checkouts_share_one_mirror(tmp_path, monkeypatch):
+    remote = str(tmp_path / 'ComfyUI')
+    os.makedirs(remote)
+    git(remote, 'init', '-q')
+    first = commit(remote, 'a.py')
+
+    commands = []
+    run_command = git_cache.run_command
+    monkeypatch.setattr(git_cache, 'run_command', lambda cmd, cwd=None: commands.append(cmd[1]) or run_command(cmd, cwd=cwd))
+
+    cache = GitMirrorCache(str(tmp_path / 'git_mirrors'))
+    dest_1, dest_2 = str(tmp_path / 'wf1/ComfyUI'), str(tmp_path / 'wf2/ComfyUI')
+    assert cache.checkout(remote, first, dest_1)
+    assert cache.checkout(remote, first, dest_2)
+    assert commands.count('clone') == 3 # one mirror, two shared checkouts
+    # objects borrowed by the checkouts are never pruned from the mirror
+    mirror_dir = cache.mirror_dir(remote)
+    assert git(mirror_dir, 'config', 'gc.auto') == '0'
+    assert git(mirror_dir, 'config', 'gc.pruneExpire') == 'never'
+    for dest in (dest_1, dest_2):
+        assert git(dest, 'rev-parse', 'HEAD') == first
+        assert git(dest, 'remote', 'get-url', 'origin') == remote
+        assert os.path.exists(os.path.join(dest, '.git/objects/info/alternates'))
+
+    # already at the pinned commit
+    commands.clear()
+    assert not cache.checkout(remote, first, dest_1)
+    assert commands == []
+
+    # a new pinned commit is fetched into the mirror, the checkout is updated in place
+    second = commit(remote, 'b.py')
+    assert cache.checkout(remote, second, dest_1)
+    assert commands == ['fetch', 'checkout']
+    assert git(dest_1, 'rev-parse', 'HEAD') == second
+    assert os.path.exists(os.path.join(dest_1, 'b.py'))
@@ -0,0 +1,83 @@
+""" GPU placement on simulated devices """
+import threading
+import time
+
+import pytest
+
+from .dao import ResourceRequirements
+from .gpu import GpuAllocator, FakeDeviceProvider, discover_devices
+
+
+def _allocator(*memory_total_mb):
+    return GpuAllocator(discover_devices(FakeDeviceProvider(list(memory_total_mb))))
+
+
+def test_small_workflows_are_packed():
+    allocator = _allocator(24000, 24000)
+    small = [allocator.allocate(ResourceRequirements(gpu_memory_mb=6000)) for _ in range(4)]
+    assert {lease.env['CUDA_VISIBLE_DEVICES'] for lease in small} == {'0'}
+
+    # the free device is kept for a large workflow
+    large = allocator.allocate(ResourceRequirements(gpu_memory_mb=20000), timeout=0)
+    assert large.env == {'CUDA_VISIBLE_DEVICES': '1'}
+    assert [d['memory_used_mb'] for d in allocator.usage()] == [24000, 20000]
+
+
+def test_runs_wait_for_a_device():
+    allocator = _allocator(16000)
+    first = allocator.allocate(ResourceRequirements(gpu_memory_mb=10000))
+    with pytest.raises(TimeoutError):
+        allocator.allocate(ResourceRequirements(gpu_memory_mb=10000), timeout=0.05)
+
+    leases = []
+    waiter = threading.Thread(target=lambda: leases.append(allocator.allocate(ResourceRequirements(gpu_memory_mb=10000))))
+    waiter.start()
+    time.sleep(0.05)
+    assert allocator.usage()[0]['waiting'] == 1
+    first.release()
+    waiter.join(timeout=5)
+    assert leases[0].device.index == 0
+
+
+def test_waiter_past_the_threshold_is_not_starved(monkeypatch):
+    monkeypatch.setattr(GpuAllocator, 'STARVATION_SEC', 0.1)
+    allocator = _allocator(16000)
+    running = allocator.allocate(ResourceRequirements(gpu_memory_mb=10000))
+    leases = []
+    large = threading.Thread(target=lambda: leases.append(allocator.allocate(ResourceRequirements(gpu_memory_mb=12000))))
+    large.start()
+    time.sleep(0.02)
+
+    # small runs are backfilled while the large one has not waited long
+    small = allocator.allocate(ResourceRequirements(gpu_memory_mb=4000), timeout=0)
+    time.sleep(0.15)
+    # then the device is reserved for the large run
+    with pytest.raises(TimeoutError):
+        allocator.allocate(ResourceRequirements(gpu_memory_mb=1000), timeout=0)
+
+    running.release()
+    large.join(timeout=5)
+    assert leases[0].device.index == 0
+    assert [d['memory_used_mb'] for d in allocator.usage()] == [16000]
+    small.release()
+
+
+def test_unknown_and_exclusive_requirements_take_a_whole_device():
+    allocator = _allocator(8000, 8000)
+    unknown = allocator.allocate()
+    exclusive = allocator.allocate(ResourceRequirements(gpu_memory_mb=1000, exclusive=True))
+    assert {unknown.device.index, exclusive.device.index} == {0, 1}
+    with pytest.raises(TimeoutError):
+        allocator.allocate(ResourceRequirements(gpu_memory_mb=1000), timeout=0)
+    exclusive.release()
+    assert allocator.allocate(ResourceRequirements(gpu_memory_mb=1000), timeout=0).device.index == 1
+
+
+def test_requirements_larger_than_any_device_are_rejected():
+    with pytest.raises(ValueError):
+        _allocator(8000).allocate(ResourceRequirements(gpu_memory_mb=9000))
+
+
+def test_cpu_only_node():
+    lease = _allocator().allocate(ResourceRequirements(gpu_memory_mb=9000))
+    assert lease.device is None and lease.env == {}
@@ -0,0 +1,97 @@
+""" Install DAG scheduling, failures and dry-run plans """
+import json
+import threading
+import time
+
+import pytest
+
+from . import database
+from .database import get_workflow_by_dir
+from .workflow_installer import InstallPlan, InstallError, plan_install
+
+
+def test_independent_steps_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    order = []
+    plan = InstallPlan()
+    plan.add('a', lambda: barrier.wait() and None)
+    plan.add('b', lambda: barrier.wait() and None)
+    plan.add('c', lambda: order.append('c') or False, deps=['a', 'b'])
+
+    report = plan.run(max_workers=2)
+    assert [(s.name, s.status) for s in report.steps] == [('a', 'done'), ('b', 'done'), ('c', 'unchanged')]
+    assert order == ['c']
+
+
+def test_failed_step_blocks_dependents():
+    plan = InstallPlan()
+    plan.add('ok', lambda: time.sleep(0.05))
+    plan.add('broken', lambda: 1 / 0)
+    plan.add('after', lambda: None, deps=['broken', 'ok'])
+
+    with pytest.raises(InstallError) as e:
+        plan.run()
+    statuses = {s.name: s.status for s in e.value.report.steps}
+    assert statuses == {'ok': 'done', 'broken': 'failed', 'after': 'blocked'}
+    assert 'ZeroDivisionError' in e.value.report.failed[0].error
+
+
+def test_cycles_are_rejected():
+    plan = InstallPlan()
+    plan.add('a', lambda: None, deps=['b'])
+    plan.add('b', lambda: None, deps=['a'])
+    with pytest.raises(ValueError):
+        plan.order()
+
+
+def _workflow_dirs(tmp_path, *names):
+    workflows = []
+    for name in names:
+        workflow_dir = tmp_path / 'workflows' / name
+        workflow_dir.mkdir(parents=True)
+        with open(workflow_dir / 'dependency.json', 'w') as f:
+            json.dump({'models': [], 'modules': [
+                {'name': 'node_a', 'github_url': 'https://github.com/a/node_a.git', 'commit_sha': 'abc'}]}, f)
+        workflows.append(str(workflow_dir))
+    return workflows
+
+
+def test_dry_run_plan(tmp_path):
+    workflows = _workflow_dirs(tmp_path, 'wf1', 'wf2')
+
+    report = plan_install(str(tmp_path), workflows).run(dry_run=True)
+    names = [s.name for s in report.steps]
+    assert all(s.status == 'planned' for s in report.steps)
+    assert names.index('inventory') < names.index(f'{workflows[0]}:verify:node_a')
+    assert names.index(f'{workflows[1]}:manifest') < names.index(f'{workflows[1]}:db')
+    assert not (tmp_path / 'workflows' / 'wf1' / 'input').exists()
+
+
+def test_reinstall_bumps_the_record_version(tmp_path, db):
+    [workflow_dir] = _workflow_dirs(tmp_path, 'wf1')
+
+    def install():
+        # a new plan per install, like separate install runs; only the steps writing the manifest
+        # and the record, the others need the network
+        plan = plan_install(str(tmp_path), [workflow_dir])
+        for name in ('db:init', f'{workflow_dir}:manifest', f'{workflow_dir}:db'):
+            plan.steps[name].fn()
+        return get_workflow_by_dir(workflow_dir)
+
+    created = install()
+    manifest = (tmp_path / 'workflows' / 'wf1' / 'manifest.json').read_text()
+    # the database configured by the process is kept
+    assert database.engine is db
+    assert created.updated_at is not None
+
+    # re-installing an unchanged workflow is a no-op
+    time.sleep(0.01)
+    assert install().updated_at == created.updated_at
+    assert (tmp_path / 'workflows' / 'wf1' / 'manifest.json').read_text() == manifest
+
+    # a changed workflow is a new version
+    with open(tmp_path / 'workflows' / 'wf1' / 'dependency.json', 'w') as f:
+        json.dump({'models': [], 'modules': [], 'resources': {'gpu_memory_mb': 6000}}, f)
+    updated = install()
+    assert updated.id == created.id and updated.updated_at > created.updated_at
+    assert json.loads(manifest)['id'] == json.loads((tmp_path / 'workflows' / 'wf1' / 'manifest.json').read_text())['id']
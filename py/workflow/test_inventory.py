@@ -0,0 +1,108 @@
+""" Incremental inventory reconstruction and direct git metadata reads """
+import os
+import subprocess
+
+from . import dao
+from .dao import reconstruct_inventory
+from .gitmeta import read_git_metadata, _read_git_metadata_subprocess
+
+
+def git(cwd, *args):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+def make_repo(path, url):
+    os.makedirs(path, exist_ok=True)
+    git(path, 'init', '-q')
+    git(path, 'remote', 'add', 'origin', url)
+    commit(path)
+
+
+def commit(path):
+    git(path, '-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-q', '--allow-empty', '-m', 'c')
+
+
+def make_workspace(base_path):
+    make_repo(f'{base_path}/ComfyUI', 'https://github.com/comfyanonymous/ComfyUI.git')
+    make_repo(f'{base_path}/modules/node_a', 'https://github.com/a/node_a.git')
+    make_repo(f'{base_path}/modules/node_b', 'https://github.com/b/node_b.git')
+    os.makedirs(f'{base_path}/models/checkpoints/sd15')
+    with open(f'{base_path}/models/checkpoints/sd15/model.safetensors', 'wb') as f:
+        f.write(b'0' * 16)
+    open(f'{base_path}/models/checkpoints/empty.safetensors', 'wb').close()
+
+
+def test_read_git_metadata_matches_git(tmp_path):
+    repo = str(tmp_path / 'repo')
+    make_repo(repo, 'https://github.com/a/repo.git')
+    assert read_git_metadata(repo) == _read_git_metadata_subprocess(repo)
+
+    # packed refs, detached HEAD and push url
+    git(repo, 'pack-refs', '--all')
+    git(repo, 'remote', 'set-url', '--push', 'origin', 'git@github.com:a/repo.git')
+    assert read_git_metadata(repo) == _read_git_metadata_subprocess(repo)
+    git(repo, 'checkout', '-q', '--detach')
+    assert read_git_metadata(repo) == _read_git_metadata_subprocess(repo)
+
+    assert read_git_metadata(str(tmp_path)) == ('', '')
+
+
+def test_incremental_reconstruction(tmp_path, monkeypatch):
+    base_path = str(tmp_path)
+    make_workspace(base_path)
+
+    reads = []
+    def counting_read(module_path):
+        reads.append(os.path.basename(module_path))
+        return read_git_metadata(module_path)
+    monkeypatch.setattr(dao, 'read_git_metadata', counting_read)
+
+    inventory = reconstruct_inventory(base_path)
+    assert sorted(reads) == ['ComfyUI', 'node_a', 'node_b']
+    assert inventory.modules['node_a'].commit_sha == git(f'{base_path}/modules/node_a', 'rev-parse', 'HEAD')
+    assert list(inventory.models.keys()) == ['checkpoints/sd15/model.safetensors']
+
+    # nothing changed, nothing re-read
+    reads.clear()
+    assert reconstruct_inventory(base_path).modules == inventory.modules
+    assert reads == []
+
+    # new commit in one module, a new model and an empty file filled in place
+    commit(f'{base_path}/modules/node_b')
+    with open(f'{base_path}/models/checkpoints/sd15/lora.safetensors', 'wb') as f:
+        f.write(b'1')
+    with open(f'{base_path}/models/checkpoints/empty.safetensors', 'wb') as f:
+        f.write(b'2')
+    inventory = reconstruct_inventory(base_path)
+    assert reads == ['node_b']
+    assert inventory.modules['node_b'].commit_sha == git(f'{base_path}/modules/node_b', 'rev-parse', 'HEAD')
+    assert sorted(inventory.models.keys()) == [
+        'checkpoints/empty.safetensors', 'checkpoints/sd15/lora.safetensors', 'checkpoints/sd15/model.safetensors']
+
+    reads.clear()
+    reconstruct_inventory(base_path, full_rescan=True)
+    assert sorted(reads) == ['ComfyUI', 'node_a', 'node_b']
+
+
+def test_model_replaced_in_place_is_not_reused(tmp_path):
+    base_path = str(tmp_path)
+    make_workspace(base_path)
+    model_file = f'{base_path}/models/checkpoints/sd15/model.safetensors'
+    reconstruct_inventory(base_path)
+
+    # digest of the file set by the model store, kept while the file is unchanged
+    inventory = dao._load_inventory(base_path)
+    inventory.models['checkpoints/sd15/model.safetensors'][1].sha256 = 'old'
+    with open(f'{base_path}/inventory.json', 'w') as f:
+        f.write(inventory.model_dump_json())
+    assert reconstruct_inventory(base_path).models['checkpoints/sd15/model.safetensors'][1].sha256 == 'old'
+
+    # same size, new content, the directory mtime does not change
+    dir_mtime_ns = os.stat(os.path.dirname(model_file)).st_mtime_ns
+    st = os.stat(model_file)
+    with open(model_file, 'wb') as f:
+        f.write(b'1' * 16)
+    os.utime(model_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert os.stat(os.path.dirname(model_file)).st_mtime_ns == dir_mtime_ns
+    model = reconstruct_inventory(base_path).models['checkpoints/sd15/model.safetensors'][1]
+    assert model.sha256 is None and model.size is None
@@ -0,0 +1,66 @@
+""" Model store hashing, incremental index and dedup """
+import hashlib
+import os
+
+from .dao import Workspace, reconstruct_inventory
+from .model_store import ModelStore
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def test_scan_is_incremental(tmp_path, monkeypatch):
+    workspace = Workspace(base_path=str(tmp_path))
+    write(f'{workspace.model_path}/checkpoints/a.safetensors', b'a' * 100)
+    write(f'{workspace.model_path}/loras/b.safetensors', b'b' * 10)
+
+    hashed = []
+    hash_file = ModelStore.hash_file
+    monkeypatch.setattr(ModelStore, 'hash_file', staticmethod(lambda p: hashed.append(os.path.basename(p)) or hash_file(p)))
+
+    store = ModelStore(workspace, max_workers=2)
+    index = store.scan()
+    assert sorted(hashed) == ['a.safetensors', 'b.safetensors']
+    digest = hashlib.sha256(b'a' * 100).hexdigest()
+    assert index['checkpoints/a.safetensors'].sha256 == digest
+    assert os.path.samefile(store.blob_path(digest), f'{workspace.model_path}/checkpoints/a.safetensors')
+
+    # a new store instance reuses the persisted index
+    hashed.clear()
+    write(f'{workspace.model_path}/loras/c.safetensors', b'c' * 10)
+    ModelStore(workspace).scan()
+    assert hashed == ['c.safetensors']
+
+    # the store is not part of the inventory
+    inventory = ModelStore(workspace).annotate(reconstruct_inventory_models(workspace))
+    assert sorted(inventory.models.keys()) == ['checkpoints/a.safetensors', 'loras/b.safetensors', 'loras/c.safetensors']
+    assert inventory.models['checkpoints/a.safetensors'][1].sha256 == digest
+
+
+def reconstruct_inventory_models(workspace):
+    os.makedirs(workspace.module_path, exist_ok=True)
+    os.makedirs(workspace.base_code_path, exist_ok=True)
+    return reconstruct_inventory(workspace.base_path)
+
+
+def test_dedup_and_gc(tmp_path):
+    workspace = Workspace(base_path=str(tmp_path))
+    write(f'{workspace.model_path}/checkpoints/sd15.safetensors', b'x' * 1000)
+    write(f'{workspace.model_path}/checkpoints/sd15_copy.safetensors', b'x' * 1000)
+    write(f'{workspace.model_path}/vae/other.safetensors', b'y' * 10)
+
+    store = ModelStore(workspace)
+    store.scan()
+    assert list(store.duplicates().values()) == [['checkpoints/sd15.safetensors', 'checkpoints/sd15_copy.safetensors']]
+    assert store.dedup() == 1000
+    assert store.duplicates() == {}
+    assert os.path.samefile(f'{workspace.model_path}/checkpoints/sd15.safetensors',
+                            f'{workspace.model_path}/checkpoints/sd15_copy.safetensors')
+
+    # nothing links to the blob once the model is deleted
+    os.remove(f'{workspace.model_path}/vae/other.safetensors')
+    store.scan()
+    assert store.gc() == 10
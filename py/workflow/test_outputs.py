@@ -0,0 +1,41 @@
+""" Output manifest built from the prompt history """
+import hashlib
+
+from .outputs import build_output_manifest
+
+
+def _history(*items, text=None):
+    outputs = {'9': {'images': list(items)}}
+    if text is not None:
+        outputs['12'] = {'text': [text]}
+    return {'status': {'status_str': 'success'}, 'outputs': outputs}
+
+
+def test_manifest_lists_history_outputs(tmp_path):
+    output_dir, temp_dir = tmp_path / 'output', tmp_path / 'temp'
+    (output_dir / 'item_1').mkdir(parents=True)
+    temp_dir.mkdir()
+    (output_dir / 'item_1' / 'a.png').write_bytes(b'png')
+    (output_dir / 'prompt_history_x.json').write_text('{}')
+    (temp_dir / 'preview.png').write_bytes(b'preview')
+
+    history = _history(
+        {'filename': 'a.png', 'subfolder': 'item_1', 'type': 'output'},
+        {'filename': 'preview.png', 'subfolder': '', 'type': 'temp'},
+        {'filename': 'missing.png', 'subfolder': '', 'type': 'output'},
+        {'filename': '../../etc/passwd', 'subfolder': '', 'type': 'output'},
+        text='a caption',
+    )
+
+    manifest = build_output_manifest(history, str(output_dir))
+    assert [(o.node_id, o.kind, o.rel_path) for o in manifest] == [('9', 'images', 'item_1/a.png')]
+    assert manifest[0].size == 3
+    assert manifest[0].sha256 == hashlib.sha256(b'png').hexdigest()
+    assert manifest[0].path == str(output_dir / 'item_1' / 'a.png')
+
+    manifest = build_output_manifest(history, str(output_dir), temp_dir=str(temp_dir))
+    assert [o.type for o in manifest] == ['output', 'temp']
+
+
+def test_manifest_of_failed_prompt_is_empty(tmp_path):
+    assert build_output_manifest({'status': {'status_str': 'error'}}, str(tmp_path)) == []
@@ -0,0 +1,109 @@
+""" Server pool lease/release/eviction, using fake servers instead of ComfyUI processes """
+import threading
+
+import pytest
+
+from .dao import Workspace, Workflow, RuntimeEnv, ComfyUIDependencyConfig, CodeDependency
+from .database import WorkflowRunRecord
+from .pool import ComfyUIServerPool, PoolConfig
+
+
+class FakeServer:
+    def __init__(self, workflow, home_dir, env=None):
+        self.workflow = workflow
+        self.home_dir = home_dir
+        self.host = '127.0.0.1'
+        self.port = '8189'
+        self.process = None
+        self.alive = False
+        self.bound_run_id = None
+        self.starts = 0
+
+    def start(self):
+        self.process = object()
+        self.alive = True
+        self.starts += 1
+
+    def wait_until_ready(self, timeout=None):
+        pass
+
+    def is_alive(self):
+        return self.alive
+
+    def bind(self, workflow_run):
+        self.bound_run_id = workflow_run.id
+
+    def unbind(self):
+        self.bound_run_id = None
+
+    def stop(self):
+        self.alive = False
+
+
+def _workflow(name='wf'):
+    return Workflow(
+        name=name,
+        workflow_dir=f'/tmp/workflows/{name}',
+        python_venv=RuntimeEnv(venv_path='/tmp/venv'),
+        dependency_config=ComfyUIDependencyConfig(
+            base_code=CodeDependency(name='ComfyUI', github_url='url', commit_sha='sha')))
+
+
+def _run(run_id):
+    return WorkflowRunRecord(id=run_id, workflow_id=1, status='pending', created_at='now', runtime_dir=f'/tmp/runs/{run_id}')
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ComfyUIServerPool(Workspace(base_path=str(tmp_path)), PoolConfig(max_size=1), server_factory=FakeServer)
+    yield pool
+    pool.shutdown()
+
+
+def test_server_is_reused_across_runs(pool):
+    workflow = _workflow()
+    server = pool.lease(workflow, _run(1))
+    assert server.bound_run_id == 1
+    pool.release(server)
+    assert server.bound_run_id is None
+
+    again = pool.lease(workflow, _run(2))
+    assert again is server
+    assert again.starts == 1
+    pool.release(again)
+
+
+def test_lease_waits_when_pool_is_full(pool):
+    workflow = _workflow()
+    server = pool.lease(workflow, _run(1))
+    with pytest.raises(TimeoutError):
+        pool.lease(workflow, _run(2), timeout=0.05)
+
+    threading.Timer(0.05, pool.release, args=[server]).start()
+    assert pool.lease(workflow, _run(2), timeout=5) is server
+
+
+def test_dead_server_is_replaced(pool):
+    workflow = _workflow()
+    server = pool.lease(workflow, _run(1))
+    pool.release(server)
+    server.alive = False
+
+    replacement = pool.lease(workflow, _run(2))
+    assert replacement is not server
+    pool.release(replacement)
+
+
+def test_evict_idle_keeps_min_size(tmp_path):
+    pool = ComfyUIServerPool(Workspace(base_path=str(tmp_path)),
+                             PoolConfig(min_size=1, max_size=2, idle_timeout_sec=0), server_factory=FakeServer)
+    workflow = _workflow()
+    first = pool.lease(workflow, _run(1))
+    second = pool.lease(workflow, _run(2))
+    pool.release(first)
+    pool.release(second)
+
+    pool.evict_idle()
+    assert [first.alive, second.alive].count(True) == 1
+    pool.shutdown()
+    assert not first.alive and not second.alive
@@ -0,0 +1,67 @@
+""" Port leases of ComfyUI servers """
+import socket
+
+import pytest
+
+from .ports import PortAllocator, PortsExhausted
+
+
+def _free_range(size):
+    # a range of ports that are free right now
+    for first in range(20000, 30000, 50):
+        socks = []
+        try:
+            for port in range(first, first + size):
+                sock = socket.socket()
+                sock.bind(('', port))
+                socks.append(sock)
+            return f'{first}-{first + size - 1}'
+        except OSError:
+            continue
+        finally:
+            for sock in socks:
+                sock.close()
+    pytest.skip('no free port range')
+
+
+def test_ports_are_leased_in_order_until_released(tmp_path):
+    allocator = PortAllocator(_free_range(3), lock_dir=str(tmp_path))
+    leases = [allocator.reserve() for _ in range(3)]
+    assert [l.port for l in leases] == [allocator.first, allocator.first + 1, allocator.first + 2]
+    with pytest.raises(PortsExhausted):
+        allocator.reserve()
+
+    leases[1].release()
+    assert allocator.reserve().port == allocator.first + 1
+    assert allocator.leased() == {l.port for l in leases}
+
+
+def test_ports_in_use_are_skipped(tmp_path):
+    port_range = _free_range(3)
+    first = int(port_range.split('-')[0])
+    listener = socket.socket()
+    listener.bind(('', first))
+    listener.listen()
+    try:
+        # another process of the node holds the lock of the second port
+        other = PortAllocator(port_range, lock_dir=str(tmp_path))
+        other._next = first + 1
+        other_lease = other.reserve()
+
+        allocator = PortAllocator(port_range, lock_dir=str(tmp_path))
+        assert allocator.reserve().port == first + 2
+        other_lease.release()
+    finally:
+        listener.close()
+
+
+def test_held_port_can_be_bound_after_unhold(tmp_path):
+    lease = PortAllocator(_free_range(1), lock_dir=str(tmp_path)).reserve()
+    server = socket.socket()
+    with pytest.raises(OSError):
+        server.bind(('', lease.port))
+    lease.unhold()
+    server.bind(('', lease.port))
+    server.close()
+    lease.release()
+    assert lease.released
@@ -0,0 +1,69 @@
+""" Readiness probe against fake services and real child processes """
+import subprocess
+import sys
+
+import pytest
+
+from .readiness import ReadinessProbe, ServerStartupError, StartupHistogram, StartupMetrics
+
+
+class FakeService:
+    host = '127.0.0.1'
+    port = '8189'
+
+    def __init__(self, ready_after):
+        self.ready_after = ready_after
+        self.probes = 0
+        self.timeouts = []
+
+    def is_server_ready(self, timeout=None):
+        self.probes += 1
+        self.timeouts.append(timeout)
+        return self.probes > self.ready_after
+
+
+def _sleeper(seconds=30):
+    return subprocess.Popen([sys.executable, '-c', f'import time; time.sleep({seconds})'])
+
+
+def test_ready_after_a_few_fast_probes():
+    process = _sleeper()
+    try:
+        service = FakeService(ready_after=3)
+        elapsed = ReadinessProbe(service, process, deadline_sec=10).wait()
+        assert service.probes == 4
+        # 0.1 + 0.2 + 0.4 of backoff, far below the old fixed 5s sleep
+        assert elapsed < 2
+        assert all(t == ReadinessProbe.PROBE_TIMEOUT_SEC for t in service.timeouts)
+    finally:
+        process.kill()
+
+
+def test_process_exit_stops_probing():
+    process = subprocess.Popen([sys.executable, '-c', 'import sys; sys.exit(3)'])
+    service = FakeService(ready_after=1000)
+    with pytest.raises(ServerStartupError, match='code 3'):
+        ReadinessProbe(service, process, deadline_sec=10).wait()
+
+
+def test_deadline_fails_startup():
+    process = _sleeper()
+    try:
+        with pytest.raises(ServerStartupError, match='not ready'):
+            ReadinessProbe(FakeService(ready_after=1000), process, deadline_sec=0.3).wait()
+    finally:
+        process.kill()
+
+
+def test_startup_histogram():
+    histogram = StartupHistogram(buckets=[1, 5])
+    for seconds in [0.5, 1, 3, 60]:
+        histogram.observe(seconds)
+    snapshot = histogram.snapshot()
+    assert snapshot['buckets'] == [(1, 2), (5, 3), (float('inf'), 4)]
+    assert snapshot['count'] == 4
+
+    metrics = StartupMetrics()
+    metrics.observe('sticker', 1.2)
+    metrics.observe_failure('sticker')
+    assert metrics.snapshot()['sticker']['failures'] == 1
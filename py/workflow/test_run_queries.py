@@ -0,0 +1,59 @@
+""" SQL filtered, keyset paginated run listings """
+import pytest
+from sqlalchemy import inspect
+
+from . import database
+from .database import (
+    WorkflowRecord, WorkflowRunRecord, create_workflow, create_workflow_run, list_workflows, query_workflow_runs
+)
+
+
+def _create_runs():
+    runs = []
+    for i in range(10):
+        runs.append(create_workflow_run(WorkflowRunRecord(
+            workflow_id=1 + i % 2,
+            status='completed' if i % 3 else 'failed',
+            # two runs per second, ties are ordered by id
+            created_at=f'2024-01-01T00:00:0{i // 2}',
+        )))
+    return runs
+
+
+def test_indexes_are_created(db):
+    indexes = {i['name'] for i in inspect(database.engine).get_indexes('workflowrunrecord')}
+    assert {'ix_workflowrunrecord_status_created_at', 'ix_workflowrunrecord_workflow_id_created_at'} <= indexes
+
+
+def test_pages_cover_all_runs_newest_first(db):
+    runs = _create_runs()
+    seen, cursor = [], None
+    while True:
+        page = query_workflow_runs(limit=3, cursor=cursor)
+        seen.extend(r.id for r in page.runs)
+        if page.next_cursor is None:
+            break
+        cursor = page.next_cursor
+    assert seen == [r.id for r in reversed(runs)]
+
+
+def test_filters(db):
+    runs = _create_runs()
+    page = query_workflow_runs(status='failed', workflow_id=1)
+    assert [r.id for r in page.runs] == [r.id for r in reversed(runs) if r.status == 'failed' and r.workflow_id == 1]
+
+    page = query_workflow_runs(status=['failed', 'running'], created_after='2024-01-01T00:00:01',
+                               created_before='2024-01-01T00:00:04')
+    assert [r.id for r in page.runs] == [runs[6].id, runs[3].id]
+    assert page.next_cursor is None
+
+    with pytest.raises(ValueError):
+        query_workflow_runs(cursor='not a cursor')
+
+
+def test_list_workflows_pages(db):
+    for i in range(5):
+        create_workflow(WorkflowRecord(name=f'wf{i}', created_at='2024-01-01', workflow_dir=f'/wf{i}'))
+    first = list_workflows(limit=2)
+    rest = list_workflows(after_id=first[-1].id)
+    assert [w.name for w in first + rest] == [f'wf{i}' for i in range(5)]
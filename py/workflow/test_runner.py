@@ -0,0 +1,83 @@
+""" ComfyUIRunner prompt handling against a fake ComfyUI service """
+import json
+import os
+
+from .controller import ComfyUIRunner
+from .dao import Workflow, Workspace, RuntimeEnv, ComfyUIDependencyConfig, CodeDependency
+from .database import WorkflowRunRecord
+from .template import compile_workflow
+from .tracker import PromptCompletionTracker
+
+
+class FakeService:
+    """ Prompts complete as soon as they are submitted """
+
+    def __init__(self):
+        self.prompts = []
+
+    def submit_prompt(self, prompt, client_id):
+        self.prompts.append(prompt)
+        return {'prompt_id': f'p{len(self.prompts)}', 'number': len(self.prompts), 'node_errors': {}}
+
+    def get_history(self, prompt_id):
+        return {prompt_id: {'status': {'status_str': 'success', 'completed': True}, 'outputs': {}}}
+
+
+class FakeServer:
+    host = '127.0.0.1'
+    port = '1' # nothing listens, the tracker polls
+
+    def __init__(self):
+        self.service = FakeService()
+        self.service.host, self.service.port = self.host, self.port
+
+
+def make_workflow(tmp_path) -> Workflow:
+    return Workflow(
+        name='test', workflow_dir=str(tmp_path / 'workflow'), python_venv=RuntimeEnv(venv_path='/tmp/venv'),
+        dependency_config=ComfyUIDependencyConfig(
+            base_code=CodeDependency(name='ComfyUI', github_url='https://github.com/comfyanonymous/ComfyUI', commit_sha='abc')))
+
+
+def test_batch_item_without_config_fails_the_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(PromptCompletionTracker, 'POLL_INITIAL_INTERVAL_SEC', 0.001)
+    workflow_run = WorkflowRunRecord(id=1, workflow_id=1, status='pending', created_at='now',
+                                     input_override_json=json.dumps([{'seed': 0}, {'seed': 1}, {'seed': 2}]))
+    statuses = []
+    # a pool keeps the runner from creating a dedicated server
+    runner = ComfyUIRunner(Workspace(base_path=str(tmp_path)), make_workflow(tmp_path), workflow_run,
+                           callback=lambda r: statuses.append(r.status), pool=object())
+    server = FakeServer()
+    runner._attach_server(server)
+    # the config of the second item can not be loaded
+    monkeypatch.setattr(runner, '_load_workflow_config',
+                        lambda override: None if override['seed'] == 1 else {'3': {'inputs': dict(override)}})
+
+    runner.run()
+
+    results = json.loads(workflow_run.batch_results_json)
+    assert [(r['prompt_id'], r['status']) for r in results] == [('p1', 'completed'), (None, 'failed'), ('p2', 'completed')]
+    assert results[1]['error'] == 'can not load workflow config'
+    # prompts already submitted are tracked to completion, the run fails
+    assert len(server.service.prompts) == 2
+    assert statuses[-1] == 'failed' and 'running' in statuses
+
+
+def test_batch_outputs_are_prefixed_per_item(tmp_path, monkeypatch):
+    monkeypatch.setattr(PromptCompletionTracker, 'POLL_INITIAL_INTERVAL_SEC', 0.001)
+    workflow = make_workflow(tmp_path)
+    os.makedirs(workflow.workflow_dir)
+    with open(os.path.join(workflow.workflow_dir, 'workflow_api.json'), 'w') as f:
+        json.dump({'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'out'}}}, f)
+
+    for _ in range(2):
+        # empty overrides, every item is the cached graph of the compiled workflow
+        workflow_run = WorkflowRunRecord(id=1, workflow_id=1, status='pending', created_at='now',
+                                         input_override_json=json.dumps([{}, {}, {}]))
+        runner = ComfyUIRunner(Workspace(base_path=str(tmp_path)), workflow, workflow_run, pool=object())
+        server = FakeServer()
+        runner._attach_server(server)
+        runner.run()
+        prefixes = [prompt['9']['inputs']['filename_prefix'] for prompt in server.service.prompts]
+        assert prefixes == ['item_0/out', 'item_1/out', 'item_2/out']
+    assert compile_workflow(workflow.workflow_dir).apply({})['9']['inputs']['filename_prefix'] == 'out'
@@ -0,0 +1,170 @@
+""" Job scheduler slots: concurrency, prefetch, per-slot devices and drain, on fake job queue schedulers """
+import threading
+import time
+
+import pytest
+
+from .slots import SlotScheduler, SlotConfig
+
+
+class FakeJobQueue:
+    """ Jobs shared by the pollers, outcomes recorded by job name """
+
+    def __init__(self, jobs):
+        self.lock = threading.Lock()
+        self.jobs = list(jobs)
+        self.claimed = []
+        self.completed = {}
+        self.failed = {}
+
+    def claim(self):
+        with self.lock:
+            if not self.jobs:
+                return None
+            self.claimed.append(self.jobs[0])
+            return self.jobs.pop(0)
+
+
+class FakeJobScheduler:
+    """ The interface of job_queue.SingleThreadJobScheduler: claim a job, call its workflow, report the outcome """
+
+    def __init__(self, job_queue: FakeJobQueue):
+        self.job_queue = job_queue
+        self.workflows = {}
+
+    def register_workflow(self, name, workflow):
+        self.workflows[name] = workflow
+
+    def run(self):
+        while True:
+            request = self.job_queue.claim()
+            if request is None:
+                time.sleep(0.01)
+                continue
+            try:
+                self.job_queue.completed[request] = self.workflows['test'](request)
+            except Exception as e:
+                self.job_queue.failed[request] = str(e)
+
+
+class SlotWorkflow:
+    """ Hold a slot until the job is released by the test """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.lock = threading.Condition()
+        self.running = []
+        self.max_running = 0
+        self.released = set()
+
+    def __call__(self, request):
+        with self.scheduler.acquire_slot() as slot:
+            with self.lock:
+                self.running.append(request)
+                self.max_running = max(self.max_running, len(self.running))
+                self.lock.notify_all()
+                self.lock.wait_for(lambda: request in self.released or '*' in self.released, timeout=10)
+                self.running.remove(request)
+                self.lock.notify_all()
+            return slot.env
+
+    def release(self, request='*'):
+        with self.lock:
+            self.released.add(request)
+            self.lock.notify_all()
+
+    def wait_running(self, *requests):
+        with self.lock:
+            assert self.lock.wait_for(lambda: self.running == list(requests), timeout=5)
+
+
+@pytest.fixture(autouse=True)
+def no_report_grace(monkeypatch):
+    monkeypatch.setattr(SlotScheduler, 'REPORT_GRACE_SEC', 0)
+
+
+def _scheduler(job_queue, devices, prefetch=0):
+    scheduler = SlotScheduler(lambda: FakeJobScheduler(job_queue), [SlotConfig(slot_id=i, cuda_visible_devices=d) for i, d in enumerate(devices)],
+                              prefetch=prefetch)
+    workflow = SlotWorkflow(scheduler)
+    scheduler.register_workflow('test', workflow)
+    return scheduler, workflow
+
+
+def _wait(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_jobs_run_on_slots_with_their_devices():
+    job_queue = FakeJobQueue([f'job{i}' for i in range(6)])
+    scheduler, workflow = _scheduler(job_queue, ['0', '1'])
+    scheduler.start()
+
+    _wait(lambda: len(workflow.running) == 2)
+    workflow.release()
+    _wait(lambda: len(job_queue.completed) == 6)
+    assert workflow.max_running == 2
+    devices = [env['CUDA_VISIBLE_DEVICES'] for env in job_queue.completed.values()]
+    assert set(devices) == {'0', '1'}
+    scheduler.shutdown(timeout=5)
+
+
+def test_prefetched_job_waits_for_a_slot():
+    job_queue = FakeJobQueue(['job0', 'job1', 'job2'])
+    scheduler, workflow = _scheduler(job_queue, ['0'], prefetch=1)
+    scheduler.start()
+
+    workflow.wait_running('job0')
+    _wait(lambda: len(job_queue.claimed) == 2)
+    time.sleep(0.05)
+    # one job running, one claimed ahead, the third stays on the queue
+    assert job_queue.claimed == ['job0', 'job1'] and job_queue.jobs == ['job2']
+    assert workflow.running == ['job0'] and scheduler.in_flight == 2
+
+    workflow.release('job0')
+    workflow.wait_running('job1')
+    workflow.release()
+    _wait(lambda: len(job_queue.completed) == 3)
+    scheduler.shutdown(timeout=5)
+
+
+def test_shutdown_waits_for_jobs_in_flight():
+    job_queue = FakeJobQueue(['job0', 'job1'])
+    scheduler, workflow = _scheduler(job_queue, ['0'], prefetch=1)
+    scheduler.start()
+    workflow.wait_running('job0')
+    _wait(lambda: len(job_queue.claimed) == 2)
+
+    drained = []
+    drain = threading.Thread(target=lambda: drained.append(scheduler.shutdown(timeout=5)))
+    drain.start()
+    time.sleep(0.05)
+    assert drained == [] and scheduler.in_flight == 2 # job0 running, job1 claimed and waiting for the slot
+
+    workflow.release()
+    drain.join()
+    assert drained == [True]
+    # claimed jobs ran to completion, none failed
+    assert sorted(job_queue.completed) == ['job0', 'job1'] and job_queue.failed == {}
+
+
+def test_job_error_and_shutdown_timeout():
+    job_queue = FakeJobQueue(['job0'])
+    scheduler = SlotScheduler(lambda: FakeJobScheduler(job_queue), [SlotConfig(slot_id=0)])
+
+    def broken(request):
+        raise ValueError('no such input')
+    scheduler.register_workflow('test', broken)
+    scheduler.start()
+    _wait(lambda: job_queue.failed)
+    assert job_queue.failed == {'job0': 'no such input'} and scheduler.in_flight == 0
+
+    job_queue = FakeJobQueue(['job0'])
+    scheduler, workflow = _scheduler(job_queue, ['0'])
+    scheduler.start()
+    workflow.wait_running('job0')
+    assert scheduler.shutdown(timeout=0.05) is False
+    workflow.release()
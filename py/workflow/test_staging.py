@@ -0,0 +1,46 @@
+""" Staging of run input files by move, hard link, reflink or copy """
+import errno
+import os
+
+from . import staging
+from .staging import stage_files
+
+
+def write(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return str(path)
+
+
+def test_link_and_move_copy_nothing(tmp_path):
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    shared = write(tmp_path / 'video.mp4', 1000)
+    owned = write(tmp_path / 'audio.wav', 10)
+
+    report = stage_files([shared], str(input_dir))
+    assert report.files[0].method == 'hardlink'
+    assert os.path.samefile(shared, input_dir / 'video.mp4')
+
+    report = stage_files([owned], str(input_dir), move=True)
+    assert report.files[0].method == 'move'
+    assert not os.path.exists(owned) and os.path.exists(input_dir / 'audio.wav')
+    assert report.bytes_copied == 0
+
+
+def test_copy_across_devices(tmp_path, monkeypatch):
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    src = write(tmp_path / 'image.png', 100)
+    # an older staged file is replaced
+    write(input_dir / 'image.png', 1)
+
+    def cross_device(*args):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(staging.os, 'link', cross_device)
+    monkeypatch.setattr(staging, '_reflink', lambda src, dst: False)
+
+    report = stage_files([src], str(input_dir))
+    assert report.files[0].method == 'copy'
+    assert report.bytes_copied == 100
+    assert os.path.getsize(input_dir / 'image.png') == 100
@@ -0,0 +1,42 @@
+""" Write-behind status updates against a file database """
+import threading
+
+from sqlmodel import SQLModel, Session
+
+from .database import WorkflowRunRecord, StatusWriter, DatabaseConfig, create_db_engine
+
+
+def test_updates_are_coalesced_and_committed(tmp_path):
+    engine = create_db_engine(DatabaseConfig.sqlite_file(str(tmp_path / 'workflow.db')))
+    SQLModel.metadata.create_all(engine)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+
+    runs = []
+    for i in range(4):
+        with Session(engine) as session:
+            run = WorkflowRunRecord(workflow_id=1, status='pending', created_at=f'2024-01-0{i + 1}')
+            session.add(run)
+            session.commit()
+            session.refresh(run)
+            runs.append(run)
+
+    writer = StatusWriter(engine, batch_interval_sec=0.05)
+
+    def run_updates(run):
+        for status in ('ready', 'running', 'running', 'completed'):
+            run.status = status
+            writer.submit(run)
+    threads = [threading.Thread(target=run_updates, args=(run,)) for run in runs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # the record of the runner is not touched by the writer
+    runs[0].status = 'mutated after submit'
+
+    assert writer.flush(timeout=5)
+    with Session(engine) as session:
+        assert [session.get(WorkflowRunRecord, run.id).status for run in runs] == ['completed'] * 4
+    assert writer.writes <= 16
+    assert writer.commits < writer.writes
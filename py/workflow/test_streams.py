@@ -0,0 +1,63 @@
+""" Chunked input copy, lazily opened outputs and file hashing """
+import hashlib
+import io
+import os
+
+from .streams import copy_stream, LazyFile, update_digest, sha256_file
+
+
+class _Stream(io.RawIOBase):
+    """ A job input stream, records the largest read """
+
+    def __init__(self, size):
+        self.remaining = size
+        self.max_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.remaining)
+        self.max_read = max(self.max_read, len(buffer))
+        buffer[:n] = b'x' * n
+        self.remaining -= n
+        return n
+
+
+def test_copy_stream_is_chunked(tmp_path):
+    src = _Stream(5 * 1024 * 1024 + 7)
+    dst = str(tmp_path / 'job/input.mp4')
+    assert copy_stream(src, dst, chunk_size=64 * 1024) == 5 * 1024 * 1024 + 7
+    assert os.path.getsize(dst) == 5 * 1024 * 1024 + 7
+    assert src.max_read <= 64 * 1024
+
+
+def test_lazy_file(tmp_path):
+    path = tmp_path / 'out.png'
+    path.write_bytes(b'0123456789')
+
+    f = LazyFile(str(path))
+    assert f._f is None # not opened until read
+    assert list(f.chunks(4)) == [b'0123', b'4567', b'89']
+    assert f._f is None # closed at end of file
+    f.seek(2)
+    assert f.read() == b'23456789'
+    f.close()
+
+
+def test_file_and_ranges_are_hashed_in_chunks(tmp_path):
+    data = os.urandom(100 * 1024 + 3)
+    path = tmp_path / 'model.safetensors'
+    path.write_bytes(data)
+    assert sha256_file(str(path)) == hashlib.sha256(data).hexdigest()
+
+    # ranges fed in order give the digest of the whole file
+    digest = hashlib.sha256()
+    assert update_digest(digest, str(path), end=4096, chunk_size=1000) == 4096
+    assert update_digest(digest, str(path), start=4096, chunk_size=1000) == len(data) - 4096
+    assert digest.hexdigest() == hashlib.sha256(data).hexdigest()
+    # short read past the end of file
+    assert update_digest(hashlib.sha256(), str(path), start=len(data) - 10, end=len(data) + 10) == 10
+
+    (tmp_path / 'empty').write_bytes(b'')
+    assert sha256_file(str(tmp_path / 'empty')) == hashlib.sha256().hexdigest()
@@ -0,0 +1,70 @@
+""" Compiled input override templates """
+import json
+import os
+
+import pytest
+
+from .template import compile_workflow, OverrideTemplateError
+
+
+GRAPH = {
+    "3": {"class_type": "KSampler", "inputs": {"seed": 1, "steps": 20, "model": ["4", 0]}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat"}},
+    "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI"}},
+}
+
+
+def write_workflow(workflow_dir, override_value, override_template, graph=GRAPH):
+    with open(os.path.join(workflow_dir, 'workflow_api.json'), 'w') as f:
+        json.dump(graph, f)
+    with open(os.path.join(workflow_dir, 'input_override.json'), 'w') as f:
+        json.dump({'override_value': override_value, 'override_template': override_template}, f)
+
+
+def test_render_applies_params_and_defaults(tmp_path):
+    write_workflow(str(tmp_path), {'seed': 42, 'prompt': 'a dog'},
+                   {'3': {'inputs': {'seed': 'seed'}}, '6': {'inputs': {'text': 'prompt'}}})
+    compiled = compile_workflow(str(tmp_path))
+
+    assert compiled.resolve({'seed': 7}) == {'3': {'inputs': {'seed': 7}}, '6': {'inputs': {'text': 'a dog'}}}
+
+    prompt = compiled.render({'seed': 7})
+    assert prompt['3']['inputs'] == {'seed': 7, 'steps': 20, 'model': ['4', 0]}
+    assert prompt['6']['inputs']['text'] == 'a dog'
+    # untouched nodes are shared, touched nodes are copied
+    assert prompt['9'] is compiled.graph['9']
+    assert compiled.graph['3']['inputs']['seed'] == 1
+
+
+def test_apply_resolved_override(tmp_path):
+    write_workflow(str(tmp_path), {}, {})
+    compiled = compile_workflow(str(tmp_path))
+
+    prompt = compiled.apply({'3': {'inputs': {'steps': 4}}})
+    assert prompt['3']['inputs'] == {'seed': 1, 'steps': 4, 'model': ['4', 0]}
+    assert compiled.graph['3']['inputs']['steps'] == 20
+    assert compiled.apply(None) is compiled.graph
+
+
+def test_unknown_keys_are_rejected(tmp_path):
+    write_workflow(str(tmp_path), {'seed': 42}, {'3': {'inputs': {'seed': 'seed'}}})
+    with pytest.raises(OverrideTemplateError):
+        compile_workflow(str(tmp_path)).resolve({'sede': 7})
+
+    write_workflow(str(tmp_path), {}, {'99': {'inputs': {'seed': 'seed'}}})
+    os.utime(os.path.join(str(tmp_path), 'input_override.json'), ns=(0, 10**9))
+    with pytest.raises(OverrideTemplateError):
+        compile_workflow(str(tmp_path))
+
+
+def test_cache_invalidated_by_mtime(tmp_path):
+    write_workflow(str(tmp_path), {'seed': 42}, {'3': {'inputs': {'seed': 'seed'}}})
+    compiled = compile_workflow(str(tmp_path))
+    assert compile_workflow(str(tmp_path)) is compiled
+
+    write_workflow(str(tmp_path), {'seed': 43}, {'3': {'inputs': {'seed': 'seed'}}})
+    # file systems with coarse mtime may not see the rewrite
+    os.utime(os.path.join(str(tmp_path), 'input_override.json'), ns=(0, 2 * 10**9))
+    recompiled = compile_workflow(str(tmp_path))
+    assert recompiled is not compiled
+    assert recompiled.resolve({}) == {'3': {'inputs': {'seed': 43}}}
@@ -0,0 +1,68 @@
+""" Run phase tracing: nested spans, durations and exporters """
+import time
+
+import pytest
+
+from .tracing import Tracer, InMemoryExporter, PrometheusExporter
+
+
+def test_nested_spans_and_durations():
+    exporter = InMemoryExporter()
+    trace = Tracer([exporter]).start_trace(workflow='sdxl')
+    with trace.span('setup'):
+        with trace.span('stage_inputs') as span:
+            span.set('bytes', 1024)
+        with trace.span('server_start', pooled=True):
+            time.sleep(0.01)
+    for _ in range(2):
+        with trace.span('execute'):
+            pass
+
+    setup, stage, start, *_ = trace.spans
+    assert stage.parent_id == setup.span_id and start.parent_id == setup.span_id
+    assert setup.parent_id is None
+    assert start.attributes == {'pooled': True}
+    durations = trace.durations()
+    assert set(durations) == {'setup', 'stage_inputs', 'server_start', 'execute'}
+    assert durations['setup'] >= durations['server_start'] >= 0.01
+
+    # exported once, when finished
+    assert exporter.traces == []
+    trace.finish()
+    trace.finish()
+    assert exporter.traces == [trace]
+    assert [s.name for s in exporter.spans] == ['setup', 'stage_inputs', 'server_start', 'execute', 'execute']
+
+
+def test_failed_span_and_prometheus_render():
+    prometheus = PrometheusExporter(prefix='test_run')
+    tracer = Tracer([prometheus])
+    for _ in range(2):
+        trace = tracer.start_trace(workflow='say "hi"')
+        with trace.span('stage_inputs') as span:
+            span.set('bytes', 100)
+        with pytest.raises(RuntimeError):
+            with trace.span('execute'):
+                raise RuntimeError('prompt failed')
+        trace.finish()
+
+    assert trace.spans[1].error == 'RuntimeError: prompt failed'
+    assert trace.spans[1].duration_sec is not None
+    text = prometheus.render()
+    assert 'test_run_phase_duration_seconds_count{workflow="say \\"hi\\"",phase="execute"} 2' in text
+    assert 'test_run_phase_duration_seconds_bucket{workflow="say \\"hi\\"",phase="stage_inputs",le="+Inf"} 2' in text
+    assert 'test_run_phase_bytes_total{workflow="say \\"hi\\"",phase="stage_inputs"} 200' in text
+    assert 'test_run_phase_errors_total{workflow="say \\"hi\\"",phase="execute"} 2' in text
+
+
+def test_exporter_error_does_not_fail_the_run():
+    class BrokenExporter(InMemoryExporter):
+        def export(self, trace):
+            raise ValueError('collector down')
+
+    exporter = InMemoryExporter()
+    trace = Tracer([BrokenExporter(), exporter]).start_trace()
+    with trace.span('teardown'):
+        pass
+    trace.finish()
+    assert len(exporter.spans) == 1
@@ -0,0 +1,122 @@
+""" Prompt completion from websocket events, with polling fallback """
+import json
+
+import websocket
+
+from .tracker import PromptCompletionTracker
+
+
+class FakeService:
+    host = '127.0.0.1'
+    port = '8189'
+
+    def __init__(self, histories):
+        self.histories = list(histories)
+        self.calls = 0
+
+    def get_history(self, prompt_id):
+        self.calls += 1
+        return self.histories.pop(0) if len(self.histories) > 1 else self.histories[0]
+
+
+class FakeSocket:
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    def recv(self):
+        if not self.messages:
+            raise websocket.WebSocketConnectionClosedException('closed')
+        message = self.messages.pop(0)
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def close(self):
+        pass
+
+
+def _msg(type, **data):
+    return json.dumps({'type': type, 'data': data})
+
+
+DONE = {'p1': {'status': {'status_str': 'success', 'completed': True}, 'outputs': {}}}
+
+
+def test_resolves_on_executing_none_and_reports_progress():
+    events = []
+    service = FakeService([DONE])
+    tracker = PromptCompletionTracker(service, 'client', on_event=events.append)
+    tracker.ws = FakeSocket([
+        _msg('status', status={}),
+        websocket.WebSocketTimeoutException('idle'),
+        _msg('executing', node='3', prompt_id='other'),
+        _msg('executing', node='3', prompt_id='p1'),
+        _msg('progress', node='3', value=1, max=2, prompt_id='p1'),
+        b'preview image',
+        _msg('executed', node='3', output={}, prompt_id='p1'),
+        _msg('executing', node=None, prompt_id='p1'),
+    ])
+
+    assert tracker.wait('p1', timeout=5) == DONE
+    assert service.calls == 1
+    assert [e.type for e in events] == ['executing', 'progress', 'executed', 'executing']
+    assert events[1].value == 1 and events[1].max == 2
+
+
+def test_falls_back_to_polling_when_socket_drops(monkeypatch):
+    monkeypatch.setattr(PromptCompletionTracker, 'POLL_INITIAL_INTERVAL_SEC', 0.001)
+    service = FakeService([{}, {'p1': {'status': {'status_str': 'success', 'completed': False}}}, DONE])
+    tracker = PromptCompletionTracker(service, 'client')
+    tracker.ws = FakeSocket([_msg('executing', node='3', prompt_id='p1')])
+
+    assert tracker.wait('p1', timeout=5) == DONE
+    assert tracker.ws is None
+    assert service.calls == 3
+
+
+def test_error_status_is_done():
+    failed = {'p1': {'status': {'status_str': 'error', 'completed': False}}}
+    tracker = PromptCompletionTracker(FakeService([failed]), 'client')
+    assert tracker.wait('p1', timeout=5) == failed
+
+
+def test_batch_prompts_resolve_independently():
+    done = {
+        'p1': {'status': {'status_str': 'success', 'completed': True}},
+        'p2': {'status': {'status_str': 'error', 'completed': False}},
+    }
+
+    class BatchService(FakeService):
+        def get_history(self, prompt_id):
+            self.calls += 1
+            return {prompt_id: done[prompt_id]}
+
+    events = []
+    tracker = PromptCompletionTracker(BatchService([{}]), 'client', on_event=events.append)
+    tracker.ws = FakeSocket([
+        _msg('executing', node='3', prompt_id='p1'),
+        _msg('executing', node=None, prompt_id='p1'),
+        _msg('execution_error', node='3', prompt_id='p2'),
+        _msg('executing', node=None, prompt_id='p2'),
+    ])
+
+    assert tracker.wait_all(['p1', 'p2'], timeout=5) == done
+    assert [(e.type, e.prompt_id) for e in events][-1] == ('executing', 'p2')
+
+
+def test_history_error_after_done_event_falls_back_to_polling(monkeypatch):
+    monkeypatch.setattr(PromptCompletionTracker, 'POLL_INITIAL_INTERVAL_SEC', 0.001)
+
+    class FlakyService(FakeService):
+        def get_history(self, prompt_id):
+            self.calls += 1
+            if self.calls == 1:
+                raise ConnectionError('connection reset')
+            return DONE
+
+    service = FlakyService([DONE])
+    tracker = PromptCompletionTracker(service, 'client')
+    tracker.ws = FakeSocket([_msg('executing', node=None, prompt_id='p1')])
+
+    assert tracker.wait('p1', timeout=5) == DONE
+    assert service.calls == 2
@@ -6,6 +6,7 @@ import json
 from datetime import datetime
 from .dao import Workspace, reconstruct_workflow, reconstruct_inventory, get_workflow_manifest
 from .controller import run_workflow
+from .template import compile_workflow
 from .database import *
 
 
@@ -39,31 +40,9 @@ def test_workflow_run():
     #
     workflow_record_to_run = get_workflow_by_id(worflow_record.id) # workflow metadata
 
-    workflow_input_override_json_file = f'{workflow_record_to_run.workflow_dir}/input_override.json'
     # empty override, use default input from workflow
     input_override = {} 
-    override_template = {}
-    with open(workflow_input_override_json_file, 'r') as f:
-        workflow_input_override_json = json.load(f)
-        
-        # override value using parameters from request
-        override_value = workflow_input_override_json.get('override_value', {})
-        override_value.update(input_override)
-        
-        # interpolate override value into override template
-        override_template=workflow_input_override_json.get('override_template', {})
-        # recursively update the input value in override template
-        def update_input_value(override_value, override_template):
-            for k, v in override_template.items():
-                if isinstance(v, dict):
-                    update_input_value(override_value, v)
-                else:
-                    if v in override_value:
-                        override_template[k] = override_value[v]
-        update_input_value(
-            override_value, 
-            override_template
-        )
+    override_template = compile_workflow(workflow_record_to_run.workflow_dir).resolve(input_override)
     run_workflow(
         workspace, workflow_record_to_run,
         input_override=override_template
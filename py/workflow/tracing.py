@@ -0,0 +1,206 @@
+""" Per-phase timing of workflow runs
+A trace is recorded for every run: one span per phase (input download, staging, server startup,
+prompt submission, execution, output collection, teardown), nested, with attributes such as bytes
+staged or produced. Finished traces are handed to exporters:
+    - PrometheusExporter: phase duration histograms and byte counters, in the Prometheus text format
+    - OpenTelemetryExporter: spans sent through the OpenTelemetry API (optional dependency)
+    - InMemoryExporter: finished spans kept in a list, for tests
+
+    trace = tracer.start_trace(workflow='sdxl')
+    with trace.span('stage_inputs') as span:
+        span.set('bytes', 1024)
+    trace.finish()
+"""
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pydantic import BaseModel
+from loguru import logger
+
+from .readiness import StartupHistogram
+
+
+class Span(BaseModel):
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start_time: float # time.time()
+    duration_sec: Optional[float] = None # None while the span is open
+    attributes: Dict = {}
+    error: Optional[str] = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+
+class SpanExporter:
+    def export(self, trace: 'Trace'):
+        pass
+
+
+class Trace:
+    """ Spans of one run, phases are sequential: a new span is a child of the innermost open span """
+
+    def __init__(self, tracer: 'Tracer', attributes: Dict):
+        self.tracer = tracer
+        self.trace_id = uuid.uuid4().hex
+        self.attributes = attributes # e.g. workflow, run_id
+        self.spans: List[Span] = []
+        self._stack: List[Tuple[Span, float]] = []
+        self.finished = False
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        span = Span(name=name, trace_id=self.trace_id, span_id=uuid.uuid4().hex[:16],
+                    parent_id=self._stack[-1][0].span_id if self._stack else None,
+                    start_time=time.time(), attributes=attributes)
+        self.spans.append(span)
+        self._stack.append((span, time.monotonic()))
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            _, started = self._stack.pop()
+            span.duration_sec = time.monotonic() - started
+
+    def durations(self) -> Dict[str, float]:
+        """ Seconds per phase of the finished spans, repeated phases are summed """
+        durations = {}
+        for span in self.spans:
+            if span.duration_sec is not None:
+                durations[span.name] = durations.get(span.name, 0) + span.duration_sec
+        return durations
+
+    def finish(self):
+        """ Export the spans, once """
+        if self.finished:
+            return
+        self.finished = True
+        for exporter in self.tracer.exporters:
+            try:
+                exporter.export(self)
+            except Exception as e:
+                logger.warning(f"Error exporting trace {self.trace_id} with {type(exporter).__name__}: {e}")
+
+
+class Tracer:
+
+    def __init__(self, exporters: Optional[List[SpanExporter]] = None):
+        self.exporters = exporters if exporters is not None else []
+
+    def start_trace(self, **attributes) -> Trace:
+        return Trace(self, attributes)
+
+
+class InMemoryExporter(SpanExporter):
+
+    def __init__(self):
+        self.traces: List[Trace] = []
+
+    def export(self, trace: Trace):
+        self.traces.append(trace)
+
+    @property
+    def spans(self) -> List[Span]:
+        return [span for trace in self.traces for span in trace.spans]
+
+    def clear(self):
+        self.traces = []
+
+
+class PrometheusExporter(SpanExporter):
+    """ Phase duration histograms and byte counters per workflow """
+
+    BUCKETS_SEC = [0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600]
+
+    def __init__(self, prefix: str = 'comfyui_run'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._durations: Dict[Tuple[str, str], StartupHistogram] = {} # {(workflow, phase) -> histogram}
+        self._bytes: Dict[Tuple[str, str], int] = {} # {(workflow, phase) -> bytes}
+        self._errors: Dict[Tuple[str, str], int] = {}
+
+    def export(self, trace: Trace):
+        workflow = str(trace.attributes.get('workflow', ''))
+        with self._lock:
+            for span in trace.spans:
+                if span.duration_sec is None:
+                    continue
+                key = (workflow, span.name)
+                self._durations.setdefault(key, StartupHistogram(PrometheusExporter.BUCKETS_SEC)).observe(span.duration_sec)
+                if 'bytes' in span.attributes:
+                    self._bytes[key] = self._bytes.get(key, 0) + int(span.attributes['bytes'])
+                if span.error is not None:
+                    self._errors[key] = self._errors.get(key, 0) + 1
+
+    @staticmethod
+    def _labels(workflow: str, phase: str, **extra) -> str:
+        labels = {'workflow': workflow, 'phase': phase, **extra}
+        return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items())
+
+    def render(self) -> str:
+        """ Metrics in the Prometheus text exposition format """
+        name = f'{self.prefix}_phase_duration_seconds'
+        lines = [f'# HELP {name} Duration of workflow run phases', f'# TYPE {name} histogram']
+        with self._lock:
+            for (workflow, phase), histogram in sorted(self._durations.items()):
+                snapshot = histogram.snapshot()
+                for bound, count in snapshot['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f'{name}_bucket{{{self._labels(workflow, phase, le=le)}}} {count}')
+                lines.append(f'{name}_sum{{{self._labels(workflow, phase)}}} {snapshot["sum"]}')
+                lines.append(f'{name}_count{{{self._labels(workflow, phase)}}} {snapshot["count"]}')
+
+            name = f'{self.prefix}_phase_bytes_total'
+            lines += [f'# HELP {name} Bytes moved by workflow run phases', f'# TYPE {name} counter']
+            for (workflow, phase), value in sorted(self._bytes.items()):
+                lines.append(f'{name}{{{self._labels(workflow, phase)}}} {value}')
+
+            name = f'{self.prefix}_phase_errors_total'
+            lines += [f'# HELP {name} Failed workflow run phases', f'# TYPE {name} counter']
+            for (workflow, phase), value in sorted(self._errors.items()):
+                lines.append(f'{name}{{{self._labels(workflow, phase)}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class OpenTelemetryExporter(SpanExporter):
+    """ Replay finished spans through the OpenTelemetry API, the SDK and its exporter are configured by the app """
+
+    def __init__(self, tracer_name: str = 'comfyui_workflow'):
+        # optional dependency
+        from opentelemetry import trace as otel_trace
+        self._otel_trace = otel_trace
+        self._tracer = otel_trace.get_tracer(tracer_name)
+
+    def export(self, trace: Trace):
+        otel_spans = {}
+        for span in trace.spans:
+            if span.duration_sec is None:
+                continue
+            parent = otel_spans.get(span.parent_id, None)
+            context = self._otel_trace.set_span_in_context(parent) if parent is not None else None
+            start_ns = int(span.start_time * 1e9)
+            otel_span = self._tracer.start_span(
+                span.name, context=context, start_time=start_ns,
+                attributes={**{k: v for k, v in trace.attributes.items() if v is not None}, **span.attributes})
+            if span.error is not None:
+                otel_span.set_status(self._otel_trace.Status(self._otel_trace.StatusCode.ERROR, span.error))
+            otel_spans[span.span_id] = otel_span
+        # children end before their parent
+        for span in reversed(trace.spans):
+            if span.span_id in otel_spans:
+                otel_spans[span.span_id].end(end_time=int((span.start_time + span.duration_sec) * 1e9))
+
+
+# phase metrics of the process, served as text by the API
+prometheus_exporter = PrometheusExporter()
+tracer = Tracer(exporters=[prometheus_exporter])
+if os.environ.get('WORKFLOW_TRACING_OTEL', '0').lower() in ('1', 'true', 'yes'):
+    tracer.exporters.append(OpenTelemetryExporter())
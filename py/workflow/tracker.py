@@ -0,0 +1,250 @@
+""" Track prompt execution on a ComfyUI server
+ComfyUI pushes execution events to websocket clients on `/ws?clientId=...`:
+    - execution_start, execution_cached, executing, executed, progress
+    - execution_error, execution_interrupted, execution_success
+    - `executing` with `node == None` is sent once the prompt is done and its history is stored
+The tracker resolves a prompt as soon as that event arrives, and falls back to polling
+`/history/{prompt_id}` with adaptive backoff if the socket can not be opened or drops.
+The async runner waits with wait_all_async() on an AsyncComfyService and an aiohttp websocket.
+"""
+import asyncio
+import json
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+import aiohttp
+import websocket
+from pydantic import BaseModel
+from loguru import logger
+
+from .client import ComfyService
+
+
+class PromptEvent(BaseModel):
+    """ An execution event of a prompt, node level progress included """
+    type: str
+    prompt_id: Optional[str] = None
+    node: Optional[str] = None
+    value: Optional[int] = None # progress steps done
+    max: Optional[int] = None # progress total steps
+    data: Dict = {}
+
+
+class PromptCompletionTracker:
+    """ Wait for prompt completion using ComfyUI websocket events
+
+    tracker = PromptCompletionTracker(service, client_id)
+    tracker.connect() # connect before submitting the prompt, so no event is missed
+    ... POST /prompt with the same client_id ...
+    history = tracker.wait(prompt_id)
+    tracker.close()
+    """
+
+    WS_CONNECT_TIMEOUT_SEC = 10
+    WS_RECV_TIMEOUT_SEC = 1 # wake up periodically to check the deadline
+    POLL_INITIAL_INTERVAL_SEC = 0.25
+    POLL_MAX_INTERVAL_SEC = 5
+    POLL_BACKOFF = 2
+    POLL_MAX_ERRORS = 5
+
+    def __init__(self, service: ComfyService, client_id: str,
+                 on_event: Optional[Callable[[PromptEvent], None]] = None):
+        self.service = service
+        self.client_id = client_id
+        self.on_event = on_event
+        self.ws: Optional[websocket.WebSocket] = None
+
+    def connect(self) -> bool:
+        """ Open the event stream, return False if websocket is not available (polling is used) """
+        url = f"ws://{self.service.host}:{self.service.port}/ws?clientId={self.client_id}"
+        try:
+            ws = websocket.WebSocket()
+            ws.connect(url, timeout=PromptCompletionTracker.WS_CONNECT_TIMEOUT_SEC)
+            ws.settimeout(PromptCompletionTracker.WS_RECV_TIMEOUT_SEC)
+            self.ws = ws
+            return True
+        except Exception as e:
+            logger.warning(f"Error connecting to {url}: {e}, falling back to polling")
+            self.ws = None
+            return False
+
+    def close(self):
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except Exception as e:
+                logger.warning(f"Error closing websocket: {e}")
+            self.ws = None
+
+    def _emit(self, event: PromptEvent):
+        if self.on_event is None:
+            return
+        try:
+            self.on_event(event)
+        except Exception as e:
+            # a broken listener must not fail the run
+            logger.error(f"Error handling prompt event {event.type}: {e}")
+
+    @staticmethod
+    def parse_event(message) -> Optional[PromptEvent]:
+        if not isinstance(message, str):
+            # binary frames are preview images
+            return None
+        msg = json.loads(message)
+        data = msg.get('data', {}) or {}
+        node = data.get('node', None)
+        return PromptEvent(
+            type=msg.get('type', ''),
+            prompt_id=data.get('prompt_id', None),
+            node=str(node) if node is not None else None,
+            value=data.get('value', None),
+            max=data.get('max', None),
+            data=data)
+
+    def _on_message(self, message, waiting: Set[str]) -> Optional[str]:
+        """ Emit the event of a waited prompt, return the prompt id when the prompt is done """
+        event = self.parse_event(message)
+        if event is None or event.prompt_id not in waiting:
+            return None
+        self._emit(event)
+        if event.type == 'executing' and event.node is None:
+            waiting.discard(event.prompt_id)
+            return event.prompt_id
+        return None
+
+    def _on_history(self, history: Dict, prompt_id: str, pending: Set[str], histories: Dict):
+        if self.is_done(history, prompt_id):
+            histories.update(history)
+            pending.discard(prompt_id)
+
+    def _wait_events(self, pending: Set[str], histories: Dict, deadline: Optional[float]) -> bool:
+        """ Consume events until all pending prompts are done, return False if the socket drops """
+        waiting = set(pending)
+        while waiting:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Prompts {waiting} not completed in time")
+            try:
+                message = self.ws.recv()
+            except websocket.WebSocketTimeoutException:
+                continue
+            except Exception as e:
+                logger.warning(f"Websocket dropped while waiting for prompts {waiting}: {e}")
+                self.close()
+                return False
+
+            prompt_id = self._on_message(message, waiting)
+            if prompt_id is None:
+                continue
+            try:
+                history = self.service.get_history(prompt_id)
+            except Exception as e:
+                # the prompt stays pending, its history is picked up by polling
+                logger.warning(f"Error getting history of prompt {prompt_id}: {e}")
+                continue
+            # not done yet: the history is picked up by polling
+            self._on_history(history, prompt_id, pending, histories)
+        return True
+
+    async def _wait_events_async(self, ws, pending: Set[str], histories: Dict):
+        """ Same as _wait_events() on an aiohttp websocket, the caller bounds the wait """
+        waiting = set(pending)
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                prompt_id = self._on_message(msg.data, waiting)
+                if prompt_id is None:
+                    continue
+                try:
+                    self._on_history(await self.service.get_history(prompt_id), prompt_id, pending, histories)
+                except Exception as e:
+                    logger.warning(f"Error getting history of prompt {prompt_id}: {e}")
+                if not waiting:
+                    return
+        except Exception as e:
+            logger.warning(f"Websocket dropped while waiting for prompts {waiting}: {e}")
+
+    @staticmethod
+    def is_done(history: Dict, prompt_id: str) -> bool:
+        status = (history.get(prompt_id, None) or {}).get('status', None)
+        if status is None:
+            return False
+        return status.get('completed', False) or status.get('status_str', None) == 'error'
+
+    class _PollSchedule:
+        """ Start fast and back off exponentially while the prompts run, give up after repeated errors """
+
+        def __init__(self, deadline: Optional[float]):
+            self.deadline = deadline
+            self.interval = PromptCompletionTracker.POLL_INITIAL_INTERVAL_SEC
+            self.errors = 0
+
+        def error(self, pending: Set[str], e: Exception):
+            logger.error(f"Error getting prompt history: {e}")
+            self.errors += 1
+            if self.errors >= PromptCompletionTracker.POLL_MAX_ERRORS:
+                raise Exception(f"Error getting prompt history for {pending}")
+
+        def next_sleep(self, pending: Set[str]) -> float:
+            interval = self.interval
+            if self.deadline is not None:
+                remaining = self.deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Prompts {pending} not completed in time")
+                interval = min(interval, remaining)
+            self.interval = min(interval * PromptCompletionTracker.POLL_BACKOFF, PromptCompletionTracker.POLL_MAX_INTERVAL_SEC)
+            return interval
+
+    def _poll(self, pending: Set[str], histories: Dict, deadline: Optional[float]):
+        """ Poll prompt history until the prompts are done """
+        schedule = PromptCompletionTracker._PollSchedule(deadline)
+        while pending:
+            try:
+                for prompt_id in sorted(pending):
+                    self._on_history(self.service.get_history(prompt_id), prompt_id, pending, histories)
+                schedule.errors = 0
+                if not pending:
+                    return
+                logger.info(f"Prompts {pending} Workflow not completed yet")
+            except Exception as e:
+                schedule.error(pending, e)
+            time.sleep(schedule.next_sleep(pending))
+
+    async def _poll_async(self, pending: Set[str], histories: Dict, deadline: Optional[float]):
+        schedule = PromptCompletionTracker._PollSchedule(deadline)
+        while pending:
+            try:
+                for prompt_id in sorted(pending):
+                    self._on_history(await self.service.get_history(prompt_id), prompt_id, pending, histories)
+                schedule.errors = 0
+                if not pending:
+                    return
+                logger.info(f"Prompts {pending} Workflow not completed yet")
+            except Exception as e:
+                schedule.error(pending, e)
+            await asyncio.sleep(schedule.next_sleep(pending))
+
+    def wait_all(self, prompt_ids: List[str], timeout: Optional[float] = None) -> Dict:
+        """ Block until all prompts are done, each prompt resolves independently,
+        return the prompt histories {prompt_id -> history}
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = set(prompt_ids)
+        histories = {}
+        if self.ws is not None:
+            self._wait_events(pending, histories, deadline)
+        self._poll(pending, histories, deadline)
+        return histories
+
+    async def wait_all_async(self, prompt_ids: List[str], ws=None) -> Dict:
+        """ wait_all() with an AsyncComfyService, on the aiohttp websocket `ws` if given """
+        pending = set(prompt_ids)
+        histories = {}
+        if ws is not None:
+            await self._wait_events_async(ws, pending, histories)
+        await self._poll_async(pending, histories, None)
+        return histories
+
+    def wait(self, prompt_id: str, timeout: Optional[float] = None) -> Dict:
+        """ Block until the prompt is done, return the prompt history {prompt_id -> history} """
+        return self.wait_all([prompt_id], timeout=timeout)
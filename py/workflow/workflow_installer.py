@@ -1,54 +1,256 @@
-""" Manage workflow execution as state machine. 
+""" Manage workflow execution as state machine.
     - Workflow is associated with runtime workspace containing preloaded models and modules
     - Workflow execution generate runtime data and logs that are stored in workspace
+
+Workflow installation is a DAG of steps (inventory, base code checkout, custom node verification,
+model fetch/index, links, manifest, DB record). Independent steps run concurrently, several workflows
+can be installed in one call, and every step is idempotent so re-running an install is close to a no-op.
 """
 
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
+from typing import Callable, Dict, List, Optional, Sequence
+
+from pydantic import BaseModel
+from loguru import logger
+
 from .dao import Workspace, reconstruct_workflow, reconstruct_inventory, get_workflow_manifest
 from .controller import run_workflow
+from .model_store import ModelStore
+from .downloader import ModelDownloader
 from .database import *
 
 
-def install_workflow(workspace_base_path: str, workflow_base_path: str):
-    # 
+class StepResult(BaseModel):
+    name: str
+    deps: List[str] = []
+    status: str # planned, running, done, unchanged, failed, blocked
+    duration_sec: float = 0.0
+    error: Optional[str] = None
+
+
+class InstallReport(BaseModel):
+    dry_run: bool = False
+    duration_sec: float = 0.0
+    steps: List[StepResult] = []
+
+    @property
+    def failed(self) -> List[StepResult]:
+        return [step for step in self.steps if step.status == 'failed']
+
+
+class InstallError(RuntimeError):
+    """ Installation step failed, the report has the status of every step """
+
+    def __init__(self, report: InstallReport):
+        super().__init__(f"Install failed: {[(step.name, step.error) for step in report.failed]}")
+        self.report = report
+
+
+class InstallStep:
+    """ A step of the install DAG, `fn` returns False when there was nothing to do """
+
+    def __init__(self, name: str, fn: Callable[[], Optional[bool]], deps: Sequence[str] = ()):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+
+
+class InstallPlan:
+    """ Install DAG, steps run as soon as their dependencies are done
+
+    plan = InstallPlan()
+    plan.add('inventory', build_inventory)
+    plan.add('link', link, deps=['inventory'])
+    report = plan.run(max_workers=8)
+    """
+
+    def __init__(self):
+        self.steps: Dict[str, InstallStep] = {}
+
+    def add(self, name: str, fn: Callable[[], Optional[bool]], deps: Sequence[str] = ()) -> str:
+        assert name not in self.steps, f'Duplicated install step {name}'
+        self.steps[name] = InstallStep(name, fn, deps)
+        return name
+
+    def order(self) -> List[str]:
+        """ Steps in topological order, raise ValueError on unknown dependencies or cycles """
+        for step in self.steps.values():
+            unknown = [dep for dep in step.deps if dep not in self.steps]
+            if unknown:
+                raise ValueError(f'Install step {step.name} depends on unknown steps {unknown}')
+        order = []
+        remaining = {name: set(step.deps) for name, step in self.steps.items()}
+        while remaining:
+            ready = sorted(name for name, deps in remaining.items() if not deps)
+            if not ready:
+                raise ValueError(f'Install steps have a dependency cycle: {sorted(remaining)}')
+            for name in ready:
+                order.append(name)
+                remaining.pop(name)
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
+    def run(self, max_workers: int = 8, dry_run: bool = False) -> InstallReport:
+        """ Run the steps, raise InstallError if a step fails (its dependents are not started) """
+        started = time.monotonic()
+        order = self.order()
+        results = {name: StepResult(name=name, deps=self.steps[name].deps, status='planned') for name in order}
+        report = InstallReport(dry_run=dry_run, steps=[results[name] for name in order])
+        if dry_run:
+            return report
+
+        def execute(step: InstallStep):
+            step_started = time.monotonic()
+            try:
+                changed = step.fn()
+                results[step.name].status = 'unchanged' if changed is False else 'done'
+            finally:
+                results[step.name].duration_sec = time.monotonic() - step_started
+
+        pending = list(order)
+        running = {}
+        failed = False
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                if not failed:
+                    for name in list(pending):
+                        if all(results[dep].status in ('done', 'unchanged') for dep in self.steps[name].deps):
+                            pending.remove(name)
+                            results[name].status = 'running'
+                            running[executor.submit(execute, self.steps[name])] = name
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        # let running steps finish, do not start new ones
+                        failed = True
+                        results[name].status = 'failed'
+                        results[name].error = f'{type(error).__name__}: {error}'
+                        logger.error(f"Install step {name} failed: {error}")
+                    else:
+                        logger.info(f"Install step {name} {results[name].status} in {results[name].duration_sec:.2f}s")
+
+        for name in pending:
+            results[name].status = 'blocked'
+        report.duration_sec = time.monotonic() - started
+        if failed:
+            raise InstallError(report)
+        return report
+
+
+def plan_install(workspace_base_path: str, workflow_base_paths: List[str]) -> InstallPlan:
+    #
     # Workflow installation
     #
-    
+
     # Workflow pre-requisite files
     # - workflow.json // for backup an reuse
     # - workflow_api.json
     # - input_override.json
     # - dependency.json
     # - input/
-
-    # base_path = "/home/ruoyu.huang/workspace/xiaoapp/comfyui_workspace"
     workspace = Workspace(base_path=workspace_base_path)
-    inventory = reconstruct_inventory(workspace_base_path)
+    workflows = [reconstruct_workflow(workflow_base_path) for workflow_base_path in workflow_base_paths]
+    state = {} # results shared by steps, e.g. the inventory
+    plan = InstallPlan()
 
-    
-    # Assume an app is installed in this path, below is the installation logic
-    #
-    # TODO: add records in database
+    def build_inventory():
+        state['inventory'] = reconstruct_inventory(workspace_base_path)
+
+    def fetch_models():
+        # install missing models of the workflows to the inventory
+        models = [model for workflow in workflows for model in workflow.dependency_config.custom_models]
+        if not ModelDownloader(workspace).fetch_missing(state['inventory'], models):
+            return False
+        state['inventory'] = reconstruct_inventory(workspace_base_path)
+
+    def index_models():
+        # models are linked by digest, hash new or changed model files
+        model_store = ModelStore(workspace)
+        model_store.scan()
+        model_store.annotate(state['inventory'])
+
+    def init_database():
+        # a process that configured its database (e.g. the API) keeps its engine, only the tables are migrated
+        if is_database_configured():
+            migrate()
+        else:
+            init_db(workspace)
+
+    plan.add('inventory', build_inventory)
+    plan.add('models:fetch', fetch_models, deps=['inventory'])
+    plan.add('models:index', index_models, deps=['models:fetch'])
+    plan.add('db:init', init_database)
+
+    for workflow in workflows:
+        # Expand workflow into a workspace, steps are named after the workflow dir
+        w = workflow.workflow_dir
+        dirs = plan.add(f'{w}:dirs', workflow.prepare_dirs)
+        base_code = plan.add(f'{w}:base_code', lambda workflow=workflow: workflow._clone_main_module(workspace), deps=[dirs])
+        verify = [plan.add(f'{w}:verify:base_code', lambda workflow=workflow: workflow.verify_base_code(state['inventory']),
+                           deps=['inventory'])]
+        for custom_node in workflow.dependency_config.custom_nodes:
+            verify.append(plan.add(
+                f'{w}:verify:{custom_node.name}',
+                lambda workflow=workflow, custom_node=custom_node: workflow.verify_custom_node(state['inventory'], custom_node),
+                deps=['inventory']))
+        link_nodes = plan.add(f'{w}:link:custom_nodes', lambda workflow=workflow: workflow.link_custom_nodes(state['inventory']),
+                              deps=[base_code, 'inventory'])
+        link_models = plan.add(f'{w}:link:models', lambda workflow=workflow: workflow.link_custom_models(state['inventory']),
+                               deps=[base_code, 'models:index'])
+
+        def write_manifest(workflow=workflow):
+            state[f'{workflow.workflow_dir}:manifest_changed'] = workflow.write_manifest()
+            return state[f'{workflow.workflow_dir}:manifest_changed']
+
+        # Write the workflow manifest to workspace
+        manifest = plan.add(f'{w}:manifest', write_manifest, deps=verify + [link_nodes, link_models])
+
+        def register(workflow=workflow):
+            # Write the workflow metadata to database, one record per workflow dir
+            now = datetime.now().isoformat()
+            workflow_record = get_workflow_by_dir(workflow.workflow_dir)
+            if workflow_record is None:
+                create_workflow(WorkflowRecord(
+                    name=workflow.name,
+                    workflow_dir=workflow.workflow_dir,
+                    created_at=now,
+                    updated_at=now,
+                    description=workflow.description))
+                return
+            # a new version of the workflow (the manifest has all of it), cached workflows are revalidated by updated_at
+            if not state[f'{workflow.workflow_dir}:manifest_changed']:
+                return False
+            workflow_record.name = workflow.name
+            workflow_record.description = workflow.description
+            workflow_record.updated_at = now
+            update_workflow(workflow_record)
+        plan.add(f'{w}:db', register, deps=[manifest, 'db:init'])
+
+    return plan
+
+
+def install_workflows(workspace_base_path: str, workflow_base_paths: List[str],
+                      max_workers: int = 8, dry_run: bool = False) -> InstallReport:
+    """ Install workflows concurrently, `dry_run` returns the plan without running it """
+    plan = plan_install(workspace_base_path, workflow_base_paths)
+    report = plan.run(max_workers=max_workers, dry_run=dry_run)
+    for step in report.steps:
+        logger.info(f"{step.name}: {step.status} {step.duration_sec:.2f}s")
+    return report
+
+
+def install_workflow(workspace_base_path: str, workflow_base_path: str) -> InstallReport:
+    # base_path = "/home/ruoyu.huang/workspace/xiaoapp/comfyui_workspace"
     # workflow_base_path = "/home/ruoyu.huang/workspace/xiaoapp/comfyui_workspace/workflows/sticker"
-    workflow = reconstruct_workflow(workflow_base_path)
-    # Expand workflow into a workspace
-    # Write the workflow manifest to workspace
-    workflow.prepare_workspace(inventory)
-
-    # Write the workflow metadata to database
-    init_db()
-    worflow_record = WorkflowRecord(
-        name=workflow.name, 
-        workflow_dir=workflow.workflow_dir,
-        created_at=datetime.now().isoformat(),
-        description=workflow.description)
-    create_workflow(worflow_record)
-
-    # 
-    # Run the workflow
-    #
-    # workflow_record_to_run = get_workflow_by_id(worflow_record.id) # workflow metadata
-    # run_workflow(workspace, workflow_record_to_run)
+    return install_workflows(workspace_base_path, [workflow_base_path])
+
 
 if __name__ == "__main__":
     install_workflow(